@@ -0,0 +1,56 @@
+""" Apply retention tiers of config to ClickHouse tables. Runs once before api workers start (run.sh),
+so ON CLUSTER DDL is not issued by every worker.
+
+    python apply_retention.py
+"""
+from aiochclient import ChClient
+from aiohttp import ClientSession
+
+from config import settings, setup_logging
+from core.retention import RetentionPolicy, make_tiers
+
+import asyncio
+import logging
+
+
+setup_logging(log_level=settings.log_level, log_file=settings.log_path)
+logger = logging.getLogger(__name__)
+
+
+async def main() -> None:
+    if not settings.retention_apply:
+        logger.info("Retention: retention_apply is off, skip")
+        return
+
+    async with ClientSession() as session:
+        ch = ChClient(
+            session,
+            url=settings.clickhouse_url,
+            user=settings.clickhouse_user,
+            password=settings.clickhouse_password,
+            database=settings.clickhouse_db
+        )
+        retention = RetentionPolicy(
+            ch=ch,
+            tiers=make_tiers(
+                raw_days=settings.retention_raw_days,
+                m1_days=settings.retention_1m_days,
+                m5_days=settings.retention_5m_days,
+                h1_days=settings.retention_1h_days,
+                d1_days=settings.retention_1d_days,
+                tag_index_days=settings.retention_tag_index_days,
+                inventory_days=settings.retention_inventory_days
+            ),
+            cold_volume=settings.retention_cold_volume,
+            cold_after=settings.retention_cold_after_days,
+            database=settings.clickhouse_db,
+            cluster=settings.clickhouse_cluster
+        )
+        try:
+            await retention.apply()
+        except Exception as e:
+            logger.error(f"Retention: apply failed: {e}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
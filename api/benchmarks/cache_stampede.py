@@ -0,0 +1,99 @@
+""" Cache expiry burst: several worker processes get the same cached key right after it expired.
+Counts how many times the ClickHouse query would run, with and without stampede protection.
+The query is simulated with a sleep. With --redis workers share redis from .env and redis lease,
+without it every worker has only its own in-process cache.
+
+    python -m benchmarks.cache_stampede --workers 4 --requests 200 --latency 0.2 --redis
+"""
+from multiprocessing import Barrier, Process, Queue
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+from core.redis import connect_to_redis, redis_cache, setup_cache_refresh, setup_local_cache
+
+import argparse
+import asyncio
+import time
+import uuid
+
+
+class FakeRepository:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.queries: int = 0
+
+    @redis_cache(key_prefix="stampede", ttl=1)
+    async def get_metrics(self, query: Any) -> List[Dict[str, float]]:
+        self.queries += 1
+        await asyncio.sleep(self.latency)
+        return [{"value": time.time()}]
+
+
+async def run_worker(args: argparse.Namespace, protected: bool, metric: str, barrier: Barrier, out: Queue) -> None:
+    if args.redis:
+        from config import settings
+        await connect_to_redis(settings.redis_host, settings.redis_port, settings.redis_password)
+    setup_local_cache(max_entries=1024, ttl=1)
+    setup_cache_refresh(stale_ttl=args.stale_ttl if protected else 0, lock_ttl=10, enabled=protected)
+
+    repository = FakeRepository(args.latency)
+    query = SimpleNamespace(metric=metric)
+
+    # warm the key and let it expire in every tier
+    await repository.get_metrics(query=query)
+    await asyncio.to_thread(barrier.wait)
+    await asyncio.sleep(1.1)
+    repository.queries = 0
+
+    await asyncio.to_thread(barrier.wait)
+    started: float = time.monotonic()
+    await asyncio.gather(*(repository.get_metrics(query=query) for _ in range(args.requests)))
+    elapsed: float = time.monotonic() - started
+
+    # let background refreshes finish
+    await asyncio.sleep(args.latency * 2)
+    out.put((repository.queries, elapsed))
+
+
+def worker(args: argparse.Namespace, protected: bool, metric: str, barrier: Barrier, out: Queue) -> None:
+    asyncio.run(run_worker(args, protected, metric, barrier, out))
+
+
+def run(args: argparse.Namespace, protected: bool) -> None:
+    barrier: Barrier = Barrier(args.workers)
+    out: Queue = Queue()
+    # fresh key per run, so runs do not see each other in redis
+    metric: str = f"stampede-{uuid.uuid4().hex[:8]}"
+    processes: List[Process] = [
+        Process(target=worker, args=(args, protected, metric, barrier, out)) for _ in range(args.workers)
+    ]
+    for p in processes:
+        p.start()
+    results = [out.get() for _ in processes]
+    for p in processes:
+        p.join()
+
+    queries: int = sum(q for q, _ in results)
+    slowest: float = max(e for _, e in results)
+    name: str = "protected" if protected else "unprotected"
+    print(
+        f"{name:<12} {args.workers * args.requests:>6} requests {queries:>6} queries"
+        f" burst {slowest * 1000:>8.1f} ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=200, help="concurrent requests per worker")
+    parser.add_argument("--latency", type=float, default=0.2, help="simulated query seconds")
+    parser.add_argument("--stale-ttl", type=int, default=0, help="serve stale result while it is refreshed")
+    parser.add_argument("--redis", action="store_true", help="share redis from .env between workers")
+    args = parser.parse_args()
+
+    run(args, protected=False)
+    run(args, protected=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+""" Check that single query compare returns the same periods as two sequential period queries
+and compare latency of both. Needs clickhouse settings in .env and some data in metrics_1m.
+
+    python -m benchmarks.compare_query --metric cpu_usage --hours 6 --repeat 20
+"""
+from aiochclient import ChClient
+from aiohttp import ClientSession
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from config import settings
+from core.db import MetricsReadRepository
+
+import argparse
+import asyncio
+import math
+import sys
+import time
+
+
+TABLE: str = "infra.metrics_1m"
+BUCKET: str = "minute"
+
+
+def same(a: Optional[Dict[str, float]], b: Optional[Dict[str, float]]) -> bool:
+    if a is None or b is None:
+        return a is b
+    return all(
+        (math.isnan(a[k]) and math.isnan(b[k])) or math.isclose(a[k], b[k], rel_tol=1e-9) for k in a
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--metric", default="cpu_usage")
+    parser.add_argument("--hours", type=int, default=6, help="length of every period")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    now: datetime = datetime.utcnow().replace(microsecond=0)
+    period: timedelta = timedelta(hours=args.hours)
+    cases: List[Tuple[str, Tuple[datetime, datetime], Tuple[datetime, datetime]]] = [
+        ("adjacent", (now - period, now), (now - 2 * period, now - period)),
+        ("overlapping", (now - period, now), (now - period * 1.5, now - period / 2)),
+        ("far apart", (now - period, now), (now - 10 * period, now - 9 * period)),
+    ]
+    where: List[str] = [f"metric = '{args.metric}'"]
+
+    async with ClientSession() as session:
+        ch = ChClient(
+            session,
+            url=settings.clickhouse_url,
+            user=settings.clickhouse_user,
+            password=settings.clickhouse_password,
+            database=settings.clickhouse_db
+        )
+        repository = MetricsReadRepository(ch=ch)
+
+        for name, period_a, period_b in cases:
+            sequential: float = 0.0
+            single: float = 0.0
+            for _ in range(args.repeat):
+                started: float = time.perf_counter()
+                a = await repository._aggregate_period(TABLE, BUCKET, where, *period_a)
+                b = await repository._aggregate_period(TABLE, BUCKET, where, *period_b)
+                sequential += time.perf_counter() - started
+
+                started = time.perf_counter()
+                new_a, new_b = await repository._aggregate_periods(TABLE, BUCKET, where, period_a, period_b)
+                single += time.perf_counter() - started
+
+                if not same(dict(a) if a else None, new_a) or not same(dict(b) if b else None, new_b):
+                    print(f"{name}: results differ: {dict(a)} {dict(b)} != {new_a} {new_b}")
+                    sys.exit(1)
+
+            print(
+                f"{name:<12} sequential {sequential / args.repeat * 1000:>8.1f} ms"
+                f"  combined {single / args.repeat * 1000:>8.1f} ms  results match"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
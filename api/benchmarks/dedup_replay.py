@@ -0,0 +1,104 @@
+""" Replay the same batches many times against local ClickHouse and check that raw count and
+rollup aggregates do not change. Needs clickhouse settings in .env and migration 001 applied.
+Replay of spooled inserts under their own tokens is covered by tests/test_spool_replay.py.
+
+    python -m benchmarks.dedup_replay --batches 50 --replays 10
+"""
+from aiochclient import ChClient
+from aiohttp import ClientSession
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+from config import settings
+from core.db import MetricsWriteRepository
+from core.dedup import make_insert_token
+from src.schemas import RawMetricRow
+
+import argparse
+import asyncio
+import random
+import sys
+import uuid
+
+
+TABLES: Dict[str, str] = {
+    "infra.metrics_1m": "minute",
+    "infra.metrics_5m": "bucket",
+    "infra.metrics_1h": "bucket",
+}
+
+
+def make_batches(host: str, count: int) -> List[List[RawMetricRow]]:
+    start: datetime = datetime.utcnow().replace(microsecond=0) - timedelta(minutes=count)
+    return [
+        [
+            RawMetricRow(start + timedelta(minutes=i), host, f"vm-{vm}", metric, random.random(), {})
+            for vm in range(10)
+            for metric in ("cpu_usage", "ram_used_pct")
+        ]
+        for i in range(count)
+    ]
+
+
+async def snapshot(ch: ChClient, host: str) -> Dict[str, Any]:
+    await ch.execute("SYSTEM FLUSH DISTRIBUTED infra.metrics_raw")
+    for table in TABLES:
+        await ch.execute(f"SYSTEM FLUSH DISTRIBUTED {table}")
+
+    result: Dict[str, Any] = {}
+    raw = await ch.fetchrow(f"SELECT count() AS cnt, sum(value) AS total FROM infra.metrics_raw WHERE host = '{host}'")
+    result["raw"] = (raw["cnt"], round(raw["total"], 9))
+
+    for table, bucket in TABLES.items():
+        row = await ch.fetchrow(f"""
+            SELECT
+                countMerge(cnt_value) AS cnt,
+                sumMerge(sum_value) AS total,
+                avgMerge(avg_value) AS avg
+            FROM {table}
+            WHERE host = '{host}'
+        """)
+        result[table] = (row["cnt"], round(row["total"], 9), round(row["avg"], 9))
+    return result
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batches", type=int, default=50)
+    parser.add_argument("--replays", type=int, default=10)
+    args = parser.parse_args()
+
+    host: str = f"dedup-check-{uuid.uuid4().hex[:8]}"
+    batches: List[List[RawMetricRow]] = make_batches(host, args.batches)
+
+    async with ClientSession() as session:
+        ch = ChClient(
+            session,
+            url=settings.clickhouse_url,
+            user=settings.clickhouse_user,
+            password=settings.clickhouse_password,
+            database=settings.clickhouse_db
+        )
+        repository = MetricsWriteRepository(ch=ch)
+
+        for i, rows in enumerate(batches):
+            await repository.insert_rows(rows, make_insert_token(rows, f"{host}/{i}"))
+        expected: Dict[str, Any] = await snapshot(ch, host)
+        print(f"after first insert: {expected}")
+
+        for replay in range(args.replays):
+            order: List[int] = list(range(len(batches)))
+            random.shuffle(order)
+            for i in order:
+                await repository.insert_rows(batches[i], make_insert_token(batches[i], f"{host}/{i}"))
+
+            actual: Dict[str, Any] = await snapshot(ch, host)
+            if actual != expected:
+                print(f"replay {replay + 1}: aggregates changed: {actual}")
+                sys.exit(1)
+
+        print(f"{args.replays} replays of {args.batches} batches: aggregates unchanged")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,71 @@
+""" CPU cost of encoding raw metric rows for insert: JSONEachRow vs RowBinary.
+Rows/sec is measured with process time, so it is per worker core.
+
+    python -m benchmarks.insert_formats --rows 100000 --vms 1000
+"""
+from datetime import datetime, timedelta
+from typing import Callable, List
+
+from core.db import MetricsWriteRepository
+from core.rowbinary import encode_rows
+from src.schemas import RawMetricRow
+
+import argparse
+import json
+import time
+import zlib
+
+
+METRICS: List[str] = ["cpu_usage", "load_1", "load_5", "load_15", "ram_used_pct", "disk_used_pct"]
+
+
+def make_rows(count: int, vms: int) -> List[RawMetricRow]:
+    now: datetime = datetime.utcnow().replace(microsecond=0)
+    return [
+        RawMetricRow(
+            ts=now - timedelta(seconds=i // (vms * len(METRICS))),
+            host=f"host-{i % vms // 50}",
+            vm=f"vm-{i % vms}",
+            metric=METRICS[i % len(METRICS)],
+            value=(i % 1000) / 1000,
+            tags={"mount": "/"} if i % len(METRICS) == 5 else {},
+        )
+        for i in range(count)
+    ]
+
+
+def encode_json(rows: List[RawMetricRow]) -> bytes:
+    # same serialization aiochclient does for JSONEachRow inserts
+    return json.dumps(MetricsWriteRepository._to_json_rows(rows)).encode()
+
+
+def run(name: str, encode: Callable[[List[RawMetricRow]], bytes], rows: List[RawMetricRow], repeat: int) -> None:
+    size: int = 0
+    started: float = time.process_time()
+    for _ in range(repeat):
+        size = len(encode(rows))
+    elapsed: float = time.process_time() - started
+
+    print(
+        f"{name:<16} {len(rows) * repeat / elapsed:>14,.0f} rows/sec/core"
+        f" {size / len(rows):>8.1f} bytes/row"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--vms", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rows: List[RawMetricRow] = make_rows(args.rows, args.vms)
+
+    run("json", encode_json, rows, args.repeat)
+    run("json+gzip", lambda r: zlib.compress(encode_json(r), 1), rows, args.repeat)
+    run("rowbinary", encode_rows, rows, args.repeat)
+    run("rowbinary+gzip", lambda r: zlib.compress(encode_rows(r), 1), rows, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
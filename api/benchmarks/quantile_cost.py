@@ -0,0 +1,86 @@
+""" Cost of t-digest quantile states: compressed bytes of q_value against avg/min/max/sum/count states
+in every rollup table, and latency of /metrics series and /metrics/top queries with stat=avg and stat=p95.
+Needs clickhouse settings in .env and some data in rollups written after migration 005.
+
+    python -m benchmarks.quantile_cost --metric cpu_usage --hours 24 --repeat 20
+"""
+from aiochclient import ChClient
+from aiohttp import ClientSession
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List
+
+from config import settings
+from core.db import MetricsReadRepository
+from src.schemas import MetricsQuery, MetricsTopQuery, Resolution, Scope, Stat
+
+import argparse
+import asyncio
+import time
+
+
+TABLES: List[str] = ["metrics_1m_local", "metrics_5m_local", "metrics_1h_local", "metrics_1d_local"]
+BASE_COLUMNS: List[str] = ["avg_value", "min_value", "max_value", "sum_value", "cnt_value"]
+
+
+async def timed(func: Callable[[], Awaitable[Any]], repeat: int) -> float:
+    started: float = time.perf_counter()
+    for _ in range(repeat):
+        await func()
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--metric", default="cpu_usage")
+    parser.add_argument("--hours", type=int, default=24, help="range of series queries")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    async with ClientSession() as session:
+        ch = ChClient(
+            session,
+            url=settings.clickhouse_url,
+            user=settings.clickhouse_user,
+            password=settings.clickhouse_password,
+            database=settings.clickhouse_db
+        )
+
+        rows = await ch.fetch(f"""
+            SELECT table, name, sum(data_compressed_bytes) AS bytes
+            FROM system.columns
+            WHERE database = 'infra' AND table IN ({", ".join(f"'{t}'" for t in TABLES)})
+                AND name IN ({", ".join(f"'{c}'" for c in BASE_COLUMNS + ["q_value"])})
+            GROUP BY table, name
+        """)
+        sizes: Dict[str, Dict[str, int]] = {}
+        for row in rows:
+            sizes.setdefault(row["table"], {})[row["name"]] = row["bytes"]
+
+        print("storage, compressed")
+        for table in TABLES:
+            base: int = sum(sizes.get(table, {}).get(c, 0) for c in BASE_COLUMNS)
+            digest: int = sizes.get(table, {}).get("q_value", 0)
+            overhead: str = f"{digest / base * 100:>7.1f} %" if base else "      n/a"
+            print(f"{table:<18} states {base / 2 ** 20:>10.2f} MiB  q_value {digest / 2 ** 20:>10.2f} MiB  {overhead}")
+
+        # no range cache or snapshot, every call reads ClickHouse
+        repository = MetricsReadRepository(ch=ch)
+        now: datetime = datetime.utcnow().replace(microsecond=0)
+
+        print("\nlatency")
+        for resolution in (Resolution.m1, Resolution.m5, Resolution.h1):
+            for stat in (Stat.avg, Stat.p95):
+                series = MetricsQuery(
+                    metric=args.metric, scope=Scope.global_, resolution=resolution, stat=stat,
+                    from_ts=now - timedelta(hours=args.hours), to_ts=now
+                )
+                top = MetricsTopQuery(metric=args.metric, scope=Scope.vm, resolution=resolution, stat=stat)
+                series_ms: float = await timed(lambda: repository.get_metrics(series), args.repeat)
+                top_ms: float = await timed(lambda: repository.get_top_metrics(top), args.repeat)
+                print(
+                    f"{resolution.value:<3} stat={stat.value:<4} series {series_ms:>8.1f} ms  top {top_ms:>8.1f} ms"
+                )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
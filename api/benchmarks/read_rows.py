@@ -0,0 +1,126 @@
+""" Rows and bytes read by read endpoints with projections and skip indexes (migration 006)
+and without them. Every endpoint query runs twice, the baseline client disables projections
+and skip indexes, rows read are taken from system.query_log by log_comment.
+Needs clickhouse settings in .env and some data in rollups.
+
+    python -m benchmarks.read_rows --metric cpu_usage --hours 6 --resolution 1m
+"""
+from aiochclient import ChClient
+from aiohttp import ClientSession
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+from config import settings
+from core.db import MetricsReadRepository
+from src.schemas import (
+    CardinalityScope, MetricsCardinalityQuery, MetricsCompareQuery, MetricsExtremesQuery, MetricsQuery,
+    MetricsTopQuery, MetricsTrendQuery, Resolution, Scope
+)
+
+import argparse
+import asyncio
+import uuid
+
+
+MODES: Dict[str, Dict[str, int]] = {
+    "baseline": {"optimize_use_projections": 0, "use_skip_indexes": 0},
+    "indexed": {},
+}
+
+
+def make_client(session: ClientSession, comment: str, **ch_settings: Any) -> ChClient:
+    return ChClient(
+        session,
+        url=settings.clickhouse_url,
+        user=settings.clickhouse_user,
+        password=settings.clickhouse_password,
+        database=settings.clickhouse_db,
+        log_comment=comment,
+        **ch_settings
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--metric", default="cpu_usage")
+    parser.add_argument("--hours", type=int, default=6)
+    parser.add_argument("--resolution", default="1m", choices=[r.value for r in Resolution])
+    args = parser.parse_args()
+
+    now: datetime = datetime.utcnow().replace(microsecond=0)
+    from_ts: datetime = now - timedelta(hours=args.hours)
+    resolution: Resolution = Resolution(args.resolution)
+    table: str = MetricsReadRepository.TABLE_BY_RESOLUTION[resolution]
+    bucket: str = "minute" if resolution == Resolution.m1 else "bucket"
+    run_id: str = uuid.uuid4().hex[:8]
+
+    async with ClientSession() as session:
+        ch = make_client(session, f"read_rows:{run_id}:setup")
+        row = await ch.fetchrow(f"SELECT any(vm) AS vm FROM {table} WHERE metric = '{args.metric}'")
+        vm: str = row["vm"] if row else ""
+
+        # endpoint name, call with repository of the given client
+        cases: List[Tuple[str, Callable[[MetricsReadRepository, ChClient], Awaitable[Any]]]] = [
+            ("metrics global", lambda r, c: r.get_metrics(MetricsQuery(
+                metric=args.metric, scope=Scope.global_, resolution=resolution, from_ts=from_ts, to_ts=now
+            ))),
+            ("trend global", lambda r, c: r.get_trend_metrics(MetricsTrendQuery(
+                metric=args.metric, scope=Scope.global_, resolution=resolution, from_ts=from_ts, to_ts=now
+            ))),
+            ("compare global", lambda r, c: r.get_compare_metrics(MetricsCompareQuery(
+                metric=args.metric, scope=Scope.global_, resolution=resolution,
+                from_a=now - timedelta(hours=1), to_a=now, from_b=now - timedelta(hours=2), to_b=now - timedelta(hours=1)
+            ))),
+            ("top vm", lambda r, c: r.get_top_metrics(MetricsTopQuery(
+                metric=args.metric, scope=Scope.vm, resolution=resolution
+            ))),
+            ("extremes", lambda r, c: r.get_extreme_metrics(MetricsExtremesQuery(
+                resolution=resolution, from_ts=from_ts, to_ts=now
+            ))),
+            ("cardinality range", lambda r, c: r.get_cardinality_metrics(MetricsCardinalityQuery(
+                scope=CardinalityScope.vm, resolution=resolution, from_ts=from_ts, to_ts=now
+            ))),
+            ("cardinality latest", lambda r, c: r.get_cardinality_metrics(MetricsCardinalityQuery(
+                scope=CardinalityScope.host, resolution=resolution
+            ))),
+            ("vm without host", lambda r, c: c.fetch(f"""
+                SELECT {bucket}, avgMerge(avg_value) AS avg
+                FROM {table}
+                WHERE metric = '{args.metric}' AND vm = '{vm}'
+                    AND {bucket} >= toDateTime('{from_ts:%Y-%m-%d %H:%M:%S}')
+                GROUP BY {bucket}
+            """)),
+        ]
+
+        for name, call in cases:
+            for mode, ch_settings in MODES.items():
+                # no range cache, snapshot or redis: every call reads ClickHouse
+                client = make_client(session, f"read_rows:{run_id}:{name}:{mode}", **ch_settings)
+                await call(MetricsReadRepository(ch=client), client)
+
+        await ch.execute("SYSTEM FLUSH LOGS")
+        rows = await ch.fetch(f"""
+            SELECT
+                log_comment,
+                sum(read_rows) AS rows,
+                sum(read_bytes) AS bytes,
+                sum(query_duration_ms) AS ms
+            FROM system.query_log
+            WHERE type = 'QueryFinish' AND is_initial_query AND log_comment LIKE 'read_rows:{run_id}:%'
+            GROUP BY log_comment
+        """)
+
+    stats: Dict[str, Dict[str, Any]] = {row["log_comment"]: dict(row) for row in rows}
+    print(f"{'endpoint':<20} {'rows before':>12} {'rows after':>12} {'MiB before':>11} {'MiB after':>10} {'ms':>13}")
+    for name, _ in cases:
+        before: Dict[str, Any] = stats.get(f"read_rows:{run_id}:{name}:baseline", {"rows": 0, "bytes": 0, "ms": 0})
+        after: Dict[str, Any] = stats.get(f"read_rows:{run_id}:{name}:indexed", {"rows": 0, "bytes": 0, "ms": 0})
+        print(
+            f"{name:<20} {before['rows']:>12,} {after['rows']:>12,}"
+            f" {before['bytes'] / 2 ** 20:>11.1f} {after['bytes'] / 2 ** 20:>10.1f}"
+            f" {before['ms']:>6} -> {after['ms']:<5}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
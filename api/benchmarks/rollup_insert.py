@@ -0,0 +1,80 @@
+""" Insert throughput of raw rows with rollup views attached, and parts written to every rollup table.
+Run it before and after migration 003 to compare direct and cascaded rollups.
+Needs clickhouse settings in .env, new parts are counted from system.part_log if it is enabled.
+
+    python -m benchmarks.rollup_insert --batches 200 --rows 5000
+"""
+from aiochclient import ChClient
+from aiohttp import ClientSession
+from datetime import datetime
+from typing import List
+
+from benchmarks.insert_formats import make_rows
+from config import settings
+from core.db import MetricsWriteRepository
+from src.schemas import RawMetricRow
+
+import argparse
+import asyncio
+import time
+
+
+TABLES: List[str] = ["metrics_raw_local", "metrics_1m_local", "metrics_5m_local", "metrics_1h_local"]
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batches", type=int, default=200)
+    parser.add_argument("--rows", type=int, default=5000, help="rows per insert")
+    parser.add_argument("--vms", type=int, default=1000)
+    args = parser.parse_args()
+
+    rows: List[RawMetricRow] = make_rows(args.rows, args.vms)
+
+    async with ClientSession() as session:
+        ch = ChClient(
+            session,
+            url=settings.clickhouse_url,
+            user=settings.clickhouse_user,
+            password=settings.clickhouse_password,
+            database=settings.clickhouse_db
+        )
+        repository = MetricsWriteRepository(ch=ch)
+
+        views = await ch.fetch(
+            "SELECT name, as_select FROM system.tables WHERE database = 'infra' AND engine = 'MaterializedView'"
+        )
+        for view in views:
+            source: str = view["as_select"].split(" FROM ")[-1].split()[0]
+            print(f"{view['name']:<28} <- {source}")
+
+        started_at: datetime = datetime.utcnow().replace(microsecond=0)
+        started: float = time.perf_counter()
+        for _ in range(args.batches):
+            await repository.insert_rows(rows)
+        elapsed: float = time.perf_counter() - started
+
+        print(f"\n{args.batches * args.rows / elapsed:,.0f} rows/sec ({args.batches} inserts of {args.rows} rows)")
+
+        await ch.execute("SYSTEM FLUSH DISTRIBUTED infra.metrics_raw")
+        await ch.execute("SYSTEM FLUSH LOGS")
+
+        for table in TABLES:
+            active = await ch.fetchrow(
+                f"SELECT count() AS parts FROM system.parts WHERE database = 'infra' AND table = '{table}' AND active"
+            )
+            try:
+                new = await ch.fetchrow(f"""
+                    SELECT count() AS parts
+                    FROM system.part_log
+                    WHERE database = 'infra' AND table = '{table}' AND event_type = 'NewPart'
+                        AND event_time >= toDateTime('{started_at:%Y-%m-%d %H:%M:%S}')
+                """)
+                new_parts: str = str(new["parts"])
+            except Exception:
+                new_parts = "n/a"
+            print(f"{table:<20} new parts {new_parts:>8}  active parts {active['parts']:>6}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
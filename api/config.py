@@ -1,4 +1,5 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
+from typing import Literal, Optional
 
 import logging
 import sys
@@ -14,17 +15,85 @@ class Settings(BaseSettings):
 
     app_name: str = "InfraAnalyticsAPI"
     debug: bool = False
+    # X-Admin-Token of admin endpoints (cache invalidation), they answer 403 while it is not set
+    admin_token: Optional[str] = None
 
     clickhouse_host: str
     clickhouse_port: int
     clickhouse_db: str
     clickhouse_user: str
     clickhouse_password: str
+    clickhouse_cluster: str = "infra_cluster"
+    clickhouse_insert_format: Literal["json", "rowbinary"] = "json"
+    clickhouse_insert_compression: Literal["none", "gzip"] = "none"
 
     redis_host: str
     redis_port: int
     redis_password: str
 
+    # in-process cache tier in front of redis, entry ttl is capped by local_cache_ttl seconds
+    local_cache_enabled: bool = True
+    local_cache_max_entries: int = 1024
+    local_cache_ttl: float = 5.0
+    # expired key is recomputed once: concurrent misses share one query, workers share redis lease
+    # of cache_lock_ttl seconds, stale result is served up to cache_stale_ttl seconds while it is refreshed
+    cache_single_flight: bool = True
+    cache_stale_ttl: int = 30
+    cache_lock_ttl: int = 10
+    # /metrics series are cached in chunks of range_cache_chunk_buckets buckets, chunk is cached
+    # range_cache_ttl seconds once it ended range_cache_settle seconds ago
+    range_cache_enabled: bool = True
+    range_cache_ttl: int = 3600
+    range_cache_settle: int = 120
+    range_cache_chunk_buckets: int = 10
+    # latest minute per series is kept in redis on ingest for 1m /metrics/latest and /metrics/top,
+    # metric hash is dropped snapshot_ttl seconds after its last sample
+    snapshot_enabled: bool = True
+    snapshot_ttl: int = 86400
+
+    # trend regression by ClickHouse simpleLinearRegression, otherwise bucket averages are fetched
+    trend_server_side: bool = True
+
+    # days every table keeps, TTLs are applied by apply_retention.py when retention_apply is set. With
+    # retention_cold_volume rollup parts older than retention_cold_after days move to that volume
+    retention_apply: bool = True
+    retention_raw_days: int = 2
+    retention_1m_days: int = 14
+    retention_5m_days: int = 60
+    retention_1h_days: int = 365
+    retention_1d_days: int = 1825
+    retention_cold_volume: Optional[str] = None
+    retention_cold_after_days: int = 7
+    # tag sets not seen for longer expire from tag index, rollup rows older than that lose their tags
+    retention_tag_index_days: int = 365
+    # entities silent for longer expire from inventory, cardinality of older ranges is counted in rollups
+    retention_inventory_days: int = 30
+
+    # cardinality and discovery from infra.inventory_dict copy, reloaded every inventory_ttl seconds
+    inventory_enabled: bool = True
+    inventory_ttl: float = 30.0
+
+    ingest_max_body_size: int = 32 * 1024 * 1024
+    # samples out of [now - max_sample_age, now + max_future_skew] are dropped or rejected
+    ingest_max_sample_age: int = 2 * 24 * 3600
+    ingest_max_future_skew: int = 300
+    ingest_late_data_policy: Literal["drop", "reject"] = "drop"
+    ingest_dedup_enabled: bool = True
+    ingest_dedup_ttl: int = 3600
+
+    ingest_buffer_enabled: bool = False
+    ingest_buffer_max_rows: int = 10000
+    ingest_buffer_max_age: float = 1.0
+    ingest_buffer_capacity: int = 100000
+
+    spool_enabled: bool = False
+    spool_path: str = "spool"
+    spool_segment_bytes: int = 64 * 1024 * 1024
+    spool_max_bytes: int = 1024 * 1024 * 1024
+    spool_replay_rows: int = 50000
+    spool_replay_interval: float = 5.0
+    spool_fsync: bool = False
+
     model_config = SettingsConfigDict(
         env_file=".env",
         env_file_encoding="utf-8",
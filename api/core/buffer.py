@@ -0,0 +1,162 @@
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import asyncio
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class BufferFullError(Exception):
+    ...
+
+
+class MetricsBuffer:
+    """ Per worker micro-batching buffer for raw metric rows.
+    Rows from many ingest requests are collected in memory and written with a single insert
+    when max_rows or max_age is reached. Rows of a failed flush are retried as the same batch,
+    so flush_func may derive insert deduplication token from them.
+    """
+
+    def __init__(
+            self,
+            flush_func: Callable[[List[Any]], Awaitable[None]],
+            max_rows: int = 10000,
+            max_age: float = 1.0,
+            capacity: int = 100000,
+    ):
+        self.flush_func = flush_func
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.capacity = capacity
+
+        self._rows: List[Any] = []
+        self._retry: Optional[List[Any]] = None
+        self._first_at: Optional[float] = None
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: bool = False
+
+        self.flushes: int = 0
+        self.flushed_rows: int = 0
+        self.failed_flushes: int = 0
+
+    def __len__(self) -> int:
+        return len(self._rows) + (len(self._retry) if self._retry is not None else 0)
+
+    async def start(self) -> None:
+        """ Start background flush loop
+        :return:
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """ Stop background flush loop and flush everything left in buffer. The loop is not cancelled,
+        a flush in progress runs to completion, so rows it took out of the buffer are not lost
+        :return:
+        """
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def add(self, rows: List[Any]) -> None:
+        """ Add rows to buffer, flush is done by background loop
+        :param rows:
+        :return:
+        """
+        if len(self) + len(rows) > self.capacity:
+            raise BufferFullError(f"Ingest buffer is full ({len(self)}/{self.capacity} rows)")
+
+        if not self._rows:
+            self._first_at = time.monotonic()
+        self._rows.extend(rows)
+
+        if len(self._rows) >= self.max_rows:
+            self._wakeup.set()
+
+    async def flush(self) -> bool:
+        """ Write all buffered rows with one insert. Rows of failed insert are kept for retry
+        :return: False if insert failed
+        """
+        async with self._flush_lock:
+            if self._retry is not None:
+                if not await self._flush_rows(self._retry):
+                    return False
+                self._retry = None
+
+            if not self._rows:
+                return True
+
+            rows, self._rows = self._rows, []
+            self._first_at = None
+
+            if not await self._flush_rows(rows):
+                self._retry = rows
+                return False
+            return True
+
+    async def _flush_rows(self, rows: List[Any]) -> bool:
+        try:
+            await self.flush_func(rows)
+        except Exception as e:
+            self.failed_flushes += 1
+            logger.error(f"Flush {len(rows)} buffered rows failed: {e}")
+            return False
+
+        self.flushes += 1
+        self.flushed_rows += len(rows)
+        logger.debug(f"Flushed {len(rows)} buffered rows")
+        return True
+
+    def stats(self) -> Dict[str, int | float]:
+        """ Get buffer fill stats
+        :return:
+        """
+        size: int = len(self)
+        return {
+            "size": size,
+            "retry_rows": len(self._retry) if self._retry is not None else 0,
+            "max_rows": self.max_rows,
+            "capacity": self.capacity,
+            "fill": size / self.capacity if self.capacity else 0.0,
+            "oldest_age": time.monotonic() - self._first_at if self._first_at else 0.0,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "failed_flushes": self.failed_flushes,
+        }
+
+    def _is_due(self) -> bool:
+        if self._retry is not None:
+            return True
+        if not self._rows:
+            return False
+        if len(self._rows) >= self.max_rows:
+            return True
+        return self._first_at is not None and time.monotonic() - self._first_at >= self.max_age
+
+    async def _wait(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            timeout: float = self.max_age
+            if self._first_at is not None:
+                timeout = max(0.0, self.max_age - (time.monotonic() - self._first_at))
+
+            await self._wait(timeout)
+            if self._stopping:
+                break
+
+            if self._is_due() and not await self.flush():
+                # clickhouse is failing, do not retry in a tight loop, stop() still wakes the loop up
+                await self._wait(self.max_age)
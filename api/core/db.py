@@ -1,16 +1,156 @@
 from abc import ABC, abstractmethod
 from aiochclient import ChClient, Record
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timedelta
+from operator import attrgetter
 from typing import Tuple, Dict, List, Optional, Any
 
+from core.buffer import MetricsBuffer
+from core.dedup import BatchDeduplicator, make_insert_token
+from core.inventory import FleetInventory, InventoryNotLoadedError
+from core.range_cache import RangeCache
 from core.redis import redis_cache
-from src.helpers import calculate_delta, calculate_percents
+from core.rowbinary import RowBinaryWriter
+from core.snapshot import LatestSnapshot
+from core.spool import MetricsSpool
+from src.helpers import calculate_delta, calculate_percents, to_utc
 from src.schemas import (
-    MetricBatch, MetricsQuery, LatestMetricsQuery, MetricsTopQuery, MetricsCardinalityQuery, MetricsCompareQuery,
-    Resolution, CardinalityScope, MetricsTrendQuery, MetricsBottomQuery, MetricsExtremesQuery
+    MetricBatch, BaseColumnarBatch, ColumnarMetricBatch, AggregatedMetricBatch, RawMetricRow, AggregatedMetricRow,
+    MetricsQuery, LatestMetricsQuery, MetricsTopQuery, MetricsCardinalityQuery, MetricsCompareQuery, Resolution,
+    RESOLUTION_SECONDS, AutoResolution, Stat, CardinalityScope, MetricsTrendQuery, MetricsTrendsQuery, MetricsBottomQuery, MetricsExtremesQuery
 )
 
+import asyncio
+import calendar
+import logging
+import math
+
+
+logger = logging.getLogger(__name__)
+
+# levels of q_value t-digest states in rollup tables, ClickHouse arrays are 1-based
+QUANTILE_LEVELS: str = "0.5, 0.95, 0.99"
+QUANTILE_INDEX: Dict[str, int] = {Stat.p50: 1, Stat.p95: 2, Stat.p99: 3}
+
+# shard local tag set lookups, see clickhouse/init.sql
+TAG_INDEX_TABLE: str = "infra.tag_index_local"
+TAG_VALUES_DICT: str = "infra.tag_values"
+
+
+def _stat_sql(stat: Stat) -> Optional[str]:
+    """ select expression of percentile stat, NULL for buckets written before rollups had digests
+    :param stat:
+    :return: None for avg, it is always selected
+    """
+    if stat == Stat.avg:
+        return None
+    return (
+        f"ifNotFinite(quantilesTDigestMerge({QUANTILE_LEVELS})(q_value)[{QUANTILE_INDEX[stat]}], NULL) AS {stat.value}"
+    )
+
+
+def _tag_where(tag: Optional[str]) -> List[str]:
+    """ condition of key=value tag filter, matching tag sets are read from tag index by its primary key,
+    so the filter costs the same for any number of tag sets
+    :param tag:
+    :return:
+    """
+    if not tag:
+        return []
+    key, value = tag.split("=", 1)
+    return [f"tag_set IN (SELECT tag_set FROM {TAG_INDEX_TABLE} WHERE key = '{key}' AND value = '{value}')"]
+
+
+def _tag_column(group_by_tag: Optional[str]) -> Optional[str]:
+    """ select expression of tag value to group by, empty string for tag sets without the key
+    :param group_by_tag:
+    :return:
+    """
+    if not group_by_tag:
+        return None
+    return f"dictGetOrDefault('{TAG_VALUES_DICT}', 'value', (tag_set, '{group_by_tag}'), '') AS tag"
+
+
+def _align(ts: datetime, seconds: int, up: bool = False) -> datetime:
+    """ round naive UTC datetime to epoch aligned multiple of seconds
+    :param ts:
+    :param seconds:
+    :param up: round up, down by default
+    :return:
+    """
+    offset: int = calendar.timegm(ts.timetuple()) % seconds
+    if not offset:
+        return ts
+    return ts + timedelta(seconds=seconds - offset) if up else ts - timedelta(seconds=offset)
+
+
+def _period_where(bucket: str, from_ts: datetime, to_ts: datetime) -> str:
+    """ condition of buckets in [from_ts, to_ts]
+    :param bucket:
+    :param from_ts:
+    :param to_ts:
+    :return:
+    """
+    from_ts, to_ts = to_utc(from_ts), to_utc(to_ts)
+    return (
+        f"{bucket} >= toDateTime('{from_ts:%Y-%m-%d %H:%M:%S}') "
+        f"AND {bucket} <= toDateTime('{to_ts:%Y-%m-%d %H:%M:%S}')"
+    )
+
+
+def _periods_apart(period_a: Tuple[datetime, datetime], period_b: Tuple[datetime, datetime]) -> bool:
+    """ Check compare periods are aggregated with two queries instead of one scan. One scan reads granules
+    between the periods when the primary key can not separate them, up to the whole gap. When the gap is
+    longer than the longer period that is more than both periods together, so far apart periods are read
+    by two concurrent queries. Adjacent, overlapping and close periods share one scan and one round trip
+    :param period_a:
+    :param period_b:
+    :return:
+    """
+    (from_a, to_a), (from_b, to_b) = [(to_utc(from_ts), to_utc(to_ts)) for from_ts, to_ts in (period_a, period_b)]
+    gap: float = (max(from_a, from_b) - min(to_a, to_b)).total_seconds()
+    return gap > max((to_a - from_a).total_seconds(), (to_b - from_b).total_seconds())
+
+
+def _compare_periods_sql(
+        table: str,
+        bucket: str,
+        where: List[str],
+        period_a: Tuple[datetime, datetime],
+        period_b: Tuple[datetime, datetime],
+) -> str:
+    """ one scan of both compare periods, -MergeIf combinators split avg, min, max by period
+    :param table:
+    :param bucket:
+    :param where:
+    :param period_a:
+    :param period_b:
+    :return: row with avg_a, min_a, max_a, avg_b, min_b, max_b
+    """
+    in_period: Dict[str, str] = {
+        name: _period_where(bucket, from_ts, to_ts) for name, (from_ts, to_ts) in (("a", period_a), ("b", period_b))
+    }
+    columns: List[str] = []
+    for name, condition in in_period.items():
+        columns += [
+            f"sumMergeIf(sum_value, {condition}) / countMergeIf(cnt_value, {condition}) AS avg_{name}",
+            f"minMergeIf(min_value, {condition}) AS min_{name}",
+            f"maxMergeIf(max_value, {condition}) AS max_{name}",
+        ]
+
+    return f"""
+        SELECT
+            {", ".join(columns)}
+        FROM {table}
+        WHERE
+            {" AND ".join(where)}
+            AND (({in_period["a"]}) OR ({in_period["b"]}))
+    """
+
+
+class LateSamplesError(ValueError):
+    ...
+
 
 class BaseMetricsRepository:
     def __init__(self, ch: ChClient):
@@ -19,7 +159,15 @@ class BaseMetricsRepository:
 
 class BaseMetricsWriteRepository(ABC, BaseMetricsRepository):
     @abstractmethod
-    async def add_metric(self, data: MetricBatch):
+    async def add_metric(self, data: MetricBatch, batch_id: Optional[str] = None) -> bool:
+        ...
+
+    @abstractmethod
+    async def add_columnar_metric(self, data: ColumnarMetricBatch, batch_id: Optional[str] = None) -> bool:
+        ...
+
+    @abstractmethod
+    async def add_aggregated_metric(self, data: AggregatedMetricBatch, batch_id: Optional[str] = None) -> bool:
         ...
 
 
@@ -56,32 +204,291 @@ class BaseMetricsReadRepository(ABC, BaseMetricsRepository):
     async def get_trend_metrics(self, query: MetricsTrendQuery) -> Dict[str, float]:
         ...
 
+    @abstractmethod
+    async def get_trends_metrics(self, query: MetricsTrendsQuery) -> List[Dict[str, str | float]]:
+        ...
+
 
 class MetricsWriteRepository(BaseMetricsWriteRepository):
-    async def add_metric(self, data: MetricBatch) -> None:
-        """ insert metric batch
+    RAW_TABLE: str = "infra.metrics_raw"
+    AGG_RAW_TABLE: str = "infra.metrics_agg_raw"
+
+    def __init__(
+            self,
+            ch: ChClient,
+            buffer: Optional[MetricsBuffer] = None,
+            binary_writer: Optional[RowBinaryWriter] = None,
+            spool: Optional[MetricsSpool] = None,
+            dedup: Optional[BatchDeduplicator] = None,
+            max_sample_age: Optional[int] = None,
+            max_future_skew: Optional[int] = None,
+            reject_late: bool = False,
+            snapshot: Optional[LatestSnapshot] = None,
+    ):
+        super().__init__(ch)
+        self.buffer = buffer
+        self.binary_writer = binary_writer
+        self.spool = spool
+        self.dedup = dedup
+        self.max_sample_age = max_sample_age
+        self.max_future_skew = max_future_skew
+        self.reject_late = reject_late
+        self.snapshot = snapshot
+
+    async def add_metric(self, data: MetricBatch, batch_id: Optional[str] = None) -> bool:
+        """ insert metric batch, or put it to ingest buffer if buffered mode is enabled
         :param data:
+        :param batch_id: collector assigned batch id
+        :return: False if batch is a duplicate
+        """
+        return await self._store(self._make_rows(data), batch_id=batch_id)
+
+    async def add_columnar_metric(self, data: ColumnarMetricBatch, batch_id: Optional[str] = None) -> bool:
+        """ insert compact columnar batch
+        :param data:
+        :param batch_id: collector assigned batch id, batch_id field of batch is used if not set
+        :return: False if batch is a duplicate
+        """
+        return await self._store(self._make_columnar_rows(data), batch_id=batch_id or data.batch_id)
+
+    async def add_aggregated_metric(self, data: AggregatedMetricBatch, batch_id: Optional[str] = None) -> bool:
+        """ insert pre-aggregated batch, rollups merge it with raw samples.
+        Aggregated rows are few, so they are inserted directly without buffer and spool
+        :param data:
+        :param batch_id: collector assigned batch id, batch_id field of batch is used if not set
+        :return: False if batch is a duplicate
+        """
+        batch_id = batch_id or data.batch_id
+        rows: List[AggregatedMetricRow] = self._filter_window(self._make_aggregated_rows(data))
+        if not rows:
+            return True
+
+        if batch_id and self.dedup is not None and not await self.dedup.claim(batch_id):
+            logger.info(f"Skip duplicate batch {batch_id}")
+            return False
+
+        try:
+            await self.ch.execute(
+                f"INSERT INTO {self.AGG_RAW_TABLE}"
+                f"{self._settings_sql(self._dedup_settings(make_insert_token(rows, batch_id)))} FORMAT JSONEachRow",
+                self._to_json_rows(rows)
+            )
+        except Exception:
+            if batch_id and self.dedup is not None:
+                await self.dedup.release(batch_id)
+            raise
+
+        await self._update_snapshot(rows)
+        return True
+
+    async def write_rows(self, rows: List[RawMetricRow], token: Optional[str] = None) -> None:
+        """ insert raw rows, fall back to spool if insert fails. While spool is not replayed
+        rows go straight to spool, so ClickHouse outage does not turn into retry storm
+        :param rows:
+        :param token: insert deduplication token, derived from rows if not set
+        :return:
+        """
+        token = token or make_insert_token(rows)
+
+        if self.spool is not None and not self.spool.healthy:
+            self.spool.append(rows, token)
+            return
+
+        try:
+            await self.insert_rows(rows, token)
+        except Exception as e:
+            if self.spool is None:
+                raise
+            logger.error(f"Insert {len(rows)} rows failed, write them to spool: {e}")
+            self.spool.mark_unhealthy()
+            self.spool.append(rows, token)
+
+    async def insert_rows(self, rows: List[RawMetricRow], token: Optional[str] = None) -> None:
+        """ insert raw rows with one query, RowBinary if binary writer is configured else JSONEachRow.
+        Rows are ordered by ts so rows of one date partition go together. With token the insert is
+        deduplicated by ClickHouse, rollups written by materialized views too
+        :param rows:
+        :param token: insert deduplication token
+        :return:
+        """
+        rows = sorted(rows, key=attrgetter("ts"))
+        settings: Dict[str, str] = self._dedup_settings(token)
+
+        if self.binary_writer is not None:
+            await self.binary_writer.insert(self.RAW_TABLE, rows, settings=settings)
+            return
+
+        await self.ch.execute(
+            f"INSERT INTO {self.RAW_TABLE}{self._settings_sql(settings)} FORMAT JSONEachRow",
+            self._to_json_rows(rows)
+        )
+
+    @staticmethod
+    def _dedup_settings(token: Optional[str]) -> Dict[str, str]:
+        """ insert settings to deduplicate retried insert in table and its materialized views
+        :param token:
+        :return:
+        """
+        if not token:
+            return {}
+        return {
+            "insert_deduplication_token": token,
+            "deduplicate_blocks_in_dependent_materialized_views": "1",
+        }
+
+    @staticmethod
+    def _settings_sql(settings: Dict[str, str]) -> str:
+        if not settings:
+            return ""
+        return " SETTINGS " + ", ".join(f"{k} = '{v}'" for k, v in settings.items())
+
+    async def _store(self, rows: List[RawMetricRow], batch_id: Optional[str] = None) -> bool:
+        """ put rows to ingest buffer if buffered mode is enabled else insert them
+        :param rows:
+        :param batch_id:
+        :return: False if batch is a duplicate
+        """
+        rows = self._filter_window(rows)
+        if not rows:
+            return True
+
+        if batch_id and self.dedup is not None and not await self.dedup.claim(batch_id):
+            logger.info(f"Skip duplicate batch {batch_id}")
+            return False
+
+        try:
+            if self.buffer is not None:
+                self.buffer.add(rows)
+            else:
+                await self.write_rows(rows, token=make_insert_token(rows, batch_id))
+        except Exception:
+            if batch_id and self.dedup is not None:
+                await self.dedup.release(batch_id)
+            raise
+
+        await self._update_snapshot(rows)
+        return True
+
+    async def _update_snapshot(self, rows: List[RawMetricRow | AggregatedMetricRow]) -> None:
+        """ update latest values snapshot, rows are already stored so failure is only logged
+        :param rows:
         :return:
         """
+        if self.snapshot is None:
+            return
+        try:
+            await self.snapshot.update(rows)
+        except Exception as e:
+            logger.error(f"Update latest snapshot failed: {e}")
+
+    def _filter_window(self, rows: List[Any]) -> List[Any]:
+        """ drop or reject samples older than raw TTL window or too far in the future
+        :param rows:
+        :return:
+        """
+        if self.max_sample_age is None and self.max_future_skew is None:
+            return rows
+
         now: datetime = datetime.utcnow()
+        oldest: datetime = now - timedelta(seconds=self.max_sample_age) if self.max_sample_age is not None \
+            else datetime.min
+        newest: datetime = now + timedelta(seconds=self.max_future_skew) if self.max_future_skew is not None \
+            else datetime.max
+
+        accepted: List[Any] = [row for row in rows if oldest <= row.ts <= newest]
+        skipped: int = len(rows) - len(accepted)
+        if not skipped:
+            return rows
+
+        if self.reject_late:
+            raise LateSamplesError(f"{skipped} samples are out of accepted time window")
+
+        logger.warning(f"Dropped {skipped} samples out of accepted time window")
+        return accepted
 
-        rows: List[Dict[str, Any]] = [
-            {
-                "date": now.date().isoformat(),
-                "ts": now.strftime("%Y-%m-%d %H:%M:%S"),
-                "host": m.host,
-                "vm": m.vm,
-                "metric": m.metric,
-                "value": m.value,
-                "tags": m.tags
-            }
+    @staticmethod
+    def _make_rows(data: MetricBatch) -> List[RawMetricRow]:
+        """ make raw rows from metric batch, samples without ts are stamped with receive time
+        :param data:
+        :return:
+        """
+        now: datetime = datetime.utcnow().replace(microsecond=0)
+        return [
+            RawMetricRow(to_utc(m.ts) if m.ts else now, m.host, m.vm, m.metric, m.value, m.tags)
             for m in data.root
         ]
 
-        await self.ch.execute(
-            "INSERT INTO infra.metrics_raw FORMAT JSONEachRow",
-            rows
-        )
+    @staticmethod
+    def _make_columnar_rows(data: ColumnarMetricBatch) -> List[RawMetricRow]:
+        """ make raw rows from columnar batch
+        :param data:
+        :return:
+        """
+        ts_col, tags_col = MetricsWriteRepository._columnar_ts_and_tags(data)
+        return [
+            RawMetricRow(ts, data.host, data.vm, metric, value, tags)
+            for ts, metric, value, tags in zip(ts_col, data.metrics, data.values, tags_col)
+        ]
+
+    @staticmethod
+    def _make_aggregated_rows(data: AggregatedMetricBatch) -> List[AggregatedMetricRow]:
+        """ make pre-aggregated rows from aggregated batch
+        :param data:
+        :return:
+        """
+        ts_col, tags_col = MetricsWriteRepository._columnar_ts_and_tags(data)
+        return [
+            AggregatedMetricRow(ts, data.host, data.vm, metric, min_v, max_v, sum_v, cnt, tags)
+            for ts, metric, min_v, max_v, sum_v, cnt, tags in zip(
+                ts_col, data.metrics, data.mins, data.maxs, data.sums, data.counts, tags_col
+            )
+        ]
+
+    @staticmethod
+    def _columnar_ts_and_tags(data: BaseColumnarBatch) -> Tuple[List[datetime], List[Dict[str, str]]]:
+        """ expand timestamps and dictionary encoded tags of columnar batch to columns
+        :param data:
+        :return:
+        """
+        size: int = len(data.metrics)
+
+        if data.timestamps is None:
+            ts_col: List[datetime] = [datetime.utcnow().replace(microsecond=0)] * size
+        else:
+            parsed: Dict[int, datetime] = {}
+            ts_col = []
+            for t in data.timestamps:
+                t = int(t)
+                ts: Optional[datetime] = parsed.get(t)
+                if ts is None:
+                    ts = parsed[t] = datetime.utcfromtimestamp(t)
+                ts_col.append(ts)
+
+        if data.tag_ids is None:
+            tags_col: List[Dict[str, str]] = [data.tags] * size
+        else:
+            tag_sets: List[Dict[str, str]] = [{**data.tags, **tags} for tags in data.tag_sets]
+            tags_col = [tag_sets[i] for i in data.tag_ids]
+
+        return ts_col, tags_col
+
+    @staticmethod
+    def _to_json_rows(rows: List[RawMetricRow | AggregatedMetricRow]) -> List[Dict[str, Any]]:
+        """ convert raw or aggregated rows to JSONEachRow dicts
+        :param rows:
+        :return:
+        """
+        formatted: Dict[datetime, Tuple[str, str]] = {}
+        result: List[Dict[str, Any]] = []
+
+        for row in rows:
+            date_ts: Optional[Tuple[str, str]] = formatted.get(row.ts)
+            if date_ts is None:
+                date_ts = formatted[row.ts] = (row.ts.date().isoformat(), row.ts.strftime("%Y-%m-%d %H:%M:%S"))
+
+            result.append({**row._asdict(), "date": date_ts[0], "ts": date_ts[1]})
+
+        return result
 
 
 class MetricsReadRepository(BaseMetricsReadRepository):
@@ -89,7 +496,11 @@ class MetricsReadRepository(BaseMetricsReadRepository):
         Resolution.m1: "infra.metrics_1m",
         Resolution.m5: "infra.metrics_5m",
         Resolution.h1: "infra.metrics_1h",
+        Resolution.d1: "infra.metrics_1d",
     }
+    BUCKET_SECONDS: Dict[str, int] = RESOLUTION_SECONDS
+    # point budget of auto resolution when query has no max_points
+    DEFAULT_MAX_POINTS: int = 1000
     EXTREME_RULES = {
         "cpu_usage": "desc",
         "ram_used_pct": "asc",
@@ -97,22 +508,154 @@ class MetricsReadRepository(BaseMetricsReadRepository):
         "net_io": "desc",
     }
 
-    @redis_cache(key_prefix="metrics", ttl=60)
+    def __init__(
+            self,
+            ch: ChClient,
+            range_cache: Optional[RangeCache] = None,
+            snapshot: Optional[LatestSnapshot] = None,
+            server_side_trend: bool = True,
+            retention_days: Optional[Dict[str, int]] = None,
+            inventory: Optional[FleetInventory] = None
+    ):
+        super().__init__(ch)
+        self.range_cache = range_cache
+        self.snapshot = snapshot
+        self.server_side_trend = server_side_trend
+        self.retention_days = retention_days or {}
+        self.inventory = inventory
+
+    def resolve_resolution(
+            self,
+            resolution: Resolution | AutoResolution,
+            span: float,
+            oldest: datetime,
+            max_points: Optional[int] = None
+    ) -> Resolution:
+        """ Resolution of auto mode: the coarsest table whose buckets still give max_points points over span.
+        Tables which no longer keep oldest timestamp by retention_days are skipped
+        :param resolution:
+        :param span: seconds of the query range
+        :param oldest: start of the query range
+        :param max_points:
+        :return:
+        """
+        if resolution != AutoResolution.auto:
+            return resolution
+
+        age_days: float = (datetime.utcnow() - to_utc(oldest)).total_seconds() / 86400
+        kept: List[Resolution] = [
+            r for r in self.TABLE_BY_RESOLUTION if self.retention_days.get(r, age_days) >= age_days
+        ] or [list(self.TABLE_BY_RESOLUTION)[-1]]
+
+        needed: float = span / (max_points or self.DEFAULT_MAX_POINTS)
+        chosen: Resolution = kept[0]
+        for r in kept:
+            if self.BUCKET_SECONDS[r] <= needed:
+                chosen = r
+        return chosen
+
+    def _step(self, resolution: Resolution, span: float, max_points: Optional[int]) -> Optional[int]:
+        """ bucket of server side re-bucketing, multiple of resolution bucket. Buckets are aligned to epoch,
+        a range of span seconds crosses at most ceil(span / step) of their boundaries
+        :param resolution:
+        :param span: seconds of the query range
+        :param max_points:
+        :return: None if buckets of resolution fit max_points
+        """
+        if not max_points:
+            return None
+        bucket_seconds: int = self.BUCKET_SECONDS[resolution]
+        step: int = math.ceil(span / max(max_points - 1, 1) / bucket_seconds) * bucket_seconds
+        return step if step > bucket_seconds else None
+
+    def _bucket_range(
+            self,
+            resolution: Resolution,
+            from_ts: datetime,
+            to_ts: datetime,
+            max_points: Optional[int]
+    ) -> Tuple[datetime, datetime, Optional[int]]:
+        """ bounds rounded to buckets as in cache keys, so one key always gets one step.
+        from is then aligned down to the step, so the first merged bucket is whole with and without range cache
+        :param resolution:
+        :param from_ts:
+        :param to_ts:
+        :param max_points:
+        :return: from, to, step
+        """
+        bucket_seconds: int = self.BUCKET_SECONDS[resolution]
+        from_ts = _align(to_utc(from_ts), bucket_seconds, up=True)
+        to_ts = _align(to_utc(to_ts), bucket_seconds)
+        step: Optional[int] = self._step(resolution, (to_ts - from_ts).total_seconds(), max_points)
+        if step:
+            from_ts = _align(from_ts, step)
+        return from_ts, to_ts, step
+
     async def get_metrics(self, query: MetricsQuery) -> List[Dict[str, str | float | datetime]]:
-        """ Get metrics
+        """ Get metrics. With range cache finished chunks of the series are read from cache
+        and only the open tail is read from ClickHouse
         :param query:
         :return:
         """
+        span: float = (to_utc(query.to_ts) - to_utc(query.from_ts)).total_seconds()
+        resolution: Resolution = self.resolve_resolution(query.resolution, span, query.from_ts, query.max_points)
+        from_ts, to_ts, step = self._bucket_range(resolution, query.from_ts, query.to_ts, query.max_points)
+
+        query = query.model_copy(update={"resolution": resolution, "from_ts": from_ts, "to_ts": to_ts})
+        if self.range_cache is None:
+            return await self._get_metrics_cached(query=query, step=step)
+
+        _, bucket = self.__get_table_and_bucket(resolution=query.resolution)
+        key: str = f"{query.metric}:{query.scope.value}:{query.host or ''}:{query.vm or ''}:{query.resolution.value}"
+        if query.stat != Stat.avg:
+            key += f":{query.stat.value}"
+        if query.tag or query.group_by_tag:
+            key += f":{query.tag or ''}:{query.group_by_tag or ''}"
+        return await self.range_cache.get(
+            key=f"{key}:{step}" if step else key,
+            from_ts=from_ts,
+            to_ts=to_ts,
+            bucket=bucket,
+            bucket_seconds=step or bucket_seconds,
+            fetch=lambda fetch_from, fetch_to: self._fetch_metrics(query, fetch_from, fetch_to, step)
+        )
+
+    @redis_cache(key_prefix="metrics", ttl=60)
+    async def _get_metrics_cached(
+            self,
+            query: MetricsQuery,
+            step: Optional[int] = None
+    ) -> List[Dict[str, str | float | datetime]]:
+        return await self._fetch_metrics(query, query.from_ts, query.to_ts, step)
+
+    async def _fetch_metrics(
+            self,
+            query: MetricsQuery,
+            from_ts: datetime,
+            to_ts: datetime,
+            step: Optional[int] = None
+    ) -> List[Dict[str, str | float | datetime]]:
+        """ read series of [from_ts, to_ts]
+        :param query:
+        :param from_ts:
+        :param to_ts:
+        :param step: merge buckets of the table to epoch aligned buckets of step seconds
+        :return:
+        """
         table, bucket = self.__get_table_and_bucket(resolution=query.resolution)
 
         where: List[str] = [
             f"metric = '{query.metric}'",
-            f"{bucket} >= toDateTime('{query.from_ts:%Y-%m-%d %H:%M:%S}')",
-            f"{bucket} <= toDateTime('{query.to_ts:%Y-%m-%d %H:%M:%S}')",
+            f"{bucket} >= toDateTime('{from_ts:%Y-%m-%d %H:%M:%S}')",
+            f"{bucket} <= toDateTime('{to_ts:%Y-%m-%d %H:%M:%S}')",
         ]
 
-        select_dims: List[str] = [bucket]
-        group_by: List[str] = [bucket]
+        # merged bucket can not be aliased to the bucket column, WHERE would filter on the alias
+        bucket_column: str = "step_bucket" if step else bucket
+        select_dims: List[str] = [
+            f"toStartOfInterval({bucket}, INTERVAL {step} SECOND) AS {bucket_column}" if step else bucket
+        ]
+        group_by: List[str] = [bucket_column]
 
         if query.scope == "vm":
             where += [
@@ -127,27 +670,46 @@ class MetricsReadRepository(BaseMetricsReadRepository):
             select_dims.append("host")
             group_by.append("host")
 
+        where += _tag_where(query.tag)
+        tag: Optional[str] = _tag_column(query.group_by_tag)
+        if tag:
+            select_dims.append(tag)
+            group_by.append("tag")
+
+        stat: Optional[str] = _stat_sql(query.stat)
         sql: str = f"""
                 SELECT
                     {", ".join(select_dims)},
                     sumMerge(sum_value) / countMerge(cnt_value) AS avg,
                     minMerge(min_value) AS min,
+                    {f"{stat}," if stat else ""}
                     maxMerge(max_value) AS max
                 FROM {table}
                 WHERE {" AND ".join(where)}
                 GROUP BY {", ".join(group_by)}
-                ORDER BY {bucket}
+                ORDER BY {bucket_column}
         """
 
         result = await self.ch.fetch(sql)
-        return list(dict(row) for row in result)
+        rows: List[Dict[str, str | float | datetime]] = list(dict(row) for row in result)
+        if step:
+            for row in rows:
+                row[bucket] = row.pop(bucket_column)
+        return rows
 
-    @redis_cache(key_prefix="latest", ttl=60)
     async def get_latest_metrics(self, query: LatestMetricsQuery) -> Optional[Dict[str, str | float]]:
-        """ Get latest metrics
+        """ Get latest metrics, 1m resolution is read from latest values snapshot if it is enabled
         :param query:
         :return:
         """
+        if self.snapshot is not None and query.resolution == Resolution.m1 and not query.tag:
+            latest: Optional[Dict[str, str | float]] = await self.snapshot.get_latest(query)
+            if latest is not None:
+                return latest
+        return await self._get_latest_metrics_cached(query=query)
+
+    @redis_cache(key_prefix="latest", ttl=60)
+    async def _get_latest_metrics_cached(self, query: LatestMetricsQuery) -> Optional[Dict[str, str | float]]:
         table, bucket = self.__get_table_and_bucket(resolution=query.resolution)
 
         where: List[str] = [f"metric = '{query.metric}'"]
@@ -168,6 +730,8 @@ class MetricsReadRepository(BaseMetricsReadRepository):
             select_dims.append("host")
             group_by.append("host")
 
+        where += _tag_where(query.tag)
+
         subquery: str = f"""
             SELECT max({bucket})
             FROM {table}
@@ -191,12 +755,23 @@ class MetricsReadRepository(BaseMetricsReadRepository):
         rows: List[Record] = await self.ch.fetch(sql)
         return dict(rows[0]) if rows else None
 
-    @redis_cache(key_prefix="top", ttl=60)
     async def get_top_metrics(self, query: MetricsTopQuery) -> List[Dict[str, str | float]]:
-        """ get top metrics by host or vm
+        """ get top metrics by host or vm, 1m resolution ranked by avg is read from latest values snapshot
+        if it is enabled
         :param query:
         :return:
         """
+        if (
+                self.snapshot is not None and query.resolution == Resolution.m1 and query.scope != "global"
+                and query.stat == Stat.avg and not query.tag and not query.group_by_tag
+        ):
+            top: Optional[List[Dict[str, str | float]]] = await self.snapshot.get_top(query)
+            if top is not None:
+                return top
+        return await self._get_top_metrics_cached(query=query)
+
+    @redis_cache(key_prefix="top", ttl=60)
+    async def _get_top_metrics_cached(self, query: MetricsTopQuery) -> List[Dict[str, str | float]]:
         table, bucket = self.__get_table_and_bucket(resolution=query.resolution)
 
         where = [f"metric = '{query.metric}'"]
@@ -214,17 +789,25 @@ class MetricsReadRepository(BaseMetricsReadRepository):
         else:
             raise ValueError("scope must be vm or host")
 
+        where += _tag_where(query.tag)
+        tag: Optional[str] = _tag_column(query.group_by_tag)
+        if tag:
+            select_dims.append(tag)
+            group_by.append("tag")
+
         last_bucket_sql = f"""
                 SELECT max({bucket})
                 FROM {table}
                 WHERE {" AND ".join(where)}
             """
 
+        stat: Optional[str] = _stat_sql(query.stat)
         sql = f"""
             SELECT
                 {", ".join(select_dims)},
                 sumMerge(sum_value) / countMerge(cnt_value) AS avg,
                 minMerge(min_value) AS min,
+                {f"{stat}," if stat else ""}
                 maxMerge(max_value) AS max
             FROM {table}
             WHERE
@@ -232,7 +815,7 @@ class MetricsReadRepository(BaseMetricsReadRepository):
                 AND {bucket} = ({last_bucket_sql})
             GROUP BY
                 {", ".join(group_by)}
-            ORDER BY avg DESC
+            ORDER BY {query.stat.value} DESC
             LIMIT {query.limit}
             """
 
@@ -260,13 +843,17 @@ class MetricsReadRepository(BaseMetricsReadRepository):
         else:
             raise ValueError("scope must be vm or host")
 
+        where += _tag_where(query.tag)
+        tag: Optional[str] = _tag_column(query.group_by_tag)
+
         sql: str = f"""
             SELECT
                 {entity} AS name,
+                {f"{tag}," if tag else ""}
                 avgMerge(avg_value) AS value
             FROM {table}
             WHERE {" AND ".join(where)}
-            GROUP BY name
+            GROUP BY name{", tag" if tag else ""}
             ORDER BY value ASC
             LIMIT {query.limit}
         """
@@ -276,39 +863,66 @@ class MetricsReadRepository(BaseMetricsReadRepository):
 
     @redis_cache(key_prefix="extreme", ttl=60)
     async def get_extreme_metrics(self, query: MetricsExtremesQuery) -> Dict[str, List[Dict[str, str | float]]]:
-        """ get extreme metrics
+        """ get extreme metrics, every metric is ordered by EXTREME_RULES and limited by ClickHouse,
+        with group_by_tag limit is applied to every tag value of metric
         :param query:
         :return:
         """
         table, bucket = self.__get_table_and_bucket(query.resolution)
 
+        asc_metrics: List[str] = [f"'{m}'" for m, order in self.EXTREME_RULES.items() if order == "asc"]
+        sort_key: str = f"if(metric IN ({', '.join(asc_metrics)}), value, -value)" if asc_metrics else "-value"
+        tag: Optional[str] = _tag_column(query.group_by_tag)
+
         sql: str = f"""
                 SELECT
                     vm,
                     metric,
+                    {f"{tag}," if tag else ""}
                     avgMerge(avg_value) AS value
                 FROM {table}
                 WHERE
                     metric IN {tuple(self.EXTREME_RULES.keys())}
                     AND {bucket} >= toDateTime('{query.from_ts:%Y-%m-%d %H:%M:%S}')
                     AND {bucket} <= toDateTime('{query.to_ts:%Y-%m-%d %H:%M:%S}')
+                    {"".join(f"AND {condition}" for condition in _tag_where(query.tag))}
                 GROUP BY
                     vm,
-                    metric
+                    metric{", tag" if tag else ""}
+                ORDER BY
+                    metric,{" tag," if tag else ""}
+                    {sort_key}
+                LIMIT {query.limit} BY metric{", tag" if tag else ""}
             """
 
         rows: List[Record] = await self.ch.fetch(sql)
         if not rows:
             return {}
 
-        return self._sort_extremes(rows, query.limit)
+        return self._sort_extremes(rows, query.limit, tagged=tag is not None)
 
-    @redis_cache(key_prefix="cardinality", ttl=60)
     async def get_cardinality_metrics(self, query: MetricsCardinalityQuery) -> Dict[str, int]:
-        """ get cardinality metrics
+        """ get cardinality metrics, from fleet inventory if it is set, there is no tag filter and
+        the range is within inventory retention. Until inventory copy is loaded the query goes to ClickHouse
         :param query:
         :return:
         """
+        if self.inventory is not None and query.tag is None and self.inventory.covers(query.from_ts):
+            try:
+                count: int = await self.inventory.cardinality(
+                    query.scope.value,
+                    from_ts=query.from_ts,
+                    to_ts=query.to_ts,
+                    bucket_seconds=self.BUCKET_SECONDS[query.resolution]
+                )
+                return {"count": count}
+            except InventoryNotLoadedError as e:
+                logger.warning(f"{e}, count cardinality in ClickHouse")
+
+        return await self._get_cardinality_metrics_cached(query=query)
+
+    @redis_cache(key_prefix="cardinality", ttl=60)
+    async def _get_cardinality_metrics_cached(self, query: MetricsCardinalityQuery) -> Dict[str, int]:
         table, bucket = self.__get_table_and_bucket(resolution=query.resolution)
 
         if query.scope == CardinalityScope.vm:
@@ -331,6 +945,7 @@ class MetricsReadRepository(BaseMetricsReadRepository):
             where.append(
                 f"{bucket} = (SELECT max({bucket}) FROM {table})"
             )
+        where += _tag_where(query.tag)
 
         sql: str = f"""
             SELECT
@@ -342,12 +957,22 @@ class MetricsReadRepository(BaseMetricsReadRepository):
         rows: List[Record] = await self.ch.fetch(sql)
         return dict(rows[0]) if rows else {"count": 0}
 
-    @redis_cache(key_prefix="compare", ttl=60)
     async def get_compare_metrics(self, query: MetricsCompareQuery) -> Dict[str, Any]:
         """ get compare metrics by before period and after period
         :param query:
         :return:
         """
+        span: float = max(
+            (to_utc(query.to_a) - to_utc(query.from_a)).total_seconds(),
+            (to_utc(query.to_b) - to_utc(query.from_b)).total_seconds()
+        )
+        resolution: Resolution = self.resolve_resolution(
+            query.resolution, span, min(to_utc(query.from_a), to_utc(query.from_b)), query.max_points
+        )
+        return await self._get_compare_metrics_cached(query=query.model_copy(update={"resolution": resolution}))
+
+    @redis_cache(key_prefix="compare", ttl=60)
+    async def _get_compare_metrics_cached(self, query: MetricsCompareQuery) -> Dict[str, Any]:
         table, bucket = self.__get_table_and_bucket(resolution=query.resolution)
 
         where: List[str] = [f"metric = '{query.metric}'"]
@@ -360,27 +985,22 @@ class MetricsReadRepository(BaseMetricsReadRepository):
         elif query.scope == "host":
             where.append(f"host = '{query.host}'")
 
-        after: Optional[Record] = await self._aggregate_period(
-            table=table,
-            bucket=bucket,
-            where=where,
-            from_ts=query.from_a,
-            to_ts=query.to_a
-        )
-        before: Optional[Record] = await self._aggregate_period(
+        where += _tag_where(query.tag)
+
+        after, before = await self._aggregate_periods(
             table=table,
             bucket=bucket,
             where=where,
-            from_ts=query.from_b,
-            to_ts=query.to_b
+            period_a=(query.from_a, query.to_a),
+            period_b=(query.from_b, query.to_b)
         )
 
         if not after or not before:
             return {"status": "no_data"}
 
         return {
-            "before": dict(after),
-            "after": dict(before),
+            "before": after,
+            "after": before,
             "delta": {
                 "avg": calculate_delta(after["avg"], before["avg"]),
                 "min": calculate_delta(after["min"], before["min"]),
@@ -393,12 +1013,26 @@ class MetricsReadRepository(BaseMetricsReadRepository):
             },
         }
 
-    @redis_cache(key_prefix="trend", ttl=60)
     async def get_trend_metrics(self, query: MetricsTrendQuery) -> Optional[Dict[str, float]]:
-        """
+        """ Get slope and intercept of metric, computed by ClickHouse simpleLinearRegression
+        or locally if server side trend is disabled
         :param query:
         :return:
         """
+        span: float = (to_utc(query.to_ts) - to_utc(query.from_ts)).total_seconds()
+        resolution: Resolution = self.resolve_resolution(query.resolution, span, query.from_ts, query.max_points)
+        from_ts, to_ts, step = self._bucket_range(resolution, query.from_ts, query.to_ts, query.max_points)
+        return await self._get_trend_metrics_cached(
+            query=query.model_copy(update={"resolution": resolution, "from_ts": from_ts, "to_ts": to_ts}),
+            step=step
+        )
+
+    @redis_cache(key_prefix="trend", ttl=60)
+    async def _get_trend_metrics_cached(
+            self,
+            query: MetricsTrendQuery,
+            step: Optional[int] = None
+    ) -> Optional[Dict[str, float]]:
         table, bucket = self.__get_table_and_bucket(resolution=query.resolution)
 
         where: List[str] = [f"metric = '{query.metric}'"]
@@ -411,15 +1045,136 @@ class MetricsReadRepository(BaseMetricsReadRepository):
         elif query.scope == "host":
             where.append(f"host = '{query.host}'")
 
+        where += _tag_where(query.tag)
+
+        if not self.server_side_trend:
+            return await self._local_trend(table, bucket, where, query.from_ts, query.to_ts, step)
+
+        rows: List[Record] = await self.ch.fetch(
+            self._trend_sql(table, bucket, where, [], query.from_ts, query.to_ts, step)
+        )
+        if not rows or not rows[0]["points"]:
+            return None
+
+        return self._trend_result(rows[0])
+
+    @redis_cache(key_prefix="trends", ttl=60)
+    async def get_trends_metrics(self, query: MetricsTrendsQuery) -> List[Dict[str, str | float]]:
+        """ Get trends of every vm of host or of every host with one query
+        :param query:
+        :return:
+        """
+        table, bucket = self.__get_table_and_bucket(resolution=query.resolution)
+
+        where: List[str] = [f"metric = '{query.metric}'"]
+        dims: List[str] = ["host"]
+        if query.scope == "host":
+            where.append(f"host = '{query.host}'")
+            dims.append("vm")
+
+        where += _tag_where(query.tag)
+        tag: Optional[str] = _tag_column(query.group_by_tag)
+        if tag:
+            dims.append("tag")
+
+        rows: List[Record] = await self.ch.fetch(
+            self._trend_sql(table, bucket, where, dims, query.from_ts, query.to_ts, tag_column=tag)
+        )
+        return [
+            {**{dim: row[dim] for dim in dims}, **self._trend_result(row)}
+            for row in rows
+        ]
+
+    @staticmethod
+    def _trend_sql(
+            table: str,
+            bucket: str,
+            where: List[str],
+            dims: List[str],
+            from_ts: datetime,
+            to_ts: datetime,
+            step: Optional[int] = None,
+            tag_column: Optional[str] = None
+    ) -> str:
+        """ regression of bucket averages per dims. Time is counted from from_ts, so sums of squares
+        stay small, intercept is moved back to unix epoch
+        :param table:
+        :param bucket:
+        :param where:
+        :param dims:
+        :param from_ts:
+        :param to_ts:
+        :param step: merge buckets to epoch aligned buckets of step seconds
+        :param tag_column: select expression of tag dim
+        :return:
+        """
+        select_dims: str = "".join(f"{dim}, " for dim in dims)
+        inner_dims: str = "".join(f"{tag_column if dim == 'tag' else dim}, " for dim in dims)
+        group_by: str = f"GROUP BY {', '.join(dims)}" if dims else ""
+        ts: str = f"toStartOfInterval({bucket}, INTERVAL {step} SECOND)" if step else bucket
+
+        return f"""
+            WITH toInt64(toUInt32(toDateTime('{from_ts:%Y-%m-%d %H:%M:%S}'))) AS x0
+            SELECT
+                {select_dims}
+                count() AS points,
+                simpleLinearRegression(toFloat64(toInt64(toUInt32(ts)) - x0), avg_value) AS coef,
+                coef.1 AS slope,
+                coef.2 - coef.1 * x0 AS intercept,
+                any(avg_value) AS any_value
+            FROM (
+                SELECT
+                    {inner_dims}
+                    {ts} AS ts,
+                    avgMerge(avg_value) AS avg_value
+                FROM {table}
+                WHERE
+                    {" AND ".join(where)}
+                    AND {bucket} >= toDateTime('{from_ts:%Y-%m-%d %H:%M:%S}')
+                    AND {bucket} <= toDateTime('{to_ts:%Y-%m-%d %H:%M:%S}')
+                GROUP BY {select_dims}ts
+            )
+            {group_by}
+        """
+
+    @staticmethod
+    def _trend_result(row: Record) -> Dict[str, float]:
+        """ regression of a single point is undefined, it is flat line through the point
+        :param row:
+        :return:
+        """
+        if row["points"] == 1:
+            return {"slope": 0.0, "intercept": row["any_value"]}
+        return {"slope": row["slope"], "intercept": row["intercept"]}
+
+    async def _local_trend(
+            self,
+            table: str,
+            bucket: str,
+            where: List[str],
+            from_ts: datetime,
+            to_ts: datetime,
+            step: Optional[int] = None
+    ) -> Optional[Dict[str, float]]:
+        """ fetch bucket averages and compute regression in worker
+        :param table:
+        :param bucket:
+        :param where:
+        :param from_ts:
+        :param to_ts:
+        :param step: merge buckets to epoch aligned buckets of step seconds
+        :return:
+        """
+        ts: str = f"toStartOfInterval({bucket}, INTERVAL {step} SECOND)" if step else bucket
         sql = f"""
             SELECT
-                {bucket} AS ts,
+                toUInt32({ts}) AS ts,
                 avgMerge(avg_value) AS avg_value
             FROM {table}
             WHERE
                 {" AND ".join(where)}
-                AND {bucket} >= toDateTime('{query.from_ts:%Y-%m-%d %H:%M:%S}')
-                AND {bucket} <= toDateTime('{query.to_ts:%Y-%m-%d %H:%M:%S}')
+                AND {bucket} >= toDateTime('{from_ts:%Y-%m-%d %H:%M:%S}')
+                AND {bucket} <= toDateTime('{to_ts:%Y-%m-%d %H:%M:%S}')
             GROUP BY ts
             ORDER BY ts
         """
@@ -428,13 +1183,44 @@ class MetricsReadRepository(BaseMetricsReadRepository):
         if not rows:
             return None
 
-        ts_list = [r["ts"].timestamp() for r in rows]
+        ts_list = [float(r["ts"]) for r in rows]
         avg_list = [r["avg_value"] for r in rows]
 
         slope, intercept = self.__linear_regression(ts_list, avg_list)
 
         return {"slope": slope, "intercept": intercept}
 
+    async def _aggregate_periods(
+            self,
+            table: str,
+            bucket: str,
+            where: List[str],
+            period_a: Tuple[datetime, datetime],
+            period_b: Tuple[datetime, datetime],
+    ) -> Tuple[Optional[Dict[str, float]], Optional[Dict[str, float]]]:
+        """ aggregate two periods with one scan using -If combinators, periods far from each other
+        (see _periods_apart) are aggregated with two concurrent queries
+        :param table:
+        :param bucket:
+        :param where:
+        :param period_a:
+        :param period_b:
+        :return: avg, min, max of period a and period b
+        """
+        if _periods_apart(period_a, period_b):
+            a, b = await asyncio.gather(*(
+                self._aggregate_period(table=table, bucket=bucket, where=where, from_ts=from_ts, to_ts=to_ts)
+                for from_ts, to_ts in (period_a, period_b)
+            ))
+            return (dict(a) if a else None), (dict(b) if b else None)
+
+        rows: List[Record] = await self.ch.fetch(_compare_periods_sql(table, bucket, where, period_a, period_b))
+        if not rows:
+            return None, None
+
+        a, b = ({stat: rows[0][f"{stat}_{name}"] for stat in ("avg", "min", "max")} for name in ("a", "b"))
+        return a, b
+
     async def _aggregate_period(
             self,
             table: str,
@@ -451,8 +1237,7 @@ class MetricsReadRepository(BaseMetricsReadRepository):
             FROM {table}
             WHERE
                 {" AND ".join(where)}
-                AND {bucket} >= toDateTime('{from_ts:%Y-%m-%d %H:%M:%S}')
-                AND {bucket} <= toDateTime('{to_ts:%Y-%m-%d %H:%M:%S}')
+                AND {_period_where(bucket, from_ts, to_ts)}
         """
         rows: List[Record] = await self.ch.fetch(sql)
         return rows[0] if rows else None
@@ -461,19 +1246,23 @@ class MetricsReadRepository(BaseMetricsReadRepository):
             self,
             rows: List[Record],
             limit: int,
+            tagged: bool = False,
     ) -> Dict[str, List[Dict[str, float]]]:
-        """ sort results for extremes metrics by EXTREME_RULES
+        """ group results for extremes metrics by metric, rows are already limited by ClickHouse
+        and sorting them again by EXTREME_RULES costs only limit rows per metric
         :param rows:
         :param limit:
+        :param tagged: rows are grouped by tag too, every tag value keeps limit rows ordered by tag
         :return:
         """
         grouped: dict[str, list[dict]] = defaultdict(list)
 
         for row in rows:
-            grouped[row["metric"]].append({
-                "vm": row["vm"],
-                "value": float(row["value"]),
-            })
+            item: Dict[str, str | float] = {"vm": row["vm"]}
+            if tagged:
+                item["tag"] = row["tag"]
+            item["value"] = float(row["value"])
+            grouped[row["metric"]].append(item)
 
         result: dict[str, list[dict]] = {}
 
@@ -487,7 +1276,15 @@ class MetricsReadRepository(BaseMetricsReadRepository):
                 reverse=reverse,
             )
 
-            result[metric] = sorted_items[:limit]
+            if not tagged:
+                result[metric] = sorted_items[:limit]
+                continue
+
+            by_tag: dict[str, list[dict]] = defaultdict(list)
+            for item in sorted_items:
+                if len(by_tag[item["tag"]]) < limit:
+                    by_tag[item["tag"]].append(item)
+            result[metric] = [item for tag in sorted(by_tag) for item in by_tag[tag]]
 
         return result
 
@@ -502,7 +1299,8 @@ class MetricsReadRepository(BaseMetricsReadRepository):
 
     @staticmethod
     def __linear_regression(ts_list: list[float], avg_list: list[float]) -> tuple[float, float]:
-        """ get slope and intercept for trend metrics
+        """ get slope and intercept for trend metrics, used only when server side trend is disabled.
+        Time is centered before regression, sums of squared unix timestamps lose precision
         :param ts_list:
         :param avg_list:
         :return:
@@ -513,11 +1311,11 @@ class MetricsReadRepository(BaseMetricsReadRepository):
         if ts_len == 1:
             return 0.0, avg_list[0]
 
-        sum_ts_list = sum(ts_list)
-        sum_avg_list = sum(avg_list)
-        sum_xx = sum(v * v for v in ts_list)
-        sum_xy = sum(v * u for v, u in zip(ts_list, avg_list))
+        x_mean = sum(ts_list) / ts_len
+        y_mean = sum(avg_list) / ts_len
+        sum_xx = sum((v - x_mean) ** 2 for v in ts_list)
+        sum_xy = sum((v - x_mean) * (u - y_mean) for v, u in zip(ts_list, avg_list))
 
-        slope = (ts_len * sum_xy - sum_ts_list * sum_avg_list) / (ts_len * sum_xx - sum_ts_list * sum_ts_list)
-        intercept = (sum_avg_list - slope * sum_ts_list) / ts_len
+        slope = sum_xy / sum_xx if sum_xx else 0.0
+        intercept = y_mean - slope * x_mean
         return slope, intercept
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+from typing import Any, List, Optional
+
+from core.redis import delete_cache, set_cache_nx
+from core.rowbinary import encode_rows
+from src.schemas import RawMetricRow
+
+import hashlib
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def make_insert_token(rows: List[Any], batch_id: Optional[str] = None) -> str:
+    """ insert_deduplication_token for ClickHouse: hash of batch id if collector sent one, else hash of content.
+    Same rows in the same order always give the same token, so retried inserts are deduplicated
+    :param rows: raw or aggregated rows
+    :param batch_id:
+    :return:
+    """
+    if batch_id:
+        data: bytes = batch_id.encode()
+    elif rows and isinstance(rows[0], RawMetricRow):
+        data = encode_rows(rows)
+    else:
+        data = repr(rows).encode()
+
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class BatchDeduplicator:
+    """ Recently seen batch ids. Ids are claimed in redis with SET NX, so all workers share them,
+    small local cache answers repeated retries to the same worker without redis round trip
+    """
+    KEY_PREFIX: str = "batch"
+
+    def __init__(self, ttl: int = 3600, local_size: int = 10000):
+        self.ttl = ttl
+        self.local_size = local_size
+        self._local: OrderedDict[str, float] = OrderedDict()
+
+        self.duplicates: int = 0
+
+    async def claim(self, batch_id: str) -> bool:
+        """ Claim batch id
+        :param batch_id:
+        :return: False if batch was already seen
+        """
+        expires_at: Optional[float] = self._local.get(batch_id)
+        if expires_at is not None and expires_at > time.monotonic():
+            self.duplicates += 1
+            return False
+
+        claimed: Optional[bool] = await set_cache_nx(f"{self.KEY_PREFIX}:{batch_id}", ttl=self.ttl)
+        self._remember(batch_id)
+
+        if claimed is False:
+            self.duplicates += 1
+            return False
+        return True
+
+    async def release(self, batch_id: str) -> None:
+        """ Forget batch id, batch was not stored and may be retried
+        :param batch_id:
+        :return:
+        """
+        self._local.pop(batch_id, None)
+        await delete_cache(f"{self.KEY_PREFIX}:{batch_id}")
+
+    def _remember(self, batch_id: str) -> None:
+        self._local[batch_id] = time.monotonic() + self.ttl
+        self._local.move_to_end(batch_id)
+        while len(self._local) > self.local_size:
+            self._local.popitem(last=False)
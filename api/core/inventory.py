@@ -0,0 +1,190 @@
+from aiochclient import ChClient
+from datetime import datetime, timedelta
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from src.helpers import to_utc
+
+import asyncio
+import calendar
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class InventoryNotLoadedError(Exception):
+    ...
+
+
+class InventoryEntry(NamedTuple):
+    host: str
+    vm: str
+    metric: str
+    first_seen: datetime
+    last_seen: datetime
+
+
+# entity columns of inventory scope
+SCOPE_KEYS: Dict[str, Tuple[str, ...]] = {
+    "host": ("host",),
+    "vm": ("host", "vm"),
+    "metric": ("metric",),
+}
+
+
+class FleetInventory:
+    """ In-process copy of infra.inventory_dict: first and last sample time of every (host, vm, metric).
+    Entries are reloaded every ttl seconds, a stale copy is served while it is reloaded in background,
+    so cardinality and discovery are answered without ClickHouse query.
+
+    Entity counted for a range is seen between first_seen and last_seen, gaps inside are not known.
+    Samples are in the dictionary up to its lifetime plus ttl seconds after insert. Entities silent for
+    longer than retention_days expire from inventory_local, so older ranges are not covered.
+    """
+    DICTIONARY: str = "infra.inventory_dict"
+
+    def __init__(self, ch: ChClient, ttl: float = 30.0, retention_days: Optional[int] = None):
+        self.ch = ch
+        self.ttl = ttl
+        self.retention_days = retention_days
+
+        self._entries: Optional[List[InventoryEntry]] = None
+        self._loaded_at: float = 0.0
+        self._load_task: Optional[asyncio.Task] = None
+
+        self.loads: int = 0
+
+    def covers(self, from_ts: Optional[datetime]) -> bool:
+        """ Check inventory still keeps entities which were silent since from_ts
+        :param from_ts:
+        :return:
+        """
+        if from_ts is None or self.retention_days is None:
+            return True
+        return to_utc(from_ts) >= datetime.utcnow() - timedelta(days=self.retention_days)
+
+    async def entries(self) -> List[InventoryEntry]:
+        """ Get inventory entries, calls wait for the first load. InventoryNotLoadedError is raised
+        while no copy is loaded, an empty copy is never served in place of a failed load
+        :return:
+        """
+        reload_due: bool = self._entries is None or time.monotonic() - self._loaded_at > self.ttl
+        if reload_due and (self._load_task is None or self._load_task.done()):
+            self._load_task = asyncio.create_task(self._reload())
+
+        if self._entries is None:
+            # concurrent first calls share one load
+            await asyncio.shield(self._load_task)
+            if self._entries is None:
+                raise InventoryNotLoadedError("Fleet inventory is not loaded")
+        return self._entries
+
+    async def cardinality(
+            self,
+            scope: str,
+            from_ts: Optional[datetime] = None,
+            to_ts: Optional[datetime] = None,
+            bucket_seconds: int = 60
+    ) -> int:
+        """ Count hosts, vms or metrics seen in [from_ts, to_ts], without range seen in the latest bucket
+        :param scope: host, vm or metric
+        :param from_ts:
+        :param to_ts:
+        :param bucket_seconds: bucket of the latest bucket
+        :return:
+        """
+        entries: List[InventoryEntry] = await self.entries()
+        if not entries:
+            return 0
+
+        if from_ts and to_ts:
+            from_ts, to_ts = to_utc(from_ts), to_utc(to_ts)
+            seen: List[InventoryEntry] = [e for e in entries if e.first_seen <= to_ts and e.last_seen >= from_ts]
+        else:
+            latest: int = max(calendar.timegm(e.last_seen.timetuple()) for e in entries)
+            bucket_start: datetime = datetime.utcfromtimestamp(latest // bucket_seconds * bucket_seconds)
+            seen = [e for e in entries if e.last_seen >= bucket_start]
+
+        keys: Tuple[str, ...] = SCOPE_KEYS[scope]
+        return len({tuple(getattr(e, k) for k in keys) for e in seen})
+
+    async def list(
+            self,
+            scope: str,
+            host: Optional[str] = None,
+            vm: Optional[str] = None,
+            metric: Optional[str] = None
+    ) -> List[Dict[str, str | datetime]]:
+        """ Hosts, vms or metrics with their first and last sample time
+        :param scope: host, vm or metric
+        :param host:
+        :param vm:
+        :param metric:
+        :return: ordered by entity
+        """
+        keys: Tuple[str, ...] = SCOPE_KEYS[scope]
+        found: Dict[Tuple[str, ...], List[datetime]] = {}
+        for e in await self.entries():
+            if (host and e.host != host) or (vm and e.vm != vm) or (metric and e.metric != metric):
+                continue
+            key: Tuple[str, ...] = tuple(getattr(e, k) for k in keys)
+            seen: Optional[List[datetime]] = found.get(key)
+            if seen is None:
+                found[key] = [e.first_seen, e.last_seen]
+            else:
+                seen[0] = min(seen[0], e.first_seen)
+                seen[1] = max(seen[1], e.last_seen)
+
+        return [
+            {**dict(zip(keys, key)), "first_seen": seen[0], "last_seen": seen[1]}
+            for key, seen in sorted(found.items())
+        ]
+
+    async def silent(self, scope: str, seconds: int, host: Optional[str] = None) -> List[Dict[str, str | datetime]]:
+        """ Hosts, vms or metrics without samples for more than seconds
+        :param scope: host, vm or metric
+        :param seconds:
+        :param host:
+        :return: ordered by last sample time, the longest silent first
+        """
+        silent_since: datetime = datetime.utcnow() - timedelta(seconds=seconds)
+        rows: List[Dict[str, str | datetime]] = [
+            row for row in await self.list(scope, host=host) if row["last_seen"] < silent_since
+        ]
+        rows.sort(key=lambda row: row["last_seen"])
+        return rows
+
+    def stats(self) -> Dict[str, float]:
+        """ Get size and age of the inventory copy
+        :return:
+        """
+        return {
+            "entries": len(self._entries or []),
+            "age": time.monotonic() - self._loaded_at if self._entries is not None else 0.0,
+            "loads": self.loads,
+        }
+
+    async def _reload(self) -> None:
+        """ read the whole dictionary, a failed reload keeps the previous copy
+        :return:
+        """
+        try:
+            # unix timestamps, so entries are naive UTC whatever the server timezone is
+            rows = await self.ch.fetch(f"""
+                SELECT host, vm, metric, toUnixTimestamp(first_seen) AS first_seen, toUnixTimestamp(last_seen) AS last_seen
+                FROM {self.DICTIONARY}
+            """)
+        except Exception as e:
+            logger.error(f"Inventory reload failed: {e}")
+            return
+
+        self._entries = [
+            InventoryEntry(
+                row["host"], row["vm"], row["metric"],
+                datetime.utcfromtimestamp(row["first_seen"]), datetime.utcfromtimestamp(row["last_seen"])
+            )
+            for row in rows
+        ]
+        self._loaded_at = time.monotonic()
+        self.loads += 1
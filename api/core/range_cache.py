@@ -0,0 +1,146 @@
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from core.redis import CACHE_SCHEMA_VERSION, get_cache_many, get_namespace_version, set_cache_many
+
+import calendar
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+Rows = List[Dict[str, Any]]
+FetchFunc = Callable[[datetime, datetime], Awaitable[Rows]]
+
+
+class RangeCache:
+    """ Time series fragment cache. Requested range is split to chunks of chunk_buckets buckets aligned
+    to epoch, so sliding windows share chunks. Chunks which ended more than settle seconds ago are cached
+    for ttl seconds in NAMESPACE cache namespace, only missing chunks and the open tail are read from
+    ClickHouse, adjacent missing chunks with one query. Samples which come later than settle after chunk
+    end are seen after ttl.
+    """
+
+    NAMESPACE: str = "series"
+
+    def __init__(self, ttl: int = 3600, settle: int = 120, chunk_buckets: int = 10, max_chunks: int = 1000):
+        self.ttl = ttl
+        self.settle = settle
+        self.chunk_buckets = chunk_buckets
+        self.max_chunks = max_chunks
+
+        self.cached_chunks: int = 0
+        self.fetched_chunks: int = 0
+        self.tail_fetches: int = 0
+
+    async def get(
+            self,
+            key: str,
+            from_ts: datetime,
+            to_ts: datetime,
+            bucket: str,
+            bucket_seconds: int,
+            fetch: FetchFunc
+    ) -> Rows:
+        """ Get rows of [from_ts, to_ts] ordered by bucket
+        :param key: cache key of the series without time range
+        :param from_ts: naive UTC
+        :param to_ts: naive UTC
+        :param bucket: bucket column of rows
+        :param bucket_seconds:
+        :param fetch: read rows of [from, to] from ClickHouse, both ends included
+        :return:
+        """
+        chunk_seconds: int = bucket_seconds * self.chunk_buckets
+        start: int = calendar.timegm(from_ts.timetuple()) // chunk_seconds * chunk_seconds
+        end: int = calendar.timegm(to_ts.timetuple())
+        if from_ts > to_ts or (end - start) // chunk_seconds + 1 > self.max_chunks:
+            return await fetch(from_ts, to_ts)
+
+        sealed_before: int = calendar.timegm(datetime.utcnow().timetuple()) - self.settle
+        sealed: List[int] = []
+        tail: Optional[int] = None
+        for chunk_start in range(start, end + 1, chunk_seconds):
+            if chunk_start + chunk_seconds <= sealed_before:
+                sealed.append(chunk_start)
+            else:
+                tail = chunk_start
+                break
+
+        prefix: str = f"{self.NAMESPACE}:v{CACHE_SCHEMA_VERSION}.{await get_namespace_version(self.NAMESPACE)}:{key}"
+        chunks: Dict[int, Rows] = {}
+        keys: List[str] = [f"{prefix}:{chunk_start}" for chunk_start in sealed]
+        missing: List[int] = []
+        for chunk_start, rows in zip(sealed, await get_cache_many(keys)):
+            if rows is None:
+                missing.append(chunk_start)
+            else:
+                chunks[chunk_start] = self._decode(rows, bucket)
+        self.cached_chunks += len(sealed) - len(missing)
+
+        fetched: Dict[str, Rows] = {}
+        for run_start, run_end in self._runs(missing, chunk_seconds):
+            rows: Rows = await fetch(_from_epoch(run_start), _from_epoch(run_end - 1))
+            for chunk_start in range(run_start, run_end, chunk_seconds):
+                chunks[chunk_start] = []
+            for row in rows:
+                ts: int = calendar.timegm(row[bucket].timetuple())
+                chunks[ts // chunk_seconds * chunk_seconds].append(row)
+            for chunk_start in range(run_start, run_end, chunk_seconds):
+                fetched[f"{prefix}:{chunk_start}"] = chunks[chunk_start]
+            self.fetched_chunks += (run_end - run_start) // chunk_seconds
+
+        if fetched:
+            await set_cache_many(fetched, ttl=self.ttl)
+
+        result: Rows = []
+        for chunk_start in sealed:
+            result.extend(row for row in chunks[chunk_start] if from_ts <= row[bucket] <= to_ts)
+
+        if tail is not None:
+            # open chunk is still written to, read only the part of it which is requested
+            self.tail_fetches += 1
+            result.extend(await fetch(max(from_ts, _from_epoch(tail)), to_ts))
+
+        return result
+
+    def stats(self) -> Dict[str, int]:
+        """ Get chunk hit counters
+        :return:
+        """
+        return {
+            "cached_chunks": self.cached_chunks,
+            "fetched_chunks": self.fetched_chunks,
+            "tail_fetches": self.tail_fetches,
+        }
+
+    @staticmethod
+    def _runs(starts: List[int], chunk_seconds: int) -> List[Tuple[int, int]]:
+        """ group sorted chunk starts to [start, end) runs of adjacent chunks
+        :param starts:
+        :param chunk_seconds:
+        :return:
+        """
+        runs: List[Tuple[int, int]] = []
+        for chunk_start in starts:
+            if runs and runs[-1][1] == chunk_start:
+                runs[-1] = (runs[-1][0], chunk_start + chunk_seconds)
+            else:
+                runs.append((chunk_start, chunk_start + chunk_seconds))
+        return runs
+
+    @staticmethod
+    def _decode(rows: Rows, bucket: str) -> Rows:
+        """ buckets of rows read from redis are iso strings
+        :param rows:
+        :param bucket:
+        :return:
+        """
+        return [
+            {**row, bucket: datetime.fromisoformat(row[bucket])} if isinstance(row[bucket], str) else row
+            for row in rows
+        ]
+
+
+def _from_epoch(ts: int) -> datetime:
+    return datetime(1970, 1, 1) + timedelta(seconds=ts)
@@ -1,16 +1,174 @@
-from typing import Any, Dict, Optional, Callable, Coroutine
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pydantic import BaseModel
+from typing import Any, Awaitable, Dict, List, Optional, Callable, Coroutine, Tuple
 
-from src.helpers import json_serializer
+from src.helpers import json_serializer, to_utc
+from src.schemas import RESOLUTION_SECONDS, Scope
 
+import asyncio
+import calendar
 import functools
+import hashlib
 import logging
 import json
 import redis.asyncio as redis
+import time
+import uuid
 
 
 logger = logging.getLogger(__name__)
 
+# bump when format of cached results changes, all old keys are missed
+CACHE_SCHEMA_VERSION: int = 1
+NAMESPACE_VERSION_TTL: float = 1.0
+
 redis_client = None
+local_cache: Optional["LocalCache"] = None
+
+redis_stats: Dict[str, int] = {"hits": 0, "misses": 0, "stale_hits": 0}
+
+# stampede protection, see setup_cache_refresh
+single_flight: bool = True
+cache_stale_ttl: int = 0
+cache_lock_ttl: int = 10
+LOCK_POLL_INTERVAL: float = 0.05
+
+flight_stats: Dict[str, int] = {"computes": 0, "coalesced": 0, "lock_waits": 0, "refreshes": 0}
+
+_flights: Dict[str, asyncio.Task] = {}
+# Script objects of redis_client by script source, registered once per connection
+_scripts: Dict[str, Any] = {}
+
+# delete lease only if it is still held with the given token
+RELEASE_LEASE_SCRIPT: str = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+_namespace_versions: Dict[str, Tuple[int, float]] = {}
+
+
+class LocalCache:
+    """ Per worker LRU cache with TTL in front of redis. Hot keys are served without network round trip
+    and without json parsing, values are shared between requests and must not be mutated by callers.
+    Entry lives min(ttl, cache ttl) seconds, least recently used entry is evicted above max_entries.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 5.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: OrderedDict[str, Tuple[float, Any]] = OrderedDict()
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.expirations: int = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str) -> Optional[Any]:
+        """ Get value by key
+        :param key:
+        :return: None if key is missing or expired
+        """
+        entry: Optional[Tuple[float, Any]] = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """ Set value, evict least recently used entries above max_entries
+        :param key:
+        :param value:
+        :param ttl: ttl of the cached result, local entry does not outlive it
+        :return:
+        """
+        if self.max_entries <= 0:
+            return
+        entry_ttl: float = self.ttl if ttl is None else min(self.ttl, ttl)
+        self._data[key] = (time.monotonic() + entry_ttl, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        """ Delete key
+        :param key:
+        :return:
+        """
+        self._data.pop(key, None)
+
+    def delete_prefix(self, prefix: str) -> None:
+        """ Delete all keys starting with prefix
+        :param prefix:
+        :return:
+        """
+        for key in [k for k in self._data if k.startswith(prefix)]:
+            del self._data[key]
+
+    def stats(self) -> Dict[str, int | float]:
+        """ Get local cache stats
+        :return:
+        """
+        return {
+            "size": len(self._data),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+def setup_local_cache(max_entries: int, ttl: float) -> None:
+    """ Enable in-process cache tier
+    :param max_entries:
+    :param ttl:
+    :return:
+    """
+    global local_cache
+    local_cache = LocalCache(max_entries=max_entries, ttl=ttl)
+
+
+def setup_cache_refresh(stale_ttl: int, lock_ttl: int, enabled: bool = True) -> None:
+    """ Configure stampede protection of redis_cache
+    :param stale_ttl: seconds expired result is still served while one caller refreshes it in background
+    :param lock_ttl: lease of the worker which recomputes a key, other workers wait for its result up to it
+    :param enabled: coalesce concurrent misses of one key
+    :return:
+    """
+    global single_flight, cache_stale_ttl, cache_lock_ttl
+    single_flight = enabled
+    cache_stale_ttl = stale_ttl
+    cache_lock_ttl = lock_ttl
+
+
+def get_cache_stats() -> Dict[str, Any]:
+    """ Get hit/miss counters of both cache tiers
+    :return:
+    """
+    return {
+        "local": local_cache.stats() if local_cache is not None else None,
+        "redis": {**redis_stats, "connected": redis_client is not None},
+        "flights": {**flight_stats, "in_flight": len(_flights)},
+    }
 
 
 async def connect_to_redis(host: str, port: str | int, password: str) -> None:
@@ -42,6 +200,7 @@ async def connect_to_redis(host: str, port: str | int, password: str) -> None:
         raise
     else:
         redis_client = client
+        _scripts.clear()
 
 
 async def get_cache(key: str) -> Optional[Dict[str, Any]]:
@@ -53,7 +212,9 @@ async def get_cache(key: str) -> Optional[Dict[str, Any]]:
         return
     data = await redis_client.get(key)
     if data:
+        redis_stats["hits"] += 1
         return json.loads(data)
+    redis_stats["misses"] += 1
     return None
 
 
@@ -69,61 +230,314 @@ async def set_cache(key: str, value: Dict[str, Any], ttl: int = 60) -> None:
     await redis_client.set(key, json.dumps(value, default=json_serializer), ex=ttl)
 
 
-def make_cache_key(
-        key: str,
-        metric: str,
-        scope: Optional[str] = None,
-        host: Optional[str] = None,
-        vm: Optional[str] = None,
-        from_ts: Optional[str] = None,
-        to_ts: Optional[str] = None,
-        from_a: Optional[str] = None,
-        to_a: Optional[str] = None,
-        from_b: Optional[str] = None,
-        to_b: Optional[str] = None,
-        resolution: Optional[str] = None
-) -> str:
-    """ Make redis cache key
+async def get_cache_many(keys: List[str]) -> List[Optional[Any]]:
+    """ Get several keys from local tier and then with one redis MGET, redis hits fill local tier
+    :param keys:
+    :return: value or None for every key
+    """
+    values: List[Optional[Any]] = [local_cache.get(k) if local_cache is not None else None for k in keys]
+    missing: List[int] = [i for i, v in enumerate(values) if v is None]
+    if not missing or not redis_client:
+        return values
+
+    for i, data in zip(missing, await redis_client.mget([keys[i] for i in missing])):
+        if data is None:
+            redis_stats["misses"] += 1
+            continue
+        redis_stats["hits"] += 1
+        values[i] = json.loads(data)
+        if local_cache is not None:
+            local_cache.set(keys[i], values[i])
+    return values
+
+
+async def set_cache_many(values: Dict[str, Any], ttl: int = 60) -> None:
+    """ Set several keys with one redis round trip
+    :param values:
+    :param ttl:
+    :return:
+    """
+    if local_cache is not None:
+        for key, value in values.items():
+            local_cache.set(key, value, ttl=ttl)
+    if not redis_client or not values:
+        return
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for key, value in values.items():
+            pipe.set(key, json.dumps(value, default=json_serializer), ex=ttl)
+        await pipe.execute()
+
+
+async def run_script(script: str, keys: List[str], args: List[Any]) -> Optional[Any]:
+    """ Run lua script with EVALSHA, script is registered on first run and reused
+    :param script:
+    :param keys:
+    :param args:
+    :return: None if redis is not connected
+    """
+    if not redis_client:
+        return None
+    registered: Any = _scripts.get(script)
+    if registered is None:
+        registered = _scripts[script] = redis_client.register_script(script)
+    return await registered(keys=keys, args=args)
+
+
+async def get_hash(key: str, fields: Optional[List[str]] = None) -> Optional[Dict[str, str]]:
+    """ Get fields of redis hash, whole hash if fields are not set
     :param key:
-    :param metric:
-    :param scope:
-    :param host:
-    :param vm:
-    :param from_ts:
-    :param to_ts:
-    :param from_a:
-    :param to_a:
-    :param from_b:
-    :param to_b:
-    :param resolution:
-    :return:
-    """
-    cache_key: str = f"{key}:{metric}"
-    if scope:
-        cache_key += f":{scope}"
-    if host:
-        cache_key += f":{host}"
-    if vm:
-        cache_key += f":{vm}"
-    if from_ts:
-        cache_key += f":{from_ts}"
-    if to_ts:
-        cache_key += f":{to_ts}"
-    if from_a:
-        cache_key += f":{from_a}"
-    if to_a:
-        cache_key += f":{to_a}"
-    if from_b:
-        cache_key += f":{from_b}"
-    if to_b:
-        cache_key += f":{to_b}"
-    if resolution:
-        cache_key += f":{resolution}"
-    return cache_key
+    :param fields:
+    :return: None if redis is not connected
+    """
+    if not redis_client:
+        return None
+    if fields is None:
+        return await redis_client.hgetall(key)
+    values: List[Optional[str]] = await redis_client.hmget(key, fields)
+    return {f: v for f, v in zip(fields, values) if v is not None}
+
+
+async def get_cache_entry(key: str) -> Tuple[Optional[Any], bool]:
+    """ Get cached result written by set_cache_entry
+    :param key:
+    :return: value or None, value is stale
+    """
+    if not redis_client:
+        return None, False
+    data = await redis_client.get(key)
+    if not data:
+        redis_stats["misses"] += 1
+        return None, False
+
+    entry: Any = json.loads(data)
+    if not isinstance(entry, dict) or entry.keys() != {"value", "stale_at"}:
+        # entry of set_cache
+        redis_stats["hits"] += 1
+        return entry, False
+
+    if entry["stale_at"] <= time.time():
+        redis_stats["stale_hits"] += 1
+        return entry["value"], True
+    redis_stats["hits"] += 1
+    return entry["value"], False
+
+
+async def set_cache_entry(key: str, value: Any, ttl: int = 60, stale_ttl: int = 0) -> None:
+    """ Set cached result which is fresh for ttl seconds and is kept stale for stale_ttl seconds more
+    :param key:
+    :param value:
+    :param ttl:
+    :param stale_ttl:
+    :return:
+    """
+    if not redis_client:
+        return
+    entry: Dict[str, Any] = {"value": value, "stale_at": time.time() + ttl}
+    await redis_client.set(key, json.dumps(entry, default=json_serializer), ex=ttl + stale_ttl)
+
+
+async def set_cache_nx(key: str, ttl: int = 60, value: str | int = 1) -> Optional[bool]:
+    """ Set key only if it does not exist
+    :param key:
+    :param ttl:
+    :param value:
+    :return: True if key was set, False if it exists, None if redis is not connected
+    """
+    if not redis_client:
+        return None
+    return bool(await redis_client.set(key, value, nx=True, ex=ttl))
+
+
+async def release_lease(key: str, token: str) -> None:
+    """ Delete lease taken with set_cache_nx(key, value=token) unless it expired and was taken by another worker
+    :param key:
+    :param token:
+    :return:
+    """
+    await run_script(RELEASE_LEASE_SCRIPT, [key], [token])
+
+
+async def delete_cache(key: str) -> None:
+    """ Delete key from cache
+    :param key:
+    :return:
+    """
+    if local_cache is not None:
+        local_cache.delete(key)
+    if not redis_client:
+        return
+    await redis_client.delete(key)
+
+
+def normalize_query(query: Any) -> Dict[str, Any]:
+    """ Query fields which affect the result. Fields ignored for the scope and empty fields are dropped.
+    Range bounds are compared with bucket starts, so from is rounded up and to is rounded down to bucket,
+    bounds are converted to naive UTC the same way as in queries
+    :param query:
+    :return:
+    """
+    fields: Dict[str, Any] = query.model_dump() if isinstance(query, BaseModel) else dict(vars(query))
+
+    scope: Any = fields.get("scope")
+    if scope == Scope.global_:
+        fields.pop("host", None)
+        fields.pop("vm", None)
+    elif scope == Scope.host:
+        fields.pop("vm", None)
+
+    step: Optional[int] = RESOLUTION_SECONDS.get(fields.get("resolution"))
+    for name, value in list(fields.items()):
+        if not isinstance(value, datetime):
+            continue
+        value = to_utc(value)
+        if step:
+            offset: int = calendar.timegm(value.timetuple()) % step
+            if name.startswith("from_") and offset:
+                value += timedelta(seconds=step - offset)
+            elif name.startswith("to_"):
+                value -= timedelta(seconds=offset)
+        fields[name] = value
+
+    return {name: value for name, value in fields.items() if value is not None}
+
+
+async def get_namespace_version(namespace: str) -> int:
+    """ Current version of cache namespace, it is remembered by worker for NAMESPACE_VERSION_TTL seconds
+    :param namespace:
+    :return:
+    """
+    version, expires_at = _namespace_versions.get(namespace, (0, 0.0))
+    if expires_at > time.monotonic() or not redis_client:
+        return version
+
+    version = int(await redis_client.get(f"ns:{namespace}") or 0)
+    _namespace_versions[namespace] = (version, time.monotonic() + NAMESPACE_VERSION_TTL)
+    return version
+
+
+async def invalidate_namespace(namespace: str) -> int:
+    """ Invalidate all keys of namespace by bumping its version, old keys expire by ttl.
+    Other workers see new version after NAMESPACE_VERSION_TTL
+    :param namespace: key_prefix of redis_cache
+    :return: new version
+    """
+    _namespace_versions.pop(namespace, None)
+    if local_cache is not None:
+        local_cache.delete_prefix(f"{namespace}:")
+    if not redis_client:
+        return 0
+    return int(await redis_client.incr(f"ns:{namespace}"))
+
+
+async def make_cache_key(key: str, query: Any, extra: Optional[Dict[str, Any]] = None) -> str:
+    """ Make fixed length cache key: namespace, schema and namespace versions, hash of normalized query
+    :param key: namespace
+    :param query:
+    :param extra: other arguments of the cached call, they are part of the key as they are
+    :return:
+    """
+    normalized: str = json.dumps(
+        {**normalize_query(query), **(extra or {})}, sort_keys=True, default=json_serializer
+    )
+    digest: str = hashlib.blake2b(normalized.encode(), digest_size=16).hexdigest()
+    return f"{key}:v{CACHE_SCHEMA_VERSION}.{await get_namespace_version(key)}:{digest}"
+
+
+def _flight(key: str, compute: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+    """ Single flight: concurrent callers of one key in this worker share one compute task.
+    Task is not bound to the request which started it, so cancelled request does not fail the others
+    :param key:
+    :param compute:
+    :return:
+    """
+    task: Optional[asyncio.Task] = _flights.get(key)
+    if task is not None:
+        flight_stats["coalesced"] += 1
+        return task
+
+    task = asyncio.ensure_future(compute())
+    _flights[key] = task
+    task.add_done_callback(lambda t: _flights.pop(key, None) if _flights.get(key) is t else None)
+    return task
+
+
+async def _recompute(
+        cache_key: str,
+        compute: Callable[[], Awaitable[Any]],
+        ttl: int,
+        wait: bool = True
+) -> Optional[Any]:
+    """ Compute and cache result under redis lease, so one worker recomputes expired key.
+    Worker without lease waits for result of the lease holder and takes the lease over
+    once it is released without result (holder failed) or expired
+    :param cache_key:
+    :param compute:
+    :param ttl:
+    :param wait: wait for lease holder, otherwise return None without computing
+    :return:
+    """
+    lock_key: str = f"lock:{cache_key}"
+    token: str = uuid.uuid4().hex
+    leased: Optional[bool] = await set_cache_nx(lock_key, ttl=cache_lock_ttl, value=token) if single_flight else None
+
+    if leased is False:
+        if not wait:
+            return None
+        flight_stats["lock_waits"] += 1
+        deadline: float = time.monotonic() + cache_lock_ttl
+        while time.monotonic() < deadline:
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+            cached, stale = await get_cache_entry(cache_key)
+            if cached is not None and not stale:
+                return cached
+            if await set_cache_nx(lock_key, ttl=cache_lock_ttl, value=token):
+                leased = True
+                break
+        else:
+            logger.warning(f"Lease of {cache_key} is held longer than {cache_lock_ttl}s, compute without it")
+
+        if leased:
+            # holder may have cached result and released lease between the two reads
+            cached, stale = await get_cache_entry(cache_key)
+            if cached is not None and not stale:
+                await release_lease(lock_key, token)
+                return cached
+
+    try:
+        flight_stats["computes"] += 1
+        result: Any = await compute()
+        if result is not None:
+            if local_cache is not None:
+                local_cache.set(cache_key, result, ttl=ttl)
+            await set_cache_entry(cache_key, result, ttl=ttl, stale_ttl=cache_stale_ttl)
+        return result
+    finally:
+        if leased:
+            await release_lease(lock_key, token)
+
+
+def _refresh_in_background(cache_key: str, compute: Callable[[], Awaitable[Any]], ttl: int) -> None:
+    """ Stale-while-revalidate: refresh stale key unless it is refreshed by this or another worker
+    :param cache_key:
+    :param compute:
+    :param ttl:
+    :return:
+    """
+    if cache_key in _flights:
+        return
+
+    def done(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Background refresh of {cache_key} failed: {task.exception()}")
+
+    flight_stats["refreshes"] += 1
+    _flight(cache_key, lambda: _recompute(cache_key, compute, ttl, wait=False)).add_done_callback(done)
 
 
 def redis_cache(key_prefix: str, ttl: int = 60):
-    """ Cache decorator
+    """ Cache decorator. Expired key is recomputed by one caller: concurrent misses in a worker
+    share one query and workers share redis lease. Within cache_stale_ttl after expiry the stale
+    result is returned and refreshed in background
     :param key_prefix:
     :param ttl:
     :return:
@@ -135,33 +549,34 @@ def redis_cache(key_prefix: str, ttl: int = 60):
             if query is None:
                 raise ValueError("Decorator expects a 'query' argument")
 
-            cache_key: Optional[str] = None
-
-            if redis_client:
-                cache_key = make_cache_key(
-                    key=key_prefix,
-                    metric=getattr(query, "metric", None),
-                    scope=getattr(query, "scope", None),
-                    host=getattr(query, "host", None),
-                    vm=getattr(query, "vm", None),
-                    from_ts=getattr(query, "from_ts", None).isoformat() if getattr(query, "from_ts", None) else "",
-                    to_ts=getattr(query, "to_ts", None).isoformat() if getattr(query, "to_ts", None) else "",
-                    from_a=getattr(query, "from_a", None).isoformat() if getattr(query, "from_a", None) else "",
-                    to_a=getattr(query, "to_a", None).isoformat() if getattr(query, "to_a", None) else "",
-                    resolution=getattr(query, "resolution", None)
-                )
-
-                cached: Optional[Dict[str, Any]] = await get_cache(cache_key)
-                if cached:
-                    return cached
+            if not redis_client and local_cache is None:
+                return await func(self, *args, **kwargs)
 
-            result: Dict[str, Any] = await func(self, *args, **kwargs)
+            cache_key: str = await make_cache_key(
+                key_prefix, query, {name: value for name, value in kwargs.items() if name != "query"}
+            )
 
-            if cache_key:
-                if result is not None:
-                    await set_cache(cache_key, result, ttl=ttl)
+            if local_cache is not None:
+                cached = local_cache.get(cache_key)
+                if cached is not None:
+                    return cached
+
+            cached, stale = await get_cache_entry(cache_key)
+            if cached is not None:
+                if not stale:
+                    if local_cache is not None:
+                        local_cache.set(cache_key, cached, ttl=ttl)
+                    return cached
+                if single_flight:
+                    _refresh_in_background(cache_key, lambda: func(self, *args, **kwargs), ttl)
+                    return cached
 
-            return result
+            compute: Callable[[], Awaitable[Any]] = lambda: _recompute(
+                cache_key, lambda: func(self, *args, **kwargs), ttl
+            )
+            if not single_flight:
+                return await compute()
+            return await asyncio.shield(_flight(cache_key, compute))
 
         return wrapper
     return decorator
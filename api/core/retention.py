@@ -0,0 +1,132 @@
+from aiochclient import ChClient
+from typing import Dict, List, NamedTuple, Optional
+
+import logging
+import re
+
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionTier(NamedTuple):
+    table: str
+    column: str
+    days: int
+    # table is on 'tiered' storage policy, so its old parts can be moved to cold volume
+    tiered: bool = True
+
+
+def make_tiers(
+        raw_days: int,
+        m1_days: int,
+        m5_days: int,
+        h1_days: int,
+        d1_days: int,
+        tag_index_days: int,
+        inventory_days: int
+) -> List[RetentionTier]:
+    """ Retention tiers of infra tables, coarser rollups are expected to live longer
+    :param raw_days:
+    :param m1_days:
+    :param m5_days:
+    :param h1_days:
+    :param d1_days:
+    :param tag_index_days: tag sets not seen for this long are dropped from tag index
+    :param inventory_days: hosts, vms and metrics silent for this long are dropped from inventory
+    :return:
+    """
+    return [
+        RetentionTier("metrics_raw_local", "ts", raw_days, tiered=False),
+        RetentionTier("metrics_agg_raw_local", "ts", raw_days, tiered=False),
+        RetentionTier("metrics_1m_local", "minute", m1_days),
+        RetentionTier("metrics_5m_local", "bucket", m5_days),
+        RetentionTier("metrics_1h_local", "bucket", h1_days),
+        RetentionTier("metrics_1d_local", "bucket", d1_days),
+        RetentionTier("tag_index_local", "last_seen", tag_index_days, tiered=False),
+        RetentionTier("inventory_local", "last_seen", inventory_days, tiered=False),
+    ]
+
+
+class RetentionPolicy:
+    """ Keeps TTLs of raw and rollup tables equal to configured retention tiers. With cold_volume parts
+    older than cold_after days are moved to that volume of 'tiered' storage policy before they expire.
+    TTL is changed only for tables where it differs, tables are created with ttl_only_drop_parts and
+    materialize_ttl_recalculate_only, so the change costs TTL recalculation, not a rewrite of parts:
+    expired partitions are dropped whole and moves are done in background.
+    """
+
+    def __init__(
+            self,
+            ch: ChClient,
+            tiers: List[RetentionTier],
+            cold_volume: Optional[str] = None,
+            cold_after: int = 7,
+            database: str = "infra",
+            cluster: str = "infra_cluster"
+    ):
+        self.ch = ch
+        self.tiers = tiers
+        self.cold_volume = cold_volume
+        self.cold_after = cold_after
+        self.database = database
+        self.cluster = cluster
+
+    def ttl_expression(self, tier: RetentionTier) -> str:
+        """ TTL of tier in the form ClickHouse shows it in engine_full
+        :param tier:
+        :return:
+        """
+        expression: str = f"{tier.column} + toIntervalDay({tier.days})"
+        if self.cold_volume and tier.tiered and tier.days > self.cold_after:
+            expression = f"{tier.column} + toIntervalDay({self.cold_after}) TO VOLUME '{self.cold_volume}', {expression}"
+        return expression
+
+    async def current_ttls(self) -> Dict[str, str]:
+        """ TTL expressions of tier tables
+        :return: TTL by table, empty string for table without TTL
+        """
+        tables: str = ", ".join(f"'{tier.table}'" for tier in self.tiers)
+        rows = await self.ch.fetch(f"""
+            SELECT name, engine_full
+            FROM system.tables
+            WHERE database = '{self.database}' AND name IN ({tables})
+        """)
+
+        ttls: Dict[str, str] = {}
+        for row in rows:
+            match = re.search(r"\bTTL (.+?)(?: SETTINGS |$)", row["engine_full"])
+            ttls[row["name"]] = match.group(1).strip() if match else ""
+        return ttls
+
+    async def apply(self) -> List[str]:
+        """ Modify TTL of tables where it differs from the tier, errors are logged
+        :return: modified tables
+        """
+        current: Dict[str, str] = await self.current_ttls()
+
+        modified: List[str] = []
+        for tier in self.tiers:
+            if tier.table not in current:
+                logger.warning(f"Retention: table {self.database}.{tier.table} does not exist")
+                continue
+
+            expression: str = self.ttl_expression(tier)
+            if _normalize(current[tier.table]) == _normalize(expression):
+                continue
+
+            try:
+                await self.ch.execute(
+                    f"ALTER TABLE {self.database}.{tier.table} ON CLUSTER {self.cluster} MODIFY TTL {expression}"
+                )
+            except Exception as e:
+                logger.error(f"Retention: modify TTL of {self.database}.{tier.table} failed: {e}")
+                continue
+
+            logger.info(f"Retention: {self.database}.{tier.table} TTL {current[tier.table] or 'none'} -> {expression}")
+            modified.append(tier.table)
+
+        return modified
+
+
+def _normalize(expression: str) -> str:
+    return re.sub(r"\s+", "", expression).replace("DELETE", "")
@@ -0,0 +1,168 @@
+from aiochclient import ChClientError
+from aiohttp import ClientSession
+from datetime import date, datetime
+from itertools import chain
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from src.schemas import RawMetricRow
+
+import calendar
+import struct
+import zlib
+
+
+RAW_COLUMNS: Tuple[str, ...] = ("date", "ts", "host", "vm", "metric", "value", "tags")
+
+_EPOCH_ORDINAL: int = date(1970, 1, 1).toordinal()
+_EMPTY_MAP: bytes = b"\x00"
+_float64 = struct.Struct("<d").pack
+_date_datetime = struct.Struct("<HI").pack
+
+
+def encode_uvarint(value: int) -> bytes:
+    """ LEB128 unsigned varint, used for string lengths and map sizes
+    :param value:
+    :return:
+    """
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def encode_string(value: str) -> bytes:
+    """ RowBinary String
+    :param value:
+    :return:
+    """
+    raw: bytes = value.encode("utf-8")
+    return encode_uvarint(len(raw)) + raw
+
+
+def encode_map(value: Dict[str, str]) -> bytes:
+    """ RowBinary Map(String, String)
+    :param value:
+    :return:
+    """
+    if not value:
+        return _EMPTY_MAP
+    parts: List[bytes] = [encode_uvarint(len(value))]
+    for k, v in value.items():
+        parts.append(encode_string(k))
+        parts.append(encode_string(v))
+    return b"".join(parts)
+
+
+def encode_date_ts(ts: datetime) -> bytes:
+    """ RowBinary Date + DateTime pair, naive datetimes are treated as UTC
+    :param ts:
+    :return:
+    """
+    return _date_datetime(ts.toordinal() - _EPOCH_ORDINAL, calendar.timegm(ts.utctimetuple()))
+
+
+def _encode_cached(values: Sequence, encoder: Callable, cache: Dict) -> List[bytes]:
+    """ encode one column, metric names, hosts and vms repeat a lot so every distinct value is encoded once
+    :param values:
+    :param encoder:
+    :param cache:
+    :return:
+    """
+    out: List[bytes] = []
+    append = out.append
+    for v in values:
+        encoded: Optional[bytes] = cache.get(v)
+        if encoded is None:
+            encoded = cache[v] = encoder(v)
+        append(encoded)
+    return out
+
+
+def encode_rows(rows: List[RawMetricRow]) -> bytes:
+    """ Encode raw metric rows to RowBinary in RAW_COLUMNS order.
+    Columns are encoded one by one and interleaved into rows at the end
+    :param rows:
+    :return:
+    """
+    if not rows:
+        return b""
+
+    ts_col, host_col, vm_col, metric_col, value_col, tags_col = zip(*rows)
+    strings: Dict[str, bytes] = {}
+
+    columns: List[List[bytes]] = [
+        _encode_cached(ts_col, encode_date_ts, {}),
+        _encode_cached(host_col, encode_string, strings),
+        _encode_cached(vm_col, encode_string, strings),
+        _encode_cached(metric_col, encode_string, strings),
+        [_float64(v) for v in value_col],
+        [encode_map(t) if t else _EMPTY_MAP for t in tags_col],
+    ]
+    return b"".join(chain.from_iterable(zip(*columns)))
+
+
+class RowBinaryWriter:
+    """ Insert rows to ClickHouse with RowBinary format over the shared aiohttp session """
+
+    def __init__(
+            self,
+            session: ClientSession,
+            url: str,
+            user: str,
+            password: str,
+            database: str,
+            compression: Optional[str] = None,
+            chunk_rows: int = 10000,
+    ):
+        self.session = session
+        self.url = url
+        self.database = database
+        self.compression = compression
+        self.chunk_rows = chunk_rows
+        self.headers: Dict[str, str] = {
+            "X-ClickHouse-User": user,
+            "X-ClickHouse-Key": password,
+        }
+        if compression == "gzip":
+            self.headers["Content-Encoding"] = "gzip"
+
+    async def insert(self, table: str, rows: List[RawMetricRow], settings: Optional[Dict[str, str]] = None) -> None:
+        """ Stream rows to table in chunks
+        :param table:
+        :param rows:
+        :param settings: ClickHouse settings for this insert
+        :return:
+        """
+        if not rows:
+            return
+
+        params: Dict[str, str] = {
+            **(settings or {}),
+            "database": self.database,
+            "query": f"INSERT INTO {table} ({', '.join(RAW_COLUMNS)}) FORMAT RowBinary",
+        }
+
+        async with self.session.post(self.url, params=params, headers=self.headers, data=self._stream(rows)) as resp:
+            if resp.status != 200:
+                raise ChClientError(await resp.text())
+
+    async def _stream(self, rows: List[RawMetricRow]) -> AsyncIterator[bytes]:
+        for chunk in self._chunks(rows):
+            yield chunk
+
+    def _chunks(self, rows: List[RawMetricRow]) -> Iterator[bytes]:
+        compressor = zlib.compressobj(level=1, wbits=31) if self.compression == "gzip" else None
+
+        for i in range(0, len(rows), self.chunk_rows):
+            data: bytes = encode_rows(rows[i:i + self.chunk_rows])
+            if compressor is None:
+                yield data
+                continue
+            data = compressor.compress(data)
+            if data:
+                yield data
+
+        if compressor is not None:
+            yield compressor.flush()
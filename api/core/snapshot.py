@@ -0,0 +1,188 @@
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from core.redis import get_hash, run_script
+from src.schemas import AggregatedMetricRow, LatestMetricsQuery, MetricsTopQuery, RawMetricRow
+
+import calendar
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+FIELD_SEPARATOR: str = "\x1f"
+
+# KEYS: snapshot hashes, ARGV: ttl, then groups of key index, field, minute, min, max, sum, count.
+# Entry of newer minute replaces entry, entry of the same minute is merged, older one is ignored
+UPDATE_SCRIPT: str = """
+local ttl = tonumber(ARGV[1])
+for i = 2, #ARGV, 7 do
+    local key = KEYS[tonumber(ARGV[i])]
+    local field = ARGV[i + 1]
+    local minute = tonumber(ARGV[i + 2])
+    local mn = tonumber(ARGV[i + 3])
+    local mx = tonumber(ARGV[i + 4])
+    local sm = tonumber(ARGV[i + 5])
+    local ct = tonumber(ARGV[i + 6])
+    local write = true
+
+    local old = redis.call("HGET", key, field)
+    if old then
+        local o_minute, o_min, o_max, o_sum, o_cnt = string.match(old, "([^,]+),([^,]+),([^,]+),([^,]+),([^,]+)")
+        o_minute = tonumber(o_minute)
+        if o_minute > minute then
+            write = false
+        elseif o_minute == minute then
+            mn = math.min(mn, tonumber(o_min))
+            mx = math.max(mx, tonumber(o_max))
+            sm = sm + tonumber(o_sum)
+            ct = ct + tonumber(o_cnt)
+        end
+    end
+
+    if write then
+        redis.call("HSET", key, field, string.format("%d,%.17g,%.17g,%.17g,%d", minute, mn, mx, sm, ct))
+    end
+end
+for i = 1, #KEYS do
+    redis.call("EXPIRE", KEYS[i], ttl)
+end
+return #KEYS
+"""
+
+# minute, min, max, sum, count
+Entry = Tuple[int, float, float, float, int]
+
+
+class LatestSnapshot:
+    """ Latest minute per (metric, host, vm) kept in redis hash per metric, updated by ingest with one
+    atomic script call per batch. /metrics/latest and /metrics/top of 1m resolution are answered from it
+    without ClickHouse query, with the same values as metrics_1m for the latest minute.
+
+    Staleness: snapshot is updated before ingest request is answered, so it is ahead of ClickHouse
+    when ingest is buffered or spooled. Series without samples for ttl seconds are dropped with the hash
+    of the metric, queries which find nothing in snapshot fall back to ClickHouse.
+    """
+    KEY_PREFIX: str = "snapshot"
+
+    def __init__(self, ttl: int = 86400):
+        self.ttl = ttl
+
+    async def update(self, rows: List[RawMetricRow | AggregatedMetricRow]) -> None:
+        """ Merge rows to snapshot, only the newest minute of every series in batch is sent
+        :param rows:
+        :return:
+        """
+        acc: Dict[Tuple[str, str], List[Any]] = {}
+        for row in rows:
+            minute: int = calendar.timegm(row.ts.utctimetuple()) // 60 * 60
+            if isinstance(row, AggregatedMetricRow):
+                entry: List[Any] = [minute, row.min_value, row.max_value, row.sum_value, row.cnt]
+            else:
+                entry = [minute, row.value, row.value, row.value, 1]
+
+            key: Tuple[str, str] = (row.metric, f"{row.host}{FIELD_SEPARATOR}{row.vm}")
+            current: Optional[List[Any]] = acc.get(key)
+            if current is None or minute > current[0]:
+                acc[key] = entry
+            elif minute == current[0]:
+                current[1] = min(current[1], entry[1])
+                current[2] = max(current[2], entry[2])
+                current[3] += entry[3]
+                current[4] += entry[4]
+
+        if not acc:
+            return
+
+        keys: Dict[str, int] = {}
+        args: List[Any] = [self.ttl]
+        for (metric, field), entry in acc.items():
+            index: int = keys.setdefault(self._key(metric), len(keys) + 1)
+            args += [index, field, *entry]
+
+        await run_script(UPDATE_SCRIPT, list(keys), args)
+
+    async def get_latest(self, query: LatestMetricsQuery) -> Optional[Dict[str, str | float | datetime]]:
+        """ Latest minute of vm, host or all vms
+        :param query:
+        :return: None if snapshot has no entries for query
+        """
+        entries: Dict[Tuple[str, str], Entry] = await self._entries(query.metric, query.scope, query.host, query.vm)
+        if not entries:
+            return None
+
+        minute: int = max(e[0] for e in entries.values())
+        row: Dict[str, Any] = {}
+        if query.scope == "vm":
+            row.update(host=query.host, vm=query.vm)
+        elif query.scope == "host":
+            row["host"] = query.host
+
+        row["minute"] = datetime.utcfromtimestamp(minute)
+        row.update(self._aggregate([e for e in entries.values() if e[0] == minute]))
+        return row
+
+    async def get_top(self, query: MetricsTopQuery) -> Optional[List[Dict[str, str | float]]]:
+        """ Hosts or vms with the highest average in the latest minute
+        :param query:
+        :return: None if snapshot has no entries for query
+        """
+        entries: Dict[Tuple[str, str], Entry] = await self._entries(
+            query.metric, "host" if query.scope == "vm" and query.host else "global", query.host, None
+        )
+        if not entries:
+            return None
+
+        minute: int = max(e[0] for e in entries.values())
+        groups: Dict[Tuple[str, ...], List[Entry]] = {}
+        for (host, vm), entry in entries.items():
+            if entry[0] == minute:
+                groups.setdefault((host, vm) if query.scope == "vm" else (host,), []).append(entry)
+
+        dims: Tuple[str, ...] = ("host", "vm") if query.scope == "vm" else ("host",)
+        rows: List[Dict[str, Any]] = [
+            {**dict(zip(dims, group)), **self._aggregate(group_entries)}
+            for group, group_entries in groups.items()
+        ]
+        rows.sort(key=lambda r: r["avg"], reverse=True)
+        return rows[:query.limit]
+
+    async def _entries(
+            self,
+            metric: str,
+            scope: str,
+            host: Optional[str],
+            vm: Optional[str]
+    ) -> Dict[Tuple[str, str], Entry]:
+        """ read snapshot entries of metric filtered by scope
+        :param metric:
+        :param scope:
+        :param host:
+        :param vm:
+        :return: entries by (host, vm)
+        """
+        fields: Optional[List[str]] = [f"{host}{FIELD_SEPARATOR}{vm}"] if scope == "vm" else None
+        values: Optional[Dict[str, str]] = await get_hash(self._key(metric), fields)
+        if not values:
+            return {}
+
+        entries: Dict[Tuple[str, str], Entry] = {}
+        for field, value in values.items():
+            entry_host, entry_vm = field.split(FIELD_SEPARATOR, 1)
+            if scope == "host" and entry_host != host:
+                continue
+            minute, mn, mx, sm, ct = value.split(",")
+            entries[(entry_host, entry_vm)] = (int(minute), float(mn), float(mx), float(sm), int(ct))
+        return entries
+
+    @staticmethod
+    def _aggregate(entries: List[Entry]) -> Dict[str, float]:
+        count: int = sum(e[4] for e in entries)
+        return {
+            "avg": sum(e[3] for e in entries) / count if count else 0.0,
+            "min": min(e[1] for e in entries),
+            "max": max(e[2] for e in entries),
+        }
+
+    def _key(self, metric: str) -> str:
+        return f"{self.KEY_PREFIX}:{metric}"
@@ -0,0 +1,359 @@
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Awaitable, BinaryIO, Callable, Dict, List, Optional, Tuple
+
+from src.schemas import RawMetricRow
+
+import asyncio
+import calendar
+import fcntl
+import itertools
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+
+
+logger = logging.getLogger(__name__)
+
+# payload length, crc32 of payload
+RECORD_HEADER = struct.Struct("<II")
+SEGMENT_SUFFIX = ".seg"
+ACK_SUFFIX = ".ack"
+
+
+class SpoolFullError(Exception):
+    ...
+
+
+def encode_record(rows: List[RawMetricRow], token: str) -> bytes:
+    """ encode rows to spool record: header + json payload
+    :param rows:
+    :param token: insert deduplication token
+    :return:
+    """
+    payload: bytes = json.dumps(
+        [token, [[calendar.timegm(r.ts.utctimetuple()), r.host, r.vm, r.metric, r.value, r.tags] for r in rows]],
+        separators=(",", ":")
+    ).encode()
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_payload(payload: bytes) -> Tuple[str, List[RawMetricRow]]:
+    """ decode spool record payload
+    :param payload:
+    :return: insert deduplication token, rows
+    """
+    token, rows = json.loads(payload)
+    return token, [
+        RawMetricRow(datetime.utcfromtimestamp(ts), host, vm, metric, value, tags)
+        for ts, host, vm, metric, value, tags in rows
+    ]
+
+
+class MetricsSpool:
+    """ Append only on-disk spool for raw rows which could not be inserted to ClickHouse.
+    Rows are appended to segment files, every record has crc32 checksum. Background task replays
+    sealed segments oldest first in large batches and removes them, replay position is kept in
+    .ack file next to segment. Every record keeps insert deduplication token of the failed insert and is
+    replayed alone under it, so rows of an insert which landed although the client saw an error are
+    deduplicated by ClickHouse. Every worker claims its own spool directory with flock, so spool
+    left by a dead worker is replayed by the next one which claims the directory. Segments of directories nobody
+    holds on start (worker count went down) are moved to the directory of the starting worker.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            replay_func: Callable[[List[RawMetricRow], str], Awaitable[None]],
+            segment_bytes: int = 64 * 1024 * 1024,
+            max_bytes: int = 1024 * 1024 * 1024,
+            replay_rows: int = 50000,
+            replay_interval: float = 5.0,
+            fsync: bool = False,
+    ):
+        self.base_path = Path(path)
+        self.replay_func = replay_func
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.replay_rows = replay_rows
+        self.replay_interval = replay_interval
+        self.fsync = fsync
+
+        self.path: Optional[Path] = None
+        self.healthy: bool = True
+
+        self._lock_fd: Optional[int] = None
+        self._segments: List[Path] = []
+        self._active: Optional[BinaryIO] = None
+        self._active_path: Optional[Path] = None
+        self._bytes: int = 0
+        self._next_seq: int = 0
+        self._task: Optional[asyncio.Task] = None
+
+        self.spooled_rows: int = 0
+        self.replayed_rows: int = 0
+        self.failed_replays: int = 0
+        self.corrupted_records: int = 0
+
+    async def start(self) -> None:
+        """ Claim spool directory and start background replay
+        :return:
+        """
+        self._claim_directory()
+        segments: List[Path] = sorted(self.path.glob(f"*{SEGMENT_SUFFIX}"))
+        self._next_seq = int(segments[-1].stem) + 1 if segments else 0
+        self._adopt_orphans()
+
+        self._segments = sorted(self.path.glob(f"*{SEGMENT_SUFFIX}"))
+        self._bytes = sum(p.stat().st_size - self._read_ack(p) for p in self._segments)
+
+        if self._segments:
+            logger.warning(f"Spool {self.path} has {len(self._segments)} segments to replay ({self._bytes} bytes)")
+
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """ Stop background replay, close active segment and release spool directory
+        :return:
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        self._seal()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def mark_unhealthy(self) -> None:
+        """ ClickHouse insert failed, new rows go to spool until replay succeeds
+        :return:
+        """
+        self.healthy = False
+
+    def append(self, rows: List[RawMetricRow], token: str) -> None:
+        """ Append rows to active segment
+        :param rows:
+        :param token: insert deduplication token
+        :return:
+        """
+        record: bytes = encode_record(rows, token)
+        if self._bytes + len(record) > self.max_bytes:
+            raise SpoolFullError(f"Spool is full ({self._bytes}/{self.max_bytes} bytes)")
+
+        if self._active is None:
+            self._active_path = self.path / f"{self._next_seq:012d}{SEGMENT_SUFFIX}"
+            self._active = open(self._active_path, "ab")
+            self._segments.append(self._active_path)
+            self._next_seq += 1
+
+        self._active.write(record)
+        self._active.flush()
+        if self.fsync:
+            os.fsync(self._active.fileno())
+
+        self._bytes += len(record)
+        self.spooled_rows += len(rows)
+
+        if self._active.tell() >= self.segment_bytes:
+            self._seal()
+
+    async def replay(self) -> bool:
+        """ Replay records of one batch from the oldest segment, every record with its own token
+        :return: False if insert failed
+        """
+        if not self._segments:
+            self.healthy = True
+            return True
+
+        segment: Path = self._segments[0]
+        if segment == self._active_path:
+            self._seal()
+
+        offset: int = self._read_ack(segment)
+        records, next_offset, at_end = await asyncio.to_thread(self._read_batch, segment, offset)
+
+        replayed: int = 0
+        done_offset: int = offset
+        for token, rows, end_offset in records:
+            try:
+                await self.replay_func(rows, token)
+            except Exception as e:
+                self.failed_replays += 1
+                logger.error(f"Replay {len(rows)} spooled rows from {segment.name} failed: {e}")
+                self.replayed_rows += replayed
+                if done_offset > offset:
+                    self._bytes -= done_offset - offset
+                    self._write_ack(segment, done_offset)
+                return False
+            replayed += len(rows)
+            done_offset = end_offset
+
+        if replayed:
+            self.replayed_rows += replayed
+            logger.info(f"Replayed {replayed} spooled rows from {segment.name}")
+
+        self._bytes -= next_offset - offset
+        if at_end:
+            self._bytes -= segment.stat().st_size - next_offset
+            segment.unlink()
+            segment.with_suffix(ACK_SUFFIX).unlink(missing_ok=True)
+            self._segments.pop(0)
+        else:
+            self._write_ack(segment, next_offset)
+
+        if not self._segments:
+            self.healthy = True
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        """ Get spool depth stats
+        :return:
+        """
+        oldest_age: float = 0.0
+        if self._segments:
+            # mtime is kept when segments of an unclaimed directory are moved, ctime is not
+            oldest_age = max(0.0, time.time() - self._segments[0].stat().st_mtime)
+
+        return {
+            "healthy": self.healthy,
+            "segments": len(self._segments),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "oldest_age": oldest_age,
+            "spooled_rows": self.spooled_rows,
+            "replayed_rows": self.replayed_rows,
+            "failed_replays": self.failed_replays,
+            "corrupted_records": self.corrupted_records,
+        }
+
+    def _claim_directory(self) -> None:
+        for slot in itertools.count():
+            path: Path = self.base_path / f"worker-{slot}"
+            path.mkdir(parents=True, exist_ok=True)
+
+            fd: int = os.open(path / "lock", os.O_CREAT | os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+
+            self._lock_fd = fd
+            self.path = path
+            logger.info(f"Use spool directory {path}")
+            return
+
+    def _adopt_orphans(self) -> None:
+        """ move segments of unlocked worker directories to own directory, segment goes first,
+        so crash in between leaves segment without ack which is replayed from start under the same tokens
+        :return:
+        """
+        for path in sorted(self.base_path.glob("worker-*")):
+            if path == self.path or not path.is_dir():
+                continue
+
+            fd: int = os.open(path / "lock", os.O_CREAT | os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+
+            try:
+                segments: List[Path] = sorted(path.glob(f"*{SEGMENT_SUFFIX}"))
+                for segment in segments:
+                    target: Path = self.path / f"{self._next_seq:012d}{SEGMENT_SUFFIX}"
+                    self._next_seq += 1
+                    # ack left by crash after its segment was replayed and removed
+                    target.with_suffix(ACK_SUFFIX).unlink(missing_ok=True)
+                    os.replace(segment, target)
+                    ack: Path = segment.with_suffix(ACK_SUFFIX)
+                    if ack.exists():
+                        os.replace(ack, target.with_suffix(ACK_SUFFIX))
+                if segments:
+                    logger.warning(f"Moved {len(segments)} segments of unclaimed spool {path} to {self.path}")
+            finally:
+                os.close(fd)
+
+    def _seal(self) -> None:
+        if self._active is None:
+            return
+        self._active.flush()
+        os.fsync(self._active.fileno())
+        self._active.close()
+        self._active = None
+        self._active_path = None
+
+    def _read_batch(
+            self, segment: Path, offset: int
+    ) -> Tuple[List[Tuple[str, List[RawMetricRow], int]], int, bool]:
+        """ read records from offset until replay_rows is reached
+        :param segment:
+        :param offset:
+        :return: (token, rows, offset after the record) of every record, offset after last read record,
+            segment end is reached
+        """
+        records: List[Tuple[str, List[RawMetricRow], int]] = []
+        rows: int = 0
+
+        with open(segment, "rb") as f:
+            f.seek(offset)
+            while rows < self.replay_rows:
+                header: bytes = f.read(RECORD_HEADER.size)
+                if not header:
+                    return records, offset, True
+
+                payload: Optional[bytes] = None
+                if len(header) == RECORD_HEADER.size:
+                    size, crc = RECORD_HEADER.unpack(header)
+                    payload = f.read(size)
+                    if len(payload) < size or zlib.crc32(payload) != crc:
+                        payload = None
+
+                if payload is None:
+                    # torn write on crash, nothing valid can follow in this segment
+                    self.corrupted_records += 1
+                    logger.error(f"Corrupted record in spool segment {segment.name} at {offset}, skip segment tail")
+                    return records, offset, True
+
+                token, record_rows = decode_payload(payload)
+                offset = f.tell()
+                records.append((token, record_rows, offset))
+                rows += len(record_rows)
+
+        return records, offset, False
+
+    @staticmethod
+    def _read_ack(segment: Path) -> int:
+        try:
+            return int(segment.with_suffix(ACK_SUFFIX).read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    @staticmethod
+    def _write_ack(segment: Path, offset: int) -> None:
+        ack: Path = segment.with_suffix(ACK_SUFFIX)
+        tmp: Path = ack.with_suffix(".tmp")
+        tmp.write_text(str(offset))
+        os.replace(tmp, ack)
+
+    async def _run(self) -> None:
+        backoff: float = self.replay_interval
+        while True:
+            await asyncio.sleep(backoff)
+
+            while self._segments:
+                if not await self.replay():
+                    backoff = min(backoff * 2, self.replay_interval * 12)
+                    break
+                backoff = self.replay_interval
+                # let ingest requests run between batches
+                await asyncio.sleep(0)
@@ -1,7 +1,16 @@
 from aiochclient import ChClient
-from fastapi import Request
+from fastapi import Header, HTTPException, Request
+from typing import Optional
 
+from config import settings
+from core.buffer import MetricsBuffer
 from core.db import MetricsReadRepository, MetricsWriteRepository
+from core.inventory import FleetInventory
+from core.range_cache import RangeCache
+from core.spool import MetricsSpool
+from src.schemas import Resolution
+
+import secrets
 
 
 def get_ch_client(request: Request) -> ChClient:
@@ -12,12 +21,63 @@ def get_ch_client(request: Request) -> ChClient:
     return request.app.state.ch_client
 
 
+def verify_admin_token(x_admin_token: Optional[str] = Header(default=None)) -> None:
+    """ Allow admin endpoint only with X-Admin-Token equal to admin_token setting
+    :param x_admin_token:
+    :return:
+    """
+    if not settings.admin_token or not x_admin_token or not secrets.compare_digest(x_admin_token, settings.admin_token):
+        raise HTTPException(status_code=403, detail="Admin token is required")
+
+
 def get_write_repository(request: Request) -> MetricsWriteRepository:
     """ Get repository for write data to clickhouse
     :param request:
     :return:
     """
-    return MetricsWriteRepository(ch=request.app.state.ch_client)
+    return MetricsWriteRepository(
+        ch=request.app.state.ch_client,
+        buffer=request.app.state.metrics_buffer,
+        binary_writer=request.app.state.binary_writer,
+        spool=request.app.state.metrics_spool,
+        dedup=request.app.state.batch_dedup,
+        max_sample_age=settings.ingest_max_sample_age,
+        max_future_skew=settings.ingest_max_future_skew,
+        reject_late=settings.ingest_late_data_policy == "reject",
+        snapshot=request.app.state.latest_snapshot
+    )
+
+
+def get_metrics_buffer(request: Request) -> Optional[MetricsBuffer]:
+    """ Get ingest buffer, None if buffered write mode is disabled
+    :param request:
+    :return:
+    """
+    return request.app.state.metrics_buffer
+
+
+def get_metrics_spool(request: Request) -> Optional[MetricsSpool]:
+    """ Get ingest spool, None if spool is disabled
+    :param request:
+    :return:
+    """
+    return request.app.state.metrics_spool
+
+
+def get_range_cache(request: Request) -> Optional[RangeCache]:
+    """ Get /metrics series chunk cache, None if it is disabled
+    :param request:
+    :return:
+    """
+    return request.app.state.range_cache
+
+
+def get_fleet_inventory(request: Request) -> Optional[FleetInventory]:
+    """ Get in-process copy of fleet inventory, None if it is disabled
+    :param request:
+    :return:
+    """
+    return request.app.state.fleet_inventory
 
 
 def get_read_repository(request: Request) -> MetricsReadRepository:
@@ -25,4 +85,16 @@ def get_read_repository(request: Request) -> MetricsReadRepository:
     :param request:
     :return:
     """
-    return MetricsReadRepository(ch=request.app.state.ch_client)
+    return MetricsReadRepository(
+        ch=request.app.state.ch_client,
+        range_cache=request.app.state.range_cache,
+        snapshot=request.app.state.latest_snapshot,
+        server_side_trend=settings.trend_server_side,
+        retention_days={
+            Resolution.m1: settings.retention_1m_days,
+            Resolution.m5: settings.retention_5m_days,
+            Resolution.h1: settings.retention_1h_days,
+            Resolution.d1: settings.retention_1d_days,
+        },
+        inventory=request.app.state.fleet_inventory
+    )
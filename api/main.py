@@ -5,7 +5,15 @@ from fastapi.responses import JSONResponse
 from types import SimpleNamespace
 
 from config import settings, setup_logging
-from core.redis import connect_to_redis
+from core.buffer import MetricsBuffer
+from core.db import MetricsWriteRepository
+from core.dedup import BatchDeduplicator
+from core.inventory import FleetInventory
+from core.range_cache import RangeCache
+from core.redis import connect_to_redis, setup_cache_refresh, setup_local_cache
+from core.rowbinary import RowBinaryWriter
+from core.snapshot import LatestSnapshot
+from core.spool import MetricsSpool
 from src.views import router
 
 import logging
@@ -29,6 +37,79 @@ async def startup():
         password=settings.clickhouse_password,
         database=settings.clickhouse_db
     )
+
+    app.state.binary_writer = None
+    if settings.clickhouse_insert_format == "rowbinary":
+        app.state.binary_writer = RowBinaryWriter(
+            app.state.http_session,
+            url=settings.clickhouse_url,
+            user=settings.clickhouse_user,
+            password=settings.clickhouse_password,
+            database=settings.clickhouse_db,
+            compression=None if settings.clickhouse_insert_compression == "none" else settings.clickhouse_insert_compression
+        )
+
+    app.state.batch_dedup = BatchDeduplicator(ttl=settings.ingest_dedup_ttl) if settings.ingest_dedup_enabled else None
+
+    app.state.metrics_spool = None
+    if settings.spool_enabled:
+        app.state.metrics_spool = MetricsSpool(
+            path=settings.spool_path,
+            replay_func=MetricsWriteRepository(
+                ch=app.state.ch_client,
+                binary_writer=app.state.binary_writer
+            ).insert_rows,
+            segment_bytes=settings.spool_segment_bytes,
+            max_bytes=settings.spool_max_bytes,
+            replay_rows=settings.spool_replay_rows,
+            replay_interval=settings.spool_replay_interval,
+            fsync=settings.spool_fsync
+        )
+        await app.state.metrics_spool.start()
+
+    app.state.metrics_buffer = None
+    if settings.ingest_buffer_enabled:
+        app.state.metrics_buffer = MetricsBuffer(
+            flush_func=MetricsWriteRepository(
+                ch=app.state.ch_client,
+                binary_writer=app.state.binary_writer,
+                spool=app.state.metrics_spool
+            ).write_rows,
+            max_rows=settings.ingest_buffer_max_rows,
+            max_age=settings.ingest_buffer_max_age,
+            capacity=settings.ingest_buffer_capacity
+        )
+        await app.state.metrics_buffer.start()
+
+    if settings.local_cache_enabled:
+        setup_local_cache(max_entries=settings.local_cache_max_entries, ttl=settings.local_cache_ttl)
+
+    app.state.latest_snapshot = None
+    if settings.snapshot_enabled:
+        app.state.latest_snapshot = LatestSnapshot(ttl=settings.snapshot_ttl)
+
+    app.state.range_cache = None
+    if settings.range_cache_enabled:
+        app.state.range_cache = RangeCache(
+            ttl=settings.range_cache_ttl,
+            settle=settings.range_cache_settle,
+            chunk_buckets=settings.range_cache_chunk_buckets
+        )
+
+    app.state.fleet_inventory = None
+    if settings.inventory_enabled:
+        app.state.fleet_inventory = FleetInventory(
+            ch=app.state.ch_client,
+            ttl=settings.inventory_ttl,
+            retention_days=settings.retention_inventory_days
+        )
+
+    setup_cache_refresh(
+        stale_ttl=settings.cache_stale_ttl,
+        lock_ttl=settings.cache_lock_ttl,
+        enabled=settings.cache_single_flight
+    )
+
     await connect_to_redis(
         host=settings.redis_host,
         port=settings.redis_port,
@@ -38,6 +119,10 @@ async def startup():
 
 @app.on_event("shutdown")
 async def shutdown():
+    if app.state.metrics_buffer is not None:
+        await app.state.metrics_buffer.stop()
+    if app.state.metrics_spool is not None:
+        await app.state.metrics_spool.stop()
     await app.state.http_session.close()
 
 
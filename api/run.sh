@@ -1,6 +1,8 @@
 #!/bin/bash
 echo 'Starting infra analytics api'
 sleep 0.1
+# once per container, not per worker
+python apply_retention.py
 gunicorn main:app \
   -k uvicorn.workers.UvicornWorker \
   -w $(nproc) \
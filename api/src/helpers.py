@@ -1,4 +1,18 @@
-from datetime import datetime
+from datetime import datetime, timezone
+from typing import Optional
+
+import zlib
+import zstandard
+
+
+def to_utc(ts: datetime) -> datetime:
+    """ naive UTC datetime with seconds precision, the only form of timestamps in queries and ClickHouse literals
+    :param ts:
+    :return:
+    """
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts.replace(microsecond=0)
 
 
 def calculate_delta(a: float, b: float) -> float:
@@ -26,3 +40,34 @@ def json_serializer(obj):
     if isinstance(obj, datetime):
         return obj.isoformat()
     raise TypeError(f"Type {type(obj)} not serializable")
+
+
+def decode_body(body: bytes, content_encoding: Optional[str], max_size: int) -> bytes:
+    """ decompress request body by Content-Encoding header
+    :param body:
+    :param content_encoding: identity, gzip, deflate or zstd
+    :param max_size: max decompressed size
+    :return:
+    """
+    encoding: str = (content_encoding or "identity").strip().lower()
+
+    if encoding == "identity":
+        data = body
+    elif encoding in ("gzip", "deflate"):
+        decompressor = zlib.decompressobj(wbits=47 if encoding == "gzip" else 15)
+        try:
+            data = decompressor.decompress(body, max_size + 1)
+        except zlib.error as e:
+            raise ValueError(f"Invalid {encoding} body: {e}")
+    elif encoding == "zstd":
+        try:
+            with zstandard.ZstdDecompressor().stream_reader(body) as reader:
+                data = reader.read(max_size + 1)
+        except zstandard.ZstdError as e:
+            raise ValueError(f"Invalid zstd body: {e}")
+    else:
+        raise ValueError(f"Unsupported content encoding {encoding}")
+
+    if len(data) > max_size:
+        raise ValueError(f"Body is larger than {max_size} bytes")
+    return data
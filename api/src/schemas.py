@@ -1,8 +1,17 @@
 from datetime import datetime
 from enum import Enum
-from pydantic import BaseModel, Field, RootModel, model_validator
+from pydantic import BaseModel, Field, RootModel, field_validator, model_validator
 
-from typing import Dict, List, Optional
+from typing import Any, ClassVar, Dict, List, NamedTuple, Optional, Tuple
+
+from src.helpers import to_utc
+
+import math
+
+
+# range of ClickHouse DateTime
+MIN_TIMESTAMP: int = 0
+MAX_TIMESTAMP: int = 2 ** 32 - 1
 
 
 class Metric(BaseModel):
@@ -11,12 +20,114 @@ class Metric(BaseModel):
     metric: str
     value: float
     tags: Dict[str, str] = Field(default={})
+    ts: Optional[datetime] = Field(default=None)
 
 
 class MetricBatch(RootModel[List[Metric]]):
     ...
 
 
+class BaseColumnarBatch(BaseModel):
+    """ Compact batch from one vm: host, vm and tags are sent once, samples as parallel arrays.
+    tag_ids optionally points every sample to tag_sets, those tags are merged over common tags
+    """
+    VALUE_COLUMNS: ClassVar[Tuple[str, ...]] = ()
+
+    host: str
+    vm: str
+    tags: Dict[str, str] = Field(default={})
+
+    metrics: List[str]
+    timestamps: Optional[List[float]] = Field(default=None)
+
+    tag_sets: List[Dict[str, str]] = Field(default=[])
+    tag_ids: Optional[List[int]] = Field(default=None)
+
+    batch_id: Optional[str] = Field(default=None, max_length=128)
+
+    @model_validator(mode="after")
+    def validate_columns(self):
+        size: int = len(self.metrics)
+
+        for column in self.VALUE_COLUMNS:
+            if len(getattr(self, column)) != size:
+                raise ValueError(f"metrics and {column} must have the same length")
+
+        if self.timestamps is not None and len(self.timestamps) != size:
+            raise ValueError("timestamps must have the same length as metrics")
+        if self.timestamps is not None and not all(
+                math.isfinite(t) and MIN_TIMESTAMP <= t <= MAX_TIMESTAMP for t in self.timestamps
+        ):
+            raise ValueError(f"timestamps must be finite unix timestamps in [{MIN_TIMESTAMP}, {MAX_TIMESTAMP}]")
+
+        if self.tag_ids is not None:
+            if len(self.tag_ids) != size:
+                raise ValueError("tag_ids must have the same length as metrics")
+            if self.tag_ids and (min(self.tag_ids) < 0 or max(self.tag_ids) >= len(self.tag_sets)):
+                raise ValueError("tag_ids must point to tag_sets")
+
+        return self
+
+
+class ColumnarMetricBatch(BaseColumnarBatch):
+    VALUE_COLUMNS: ClassVar[Tuple[str, ...]] = ("values",)
+
+    values: List[float]
+
+
+class AggregatedMetricBatch(BaseColumnarBatch):
+    """ Pre-aggregated samples: min/max/sum/count of every metric over a collector window
+    starting at timestamps, window must not cross minute boundary
+    """
+    VALUE_COLUMNS: ClassVar[Tuple[str, ...]] = ("mins", "maxs", "sums", "counts")
+    # window is at most a minute, a sample every 10 ms. Rollup views expand every row back to count values
+    MAX_COUNT: ClassVar[int] = 6000
+
+    timestamps: List[float]
+
+    mins: List[float]
+    maxs: List[float]
+    sums: List[float]
+    counts: List[int]
+
+    @model_validator(mode="after")
+    def validate_aggregates(self):
+        for min_v, max_v, sum_v, cnt in zip(self.mins, self.maxs, self.sums, self.counts):
+            if not 1 <= cnt <= self.MAX_COUNT:
+                raise ValueError(f"counts must be in [1, {self.MAX_COUNT}]")
+            if min_v > max_v:
+                raise ValueError("mins must not be greater than maxs")
+            # sum of cnt samples in [min, max], small tolerance for float rounding on collector
+            eps: float = 1e-9 * max(1.0, abs(sum_v))
+            if not min_v * cnt - eps <= sum_v <= max_v * cnt + eps:
+                raise ValueError("sums must be between mins * counts and maxs * counts")
+
+        return self
+
+
+class RawMetricRow(NamedTuple):
+    """ Row of infra.metrics_raw, date column is derived from ts on insert """
+    ts: datetime
+    host: str
+    vm: str
+    metric: str
+    value: float
+    tags: Dict[str, str]
+
+
+class AggregatedMetricRow(NamedTuple):
+    """ Row of infra.metrics_agg_raw """
+    ts: datetime
+    host: str
+    vm: str
+    metric: str
+    min_value: float
+    max_value: float
+    sum_value: float
+    cnt: int
+    tags: Dict[str, str]
+
+
 class Scope(str, Enum):
     vm: str = "vm"
     host: str = "host"
@@ -33,12 +144,71 @@ class Resolution(str, Enum):
     m1: str = "1m"
     m5: str = "5m"
     h1: str = "1h"
+    d1: str = "1d"
+
+
+RESOLUTION_SECONDS: Dict[Resolution, int] = {
+    Resolution.m1: 60,
+    Resolution.m5: 300,
+    Resolution.h1: 3600,
+    Resolution.d1: 86400,
+}
+
 
+class AutoResolution(str, Enum):
+    """ coarsest resolution which still gives max_points buckets over the query range """
+    auto: str = "auto"
 
-class MetricsQuery(BaseModel):
+
+class Stat(str, Enum):
+    """ bucket statistic, percentiles are read from t-digest states of rollups """
+    avg: str = "avg"
+    p50: str = "p50"
+    p95: str = "p95"
+    p99: str = "p99"
+
+
+class CacheNamespace(str, Enum):
+    """ key_prefix of cached read methods and namespace of series chunks """
+    metrics: str = "metrics"
+    series: str = "series"
+    latest: str = "latest"
+    top: str = "top"
+    bottom: str = "bottom"
+    extreme: str = "extreme"
+    cardinality: str = "cardinality"
+    compare: str = "compare"
+    trend: str = "trend"
+    trends: str = "trends"
+
+
+class UtcQuery(BaseModel):
+    """ timestamps of read query are naive UTC, so cache keys, ClickHouse literals and cached chunks agree """
+
+    @field_validator("*", mode="after")
+    @classmethod
+    def validate_utc(cls, value: Any) -> Any:
+        return to_utc(value) if isinstance(value, datetime) else value
+
+
+class TagFilterQuery(UtcQuery):
+    """ tag filter as key=value, samples which had this tag are read """
+    tag: Optional[str] = Field(default=None, pattern=r"^[\w.\-/]+=[^'\\]*$")
+
+
+class TagGroupQuery(TagFilterQuery):
+    """ tag filter and tag key to group results by, every group gets tag field with the tag value """
+    group_by_tag: Optional[str] = Field(default=None, pattern=r"^[\w.\-/]+$")
+
+
+class MetricsQuery(TagGroupQuery):
     metric: str
     scope: Scope
-    resolution: Resolution = Field(default=Resolution.m1)
+    resolution: Resolution | AutoResolution = Field(default=Resolution.m1)
+    # buckets are merged on the server so the series has at most max_points points
+    max_points: Optional[int] = Field(default=None, ge=1)
+    # percentile is returned with avg, min and max of every bucket
+    stat: Stat = Field(default=Stat.avg)
 
     host: Optional[str] = Field(default=None)
     vm: Optional[str] = Field(default=None)
@@ -47,7 +217,7 @@ class MetricsQuery(BaseModel):
     to_ts: datetime
 
 
-class LatestMetricsQuery(BaseModel):
+class LatestMetricsQuery(TagFilterQuery):
     metric: str
     scope: Scope
     resolution: Resolution = Field(default=Resolution.m1)
@@ -56,19 +226,23 @@ class LatestMetricsQuery(BaseModel):
     vm: Optional[str] = Field(default=None)
 
 
-class MetricsTopQuery(BaseModel):
+class MetricsTopQuery(TagGroupQuery):
     metric: str
     scope: Scope
     resolution: Resolution = Field(default=Resolution.m1)
     limit: int = 10
+    # hosts or vms are ranked by stat
+    stat: Stat = Field(default=Stat.avg)
 
     host: Optional[str] = Field(default=None)
 
 
-class MetricsCompareQuery(BaseModel):
+class MetricsCompareQuery(TagFilterQuery):
     metric: str
     scope: Scope
-    resolution: Resolution = Field(default=Resolution.m1)
+    resolution: Resolution | AutoResolution = Field(default=Resolution.m1)
+    # only picks the table with auto resolution, periods are aggregated whole
+    max_points: Optional[int] = Field(default=None, ge=1)
 
     from_a: datetime
     to_a: datetime
@@ -79,7 +253,7 @@ class MetricsCompareQuery(BaseModel):
     vm: Optional[str] = Field(default=None)
 
 
-class MetricsCardinalityQuery(BaseModel):
+class MetricsCardinalityQuery(TagFilterQuery):
     scope: CardinalityScope
     resolution: Resolution = Field(default=Resolution.m1)
 
@@ -87,10 +261,12 @@ class MetricsCardinalityQuery(BaseModel):
     to_ts: Optional[datetime] = Field(default=None)
 
 
-class MetricsTrendQuery(BaseModel):
+class MetricsTrendQuery(TagFilterQuery):
     metric: str
     scope: Scope
-    resolution: Resolution = Field(default=Resolution.m1)
+    resolution: Resolution | AutoResolution = Field(default=Resolution.m1)
+    # regression runs over at most max_points bucket averages
+    max_points: Optional[int] = Field(default=None, ge=1)
 
     from_ts: datetime
     to_ts: datetime
@@ -110,7 +286,29 @@ class MetricsTrendQuery(BaseModel):
         return self
 
 
-class MetricsBottomQuery(BaseModel):
+class MetricsTrendsQuery(TagGroupQuery):
+    """ trends of every vm of host (scope=host) or of every host (scope=global) """
+    metric: str
+    scope: Scope
+    resolution: Resolution = Field(default=Resolution.m1)
+
+    from_ts: datetime
+    to_ts: datetime
+
+    host: Optional[str] = Field(default=None)
+
+    @model_validator(mode="after")
+    def validate_scope(self):
+        if self.scope == Scope.vm:
+            raise ValueError("scope must be host or global")
+
+        if self.scope == Scope.host and not self.host:
+            raise ValueError("host is required when scope=host")
+
+        return self
+
+
+class MetricsBottomQuery(TagGroupQuery):
     metric: str
     scope: Scope
     resolution: Resolution = Field(default=Resolution.m1)
@@ -119,9 +317,24 @@ class MetricsBottomQuery(BaseModel):
     host: Optional[str] = Field(default=None)
 
 
-class MetricsExtremesQuery(BaseModel):
+class MetricsExtremesQuery(TagGroupQuery):
     resolution: Resolution = Resolution.m1
     limit: int = 5
 
     from_ts: datetime
     to_ts: datetime
+
+
+class InventoryQuery(BaseModel):
+    """ hosts, vms or metrics of the fleet inventory, filters narrow entities down to those which had them """
+    scope: CardinalityScope
+    host: Optional[str] = Field(default=None)
+    vm: Optional[str] = Field(default=None)
+    metric: Optional[str] = Field(default=None)
+
+
+class InventorySilentQuery(BaseModel):
+    """ hosts, vms or metrics without samples for more than seconds """
+    scope: CardinalityScope = Field(default=CardinalityScope.vm)
+    seconds: int = Field(default=300, ge=1)
+    host: Optional[str] = Field(default=None)
@@ -1,13 +1,25 @@
 from datetime import datetime
-from fastapi import APIRouter, Depends
-from typing import Any, Dict, List, Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+from typing import Any, Awaitable, Dict, List, Optional, Type, TypeVar
 
-from core.db import BaseMetricsReadRepository, BaseMetricsWriteRepository
-from dependencies import get_read_repository, get_write_repository
-from src.helpers import detect_direction
+from config import settings
+from core.buffer import BufferFullError, MetricsBuffer
+from core.db import BaseMetricsReadRepository, BaseMetricsWriteRepository, LateSamplesError
+from core.inventory import FleetInventory, InventoryNotLoadedError
+from core.range_cache import RangeCache
+from core.redis import get_cache_stats, invalidate_namespace
+from core.spool import MetricsSpool, SpoolFullError
+from dependencies import (
+    get_fleet_inventory, get_metrics_buffer, get_metrics_spool, get_range_cache, get_read_repository,
+    get_write_repository, verify_admin_token
+)
+from src.helpers import decode_body, detect_direction
 from src.schemas import (
-    MetricBatch, MetricsQuery, LatestMetricsQuery, MetricsTopQuery, MetricsCardinalityQuery, MetricsCompareQuery,
-    MetricsTrendQuery, MetricsBottomQuery, MetricsExtremesQuery
+    MetricBatch, BaseColumnarBatch, ColumnarMetricBatch, AggregatedMetricBatch, MetricsQuery, LatestMetricsQuery,
+    MetricsTopQuery, MetricsCardinalityQuery, MetricsCompareQuery, MetricsTrendQuery, MetricsTrendsQuery,
+    MetricsBottomQuery, MetricsExtremesQuery, InventoryQuery, InventorySilentQuery, CacheNamespace
 )
 
 import logging
@@ -17,6 +29,8 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+BatchModel = TypeVar("BatchModel", bound=BaseColumnarBatch)
+
 
 @router.get("/test")
 async def test() -> Dict[str, str]:
@@ -141,15 +155,191 @@ async def metrics_trend(
     }
 
 
+@router.get("/metrics/trends")
+async def metrics_trends(
+        query: MetricsTrendsQuery = Depends(),
+        repository: BaseMetricsReadRepository = Depends(get_read_repository)
+) -> List[Dict[str, str | float]]:
+    """ Get trends of every vm of host or of every host
+    :param query:
+    :param repository:
+    :return:
+    """
+    return [
+        {**trend, "direction": detect_direction(trend["slope"])}
+        for trend in await repository.get_trends_metrics(query=query)
+    ]
+
+
+@router.get("/inventory")
+async def inventory(
+        query: InventoryQuery = Depends(),
+        fleet_inventory: Optional[FleetInventory] = Depends(get_fleet_inventory)
+) -> List[Dict[str, str | datetime]]:
+    """ List hosts, vms or metrics with their first and last sample time
+    :param query:
+    :param fleet_inventory:
+    :return:
+    """
+    if fleet_inventory is None:
+        raise HTTPException(status_code=503, detail="Fleet inventory is disabled")
+    try:
+        return await fleet_inventory.list(query.scope.value, host=query.host, vm=query.vm, metric=query.metric)
+    except InventoryNotLoadedError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+@router.get("/inventory/silent")
+async def inventory_silent(
+        query: InventorySilentQuery = Depends(),
+        fleet_inventory: Optional[FleetInventory] = Depends(get_fleet_inventory)
+) -> List[Dict[str, str | datetime]]:
+    """ List hosts, vms or metrics without samples for more than query.seconds, the longest silent first
+    :param query:
+    :param fleet_inventory:
+    :return:
+    """
+    if fleet_inventory is None:
+        raise HTTPException(status_code=503, detail="Fleet inventory is disabled")
+    try:
+        return await fleet_inventory.silent(query.scope.value, query.seconds, host=query.host)
+    except InventoryNotLoadedError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+@router.get("/inventory/stats")
+async def inventory_stats(fleet_inventory: Optional[FleetInventory] = Depends(get_fleet_inventory)) -> Dict[str, Any]:
+    """ Get size and age of fleet inventory copy of this worker
+    :param fleet_inventory:
+    :return:
+    """
+    return {
+        "enabled": fleet_inventory is not None,
+        "inventory": fleet_inventory.stats() if fleet_inventory is not None else None,
+    }
+
+
 @router.post("/metrics")
 async def ingest(
-        metrics: MetricBatch,
+        request: Request,
+        x_batch_id: Optional[str] = Header(default=None, max_length=128),
+        repository: BaseMetricsWriteRepository = Depends(get_write_repository)
+) -> Dict[str, str]:
+    """ Add metric, body may be gzip, deflate or zstd encoded
+    :param request:
+    :param x_batch_id: collector assigned batch id, retried batches with the same id are skipped
+    :param repository:
+    :return:
+    """
+    metrics: MetricBatch = await _parse_body(request, MetricBatch)
+    return await _store_batch(repository.add_metric(data=metrics, batch_id=x_batch_id))
+
+
+@router.post("/metrics/columnar")
+async def ingest_columnar(
+        request: Request,
+        x_batch_id: Optional[str] = Header(default=None, max_length=128),
         repository: BaseMetricsWriteRepository = Depends(get_write_repository)
 ) -> Dict[str, str]:
-    """ Add metric
-    :param metrics:
+    """ Add compact columnar metric batch, body may be gzip, deflate or zstd encoded
+    :param request:
+    :param x_batch_id: collector assigned batch id, retried batches with the same id are skipped
     :param repository:
     :return:
     """
-    await repository.add_metric(data=metrics)
-    return {"status": "ok"}
+    metrics: ColumnarMetricBatch = await _parse_body(request, ColumnarMetricBatch)
+    return await _store_batch(repository.add_columnar_metric(data=metrics, batch_id=x_batch_id))
+
+
+@router.post("/metrics/aggregated")
+async def ingest_aggregated(
+        request: Request,
+        x_batch_id: Optional[str] = Header(default=None, max_length=128),
+        repository: BaseMetricsWriteRepository = Depends(get_write_repository)
+) -> Dict[str, str]:
+    """ Add batch of collector side pre-aggregated metrics (min/max/sum/count per window),
+    body may be gzip, deflate or zstd encoded
+    :param request:
+    :param x_batch_id: collector assigned batch id, retried batches with the same id are skipped
+    :param repository:
+    :return:
+    """
+    metrics: AggregatedMetricBatch = await _parse_body(request, AggregatedMetricBatch)
+    return await _store_batch(repository.add_aggregated_metric(data=metrics, batch_id=x_batch_id))
+
+
+async def _parse_body(request: Request, model: Type[BatchModel]) -> BatchModel:
+    """ decompress and validate request body
+    :param request:
+    :param model:
+    :return:
+    """
+    try:
+        body: bytes = decode_body(
+            await request.body(),
+            content_encoding=request.headers.get("content-encoding"),
+            max_size=settings.ingest_max_body_size
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        return model.model_validate_json(body)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+
+
+async def _store_batch(store: Awaitable[bool]) -> Dict[str, str]:
+    """ run repository add method and map ingest errors to http errors
+    :param store:
+    :return:
+    """
+    try:
+        stored: bool = await store
+    except LateSamplesError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except BufferFullError as e:
+        logger.warning(str(e))
+        raise HTTPException(status_code=503, detail="Ingest buffer is full")
+    except SpoolFullError as e:
+        logger.error(str(e))
+        raise HTTPException(status_code=503, detail="Ingest spool is full")
+    return {"status": "ok" if stored else "duplicate"}
+
+
+@router.get("/ingest/stats")
+async def ingest_stats(
+        buffer: Optional[MetricsBuffer] = Depends(get_metrics_buffer),
+        spool: Optional[MetricsSpool] = Depends(get_metrics_spool)
+) -> Dict[str, Any]:
+    """ Get ingest buffer and spool stats
+    :param buffer:
+    :param spool:
+    :return:
+    """
+    return {
+        "buffered": buffer is not None,
+        "buffer": buffer.stats() if buffer is not None else None,
+        "spool": spool.stats() if spool is not None else None,
+    }
+
+
+@router.get("/cache/stats")
+async def cache_stats(range_cache: Optional[RangeCache] = Depends(get_range_cache)) -> Dict[str, Any]:
+    """ Get hit/miss counters of in-process and redis cache tiers and series chunk cache of this worker
+    :param range_cache:
+    :return:
+    """
+    return {
+        **get_cache_stats(),
+        "range": range_cache.stats() if range_cache is not None else None,
+    }
+
+
+@router.post("/cache/invalidate", dependencies=[Depends(verify_admin_token)])
+async def cache_invalidate(namespace: CacheNamespace) -> Dict[str, str | int]:
+    """ Invalidate all cached results of namespace (metrics, latest, top, series, ...), needs X-Admin-Token
+    :param namespace:
+    :return:
+    """
+    return {"namespace": namespace.value, "version": await invalidate_namespace(namespace.value)}
@@ -0,0 +1,120 @@
+""" Compare periods: one -MergeIf scan for close periods gives the same avg, min, max as two single period
+queries, far apart periods are read by two queries.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Tuple
+
+from core.db import MetricsReadRepository, _compare_periods_sql, _periods_apart
+
+import asyncio
+import math
+import pytest
+import re
+
+
+START: datetime = datetime(2026, 1, 1)
+BOUNDS = re.compile(r"bucket >= toDateTime\('([^']+)'\) AND bucket <= toDateTime\('([^']+)'\)")
+
+Period = Tuple[datetime, datetime]
+
+
+def hours(start: int, end: int) -> Period:
+    return START + timedelta(hours=start), START + timedelta(hours=end)
+
+
+class FakeRollup:
+    """ Evaluates compare queries over buckets with one sample each: value of bucket i is i % 17 """
+
+    def __init__(self, buckets: int):
+        self.rows: List[Tuple[datetime, float]] = [
+            (START + timedelta(minutes=5 * i), float(i % 17)) for i in range(buckets)
+        ]
+        self.queries: List[str] = []
+
+    def aggregate(self, from_ts: str, to_ts: str) -> Dict[str, float]:
+        values: List[float] = [
+            value for bucket, value in self.rows
+            if datetime.fromisoformat(from_ts) <= bucket <= datetime.fromisoformat(to_ts)
+        ]
+        if not values:
+            return {"avg": math.nan, "min": 0.0, "max": 0.0}
+        return {"avg": sum(values) / len(values), "min": min(values), "max": max(values)}
+
+    async def fetch(self, sql: str) -> List[Dict[str, float]]:
+        self.queries.append(sql)
+        periods: List[Tuple[str, str]] = BOUNDS.findall(sql)
+        if "MergeIf" not in sql:
+            return [self.aggregate(*periods[0])]
+
+        # where clause ends with period a OR period b
+        row: Dict[str, float] = {}
+        for name, period in zip(("a", "b"), periods[-2:]):
+            row.update({f"{stat}_{name}": value for stat, value in self.aggregate(*period).items()})
+        return [row]
+
+
+def same(a: Dict[str, float], b: Dict[str, float]) -> bool:
+    return all(a[k] == b[k] or (math.isnan(a[k]) and math.isnan(b[k])) for k in ("avg", "min", "max"))
+
+
+@pytest.mark.parametrize(
+    "period_a, period_b, apart",
+    [
+        (hours(0, 24), hours(24, 48), False),  # adjacent
+        (hours(0, 24), hours(12, 36), False),  # overlapping
+        (hours(0, 24), hours(6, 12), False),  # nested
+        (hours(0, 24), hours(48, 72), False),  # gap equal to the longer period
+        (hours(0, 24), hours(49, 73), True),  # gap longer than the longer period
+        (hours(200, 224), hours(0, 24), True),  # far apart, b before a
+        (hours(0, 1), hours(48, 96), False),  # short and long period, gap shorter than the long one
+    ]
+)
+def test_periods_apart(period_a: Period, period_b: Period, apart: bool):
+    assert _periods_apart(period_a, period_b) is apart
+    assert _periods_apart(period_b, period_a) is apart
+
+
+def test_compare_periods_sql():
+    # aware bounds are converted to UTC literals
+    period_a: Period = (datetime(2026, 1, 1, 3, tzinfo=timezone(timedelta(hours=3))), datetime(2026, 1, 1, 6))
+    sql: str = _compare_periods_sql("infra.metrics_5m", "bucket", ["metric = 'cpu_usage'"], period_a, hours(6, 12))
+
+    a: Tuple[str, str] = ("2026-01-01 00:00:00", "2026-01-01 06:00:00")
+    b: Tuple[str, str] = ("2026-01-01 06:00:00", "2026-01-01 12:00:00")
+    # sum, count, min, max of every period, then both periods in the where clause
+    assert BOUNDS.findall(sql) == [a] * 4 + [b] * 4 + [a, b]
+
+    for name in ("a", "b"):
+        for stat in ("avg", "min", "max"):
+            assert f"AS {stat}_{name}" in sql
+    for combinator in ("sumMergeIf(sum_value", "countMergeIf(cnt_value", "minMergeIf(min_value", "maxMergeIf(max_value"):
+        assert sql.count(combinator) == 2
+    assert "FROM infra.metrics_5m" in sql
+    assert "metric = 'cpu_usage'\n            AND ((" in sql
+
+
+@pytest.mark.parametrize(
+    "period_a, period_b, queries",
+    [
+        (hours(0, 24), hours(24, 48), 1),  # adjacent
+        (hours(0, 24), hours(12, 36), 1),  # overlapping
+        (hours(30, 36), hours(0, 48), 1),  # nested
+        (hours(0, 24), hours(200, 224), 2),  # far apart
+        (hours(0, 24), hours(300, 310), 2),  # far apart, second period has no data
+    ]
+)
+def test_one_scan_matches_two_queries(period_a: Period, period_b: Period, queries: int):
+    async def run() -> None:
+        ch = FakeRollup(buckets=12 * 250)
+        repository = MetricsReadRepository(ch=ch)
+        where: List[str] = ["metric = 'cpu_usage'"]
+
+        a, b = await repository._aggregate_periods("infra.metrics_5m", "bucket", where, period_a, period_b)
+        assert len(ch.queries) == queries
+
+        expected_a = await repository._aggregate_period("infra.metrics_5m", "bucket", where, *period_a)
+        expected_b = await repository._aggregate_period("infra.metrics_5m", "bucket", where, *period_b)
+        assert same(a, expected_a)
+        assert same(b, expected_b)
+
+    asyncio.run(run())
@@ -0,0 +1,138 @@
+""" Failed inserts go to spool and are replayed under their own tokens, an insert which landed although
+the client saw an error is deduplicated on replay, so counts do not change.
+"""
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+from core.db import MetricsWriteRepository
+from core.dedup import make_insert_token
+from core.spool import MetricsSpool
+from src.schemas import RawMetricRow
+
+import asyncio
+import re
+
+
+class FakeClickHouse:
+    """ Raw table with insert_deduplication_token: a block with a seen token is skipped """
+
+    def __init__(self):
+        self.rows: List[Dict[str, Any]] = []
+        self.tokens: Set[str] = set()
+        self.down: bool = False
+        self.lost_reply: bool = False
+
+    async def execute(self, sql: str, rows: List[Dict[str, Any]]) -> None:
+        if self.down:
+            raise ConnectionError("ClickHouse is down")
+
+        match: Optional[re.Match] = re.search(r"insert_deduplication_token = '(\w+)'", sql)
+        token: Optional[str] = match.group(1) if match else None
+        if token is None or token not in self.tokens:
+            self.rows.extend(rows)
+            if token is not None:
+                self.tokens.add(token)
+
+        if self.lost_reply:
+            # insert is committed, the client gets a timeout
+            raise asyncio.TimeoutError()
+
+
+def make_rows(host: str, count: int) -> List[RawMetricRow]:
+    start: datetime = datetime(2026, 1, 1)
+    return [RawMetricRow(start + timedelta(seconds=i), host, "vm-1", "cpu_usage", 0.5, {}) for i in range(count)]
+
+
+async def make_repository(ch: FakeClickHouse, path: Path, replay_rows: int = 50000) -> MetricsWriteRepository:
+    spool = MetricsSpool(
+        path=str(path),
+        replay_func=MetricsWriteRepository(ch=ch).insert_rows,
+        replay_rows=replay_rows,
+        replay_interval=3600,
+    )
+    await spool.start()
+    return MetricsWriteRepository(ch=ch, spool=spool)
+
+
+async def replay_all(spool: MetricsSpool) -> None:
+    while spool.stats()["segments"]:
+        assert await spool.replay()
+
+
+def test_landed_insert_is_not_counted_twice(tmp_path: Path):
+    async def run() -> None:
+        ch = FakeClickHouse()
+        repository = await make_repository(ch, tmp_path)
+
+        landed: List[RawMetricRow] = make_rows("landed", 10)
+        ch.lost_reply = True
+        await repository.write_rows(landed, make_insert_token(landed, "landed/1"))
+        ch.lost_reply = False
+
+        lost: List[RawMetricRow] = make_rows("lost", 7)
+        ch.down = True
+        await repository.write_rows(lost, make_insert_token(lost, "lost/1"))
+        ch.down = False
+
+        assert len(ch.rows) == 10
+        assert not repository.spool.healthy
+
+        await replay_all(repository.spool)
+        await repository.spool.stop()
+
+        assert len(ch.rows) == 17
+        assert sum(1 for row in ch.rows if row["host"] == "landed") == 10
+        assert sum(1 for row in ch.rows if row["host"] == "lost") == 7
+        assert repository.spool.healthy
+
+    asyncio.run(run())
+
+
+def test_replay_after_failure_keeps_tokens(tmp_path: Path):
+    async def run() -> None:
+        ch = FakeClickHouse()
+        repository = await make_repository(ch, tmp_path, replay_rows=5)
+
+        ch.down = True
+        for i in range(3):
+            rows: List[RawMetricRow] = make_rows(f"host-{i}", 5)
+            await repository.write_rows(rows, make_insert_token(rows, f"host-{i}/1"))
+
+        ch.down = False
+        assert await repository.spool.replay()
+        # the second record lands, the reply is lost: it stays unacked and is replayed again
+        ch.lost_reply = True
+        assert not await repository.spool.replay()
+        ch.lost_reply = False
+
+        await replay_all(repository.spool)
+        await repository.spool.stop()
+
+        assert len(ch.rows) == 15
+        assert repository.spool.stats()["replayed_rows"] == 15
+
+    asyncio.run(run())
+
+
+def test_replay_of_spool_left_by_crash(tmp_path: Path):
+    async def run() -> None:
+        ch = FakeClickHouse()
+        repository = await make_repository(ch, tmp_path)
+
+        ch.down = True
+        rows: List[RawMetricRow] = make_rows("crashed", 10)
+        await repository.write_rows(rows, make_insert_token(rows, "crashed/1"))
+        ch.down = False
+
+        # replay inserts, the worker dies before the segment is removed
+        await MetricsWriteRepository(ch=ch).insert_rows(rows, make_insert_token(rows, "crashed/1"))
+        await repository.spool.stop()
+
+        restarted = await make_repository(ch, tmp_path)
+        await replay_all(restarted.spool)
+        await restarted.spool.stop()
+
+        assert len(ch.rows) == 10
+
+    asyncio.run(run())
@@ -8,12 +8,14 @@ CREATE TABLE infra.metrics_raw_local ON CLUSTER infra_cluster
     vm String,
     metric LowCardinality(String),
     value Float64,
-    tags Map(String, String)
+    tags Map(String, String),
+    tag_set UInt64 MATERIALIZED if(empty(tags), 0, cityHash64(toString(mapSort(tags))))
 )
 ENGINE = MergeTree
 PARTITION BY date
 ORDER BY (metric, host, vm, ts)
-TTL ts + INTERVAL 2 DAY;
+TTL ts + INTERVAL 2 DAY
+SETTINGS non_replicated_deduplication_window = 1000;
 
 CREATE TABLE infra.metrics_raw ON CLUSTER infra_cluster
 AS infra.metrics_raw_local
@@ -24,22 +26,35 @@ ENGINE = Distributed(
     cityHash64(vm)
 );
 
+-- Rollup TTLs below are defaults, API replaces them from retention_* settings on startup.
+-- Storage policy 'tiered' (config.d/storage.xml) lets TTL move old parts to the cold volume.
+-- q_value is t-digest of p50/p95/p99, every rollup level merges digests of the level below.
+-- Reads without host go to projections: p_metric_time serves global scope and extremes (metric and time
+-- filters only), p_cardinality serves uniq counts without metric. idx_vm skips granules for vm without host.
 CREATE TABLE infra.metrics_1m_local ON CLUSTER infra_cluster (
     date Date,
     minute DateTime,
     host String,
     vm String,
     metric LowCardinality(String),
+    tag_set UInt64,
 
     avg_value AggregateFunction(avg, Float64),
     min_value AggregateFunction(min, Float64),
     max_value AggregateFunction(max, Float64),
     sum_value AggregateFunction(sum, Float64),
-    cnt_value AggregateFunction(count)
+    cnt_value AggregateFunction(count),
+    q_value AggregateFunction(quantilesTDigest(0.5, 0.95, 0.99), Float64),
+
+    INDEX idx_vm vm TYPE bloom_filter(0.01) GRANULARITY 4,
+    PROJECTION p_metric_time (SELECT * ORDER BY metric, minute),
+    PROJECTION p_cardinality (SELECT minute, uniq(vm), uniq(host), uniq(metric) GROUP BY minute)
 ) ENGINE = AggregatingMergeTree()
 PARTITION BY date
-ORDER BY (metric, host, vm, minute)
-TTL minute + INTERVAL 14 DAY;
+ORDER BY (metric, host, vm, minute, tag_set)
+TTL minute + INTERVAL 14 DAY
+SETTINGS non_replicated_deduplication_window = 1000, storage_policy = 'tiered',
+    ttl_only_drop_parts = 1, materialize_ttl_recalculate_only = 1, deduplicate_merge_projection_mode = 'rebuild';
 
 CREATE TABLE infra.metrics_1m ON CLUSTER infra_cluster
 AS infra.metrics_1m_local
@@ -60,19 +75,22 @@ SELECT
     host,
     vm,
     metric,
+    tag_set,
 
     avgState(value) AS avg_value,
     minState(value) AS min_value,
     maxState(value) AS max_value,
     sumState(value) AS sum_value,
-    countState()    AS cnt_value
+    countState()    AS cnt_value,
+    quantilesTDigestState(0.5, 0.95, 0.99)(value) AS q_value
 FROM infra.metrics_raw_local
 GROUP BY
     date,
     minute,
     host,
     vm,
-    metric;
+    metric,
+    tag_set;
 
 CREATE TABLE infra.metrics_5m_local ON CLUSTER infra_cluster (
     date Date,
@@ -80,41 +98,54 @@ CREATE TABLE infra.metrics_5m_local ON CLUSTER infra_cluster (
     host String,
     vm String,
     metric LowCardinality(String),
+    tag_set UInt64,
 
     avg_value AggregateFunction(avg, Float64),
     min_value AggregateFunction(min, Float64),
     max_value AggregateFunction(max, Float64),
     sum_value AggregateFunction(sum, Float64),
-    cnt_value AggregateFunction(count)
+    cnt_value AggregateFunction(count),
+    q_value AggregateFunction(quantilesTDigest(0.5, 0.95, 0.99), Float64),
+
+    INDEX idx_vm vm TYPE bloom_filter(0.01) GRANULARITY 4,
+    PROJECTION p_metric_time (SELECT * ORDER BY metric, bucket),
+    PROJECTION p_cardinality (SELECT bucket, uniq(vm), uniq(host), uniq(metric) GROUP BY bucket)
 )
 ENGINE = AggregatingMergeTree
 PARTITION BY date
-ORDER BY (metric, host, vm, bucket)
-TTL bucket + INTERVAL 14 DAY;
+ORDER BY (metric, host, vm, bucket, tag_set)
+TTL bucket + INTERVAL 60 DAY
+SETTINGS non_replicated_deduplication_window = 1000, storage_policy = 'tiered',
+    ttl_only_drop_parts = 1, materialize_ttl_recalculate_only = 1, deduplicate_merge_projection_mode = 'rebuild';
 
+-- 5m and 1h rollups are cascaded: 5m merges states of 1m blocks, 1h merges states of 5m blocks,
+-- so raw inserts are aggregated once and pre-aggregated ingest reaches them through 1m too.
 CREATE MATERIALIZED VIEW infra.mv_metrics_5m_local
     ON CLUSTER infra_cluster
 TO infra.metrics_5m_local
 AS
 SELECT
     date,
-    toStartOfFiveMinute(ts) AS bucket,
+    toStartOfFiveMinute(minute) AS bucket,
     host,
     vm,
     metric,
+    tag_set,
 
-    avgState(value) AS avg_value,
-    minState(value) AS min_value,
-    maxState(value) AS max_value,
-    sumState(value) AS sum_value,
-    countState()    AS cnt_value
-FROM infra.metrics_raw_local
+    avgMergeState(avg_value)   AS avg_value,
+    minMergeState(min_value)   AS min_value,
+    maxMergeState(max_value)   AS max_value,
+    sumMergeState(sum_value)   AS sum_value,
+    countMergeState(cnt_value) AS cnt_value,
+    quantilesTDigestMergeState(0.5, 0.95, 0.99)(q_value) AS q_value
+FROM infra.metrics_1m_local
 GROUP BY
     date,
     bucket,
     host,
     vm,
-    metric;
+    metric,
+    tag_set;
 
 CREATE TABLE infra.metrics_1h_local ON CLUSTER infra_cluster (
     date Date,
@@ -122,17 +153,25 @@ CREATE TABLE infra.metrics_1h_local ON CLUSTER infra_cluster (
     host String,
     vm String,
     metric LowCardinality(String),
+    tag_set UInt64,
 
     avg_value AggregateFunction(avg, Float64),
     min_value AggregateFunction(min, Float64),
     max_value AggregateFunction(max, Float64),
     sum_value AggregateFunction(sum, Float64),
-    cnt_value AggregateFunction(count)
+    cnt_value AggregateFunction(count),
+    q_value AggregateFunction(quantilesTDigest(0.5, 0.95, 0.99), Float64),
+
+    INDEX idx_vm vm TYPE bloom_filter(0.01) GRANULARITY 4,
+    PROJECTION p_metric_time (SELECT * ORDER BY metric, bucket),
+    PROJECTION p_cardinality (SELECT bucket, uniq(vm), uniq(host), uniq(metric) GROUP BY bucket)
 )
 ENGINE = AggregatingMergeTree
 PARTITION BY date
-ORDER BY (metric, host, vm, bucket)
-TTL bucket + INTERVAL 14 DAY;
+ORDER BY (metric, host, vm, bucket, tag_set)
+TTL bucket + INTERVAL 365 DAY
+SETTINGS non_replicated_deduplication_window = 1000, storage_policy = 'tiered',
+    ttl_only_drop_parts = 1, materialize_ttl_recalculate_only = 1, deduplicate_merge_projection_mode = 'rebuild';
 
 CREATE MATERIALIZED VIEW infra.mv_metrics_1h_local
     ON CLUSTER infra_cluster
@@ -140,20 +179,309 @@ TO infra.metrics_1h_local
 AS
 SELECT
     date,
-    toStartOfHour(ts) AS bucket,
+    toStartOfHour(bucket) AS bucket,
+    host,
+    vm,
+    metric,
+    tag_set,
+
+    avgMergeState(avg_value)   AS avg_value,
+    minMergeState(min_value)   AS min_value,
+    maxMergeState(max_value)   AS max_value,
+    sumMergeState(sum_value)   AS sum_value,
+    countMergeState(cnt_value) AS cnt_value,
+    quantilesTDigestMergeState(0.5, 0.95, 0.99)(q_value) AS q_value
+FROM infra.metrics_5m_local
+GROUP BY
+    date,
+    bucket,
+    host,
+    vm,
+    metric,
+    tag_set;
+
+-- Daily rollup for capacity planning over months, cascaded from 1h. Partitioned by month,
+-- so years of it stay a few dozen partitions.
+CREATE TABLE infra.metrics_1d_local ON CLUSTER infra_cluster (
+    date Date,
+    bucket DateTime,
+    host String,
+    vm String,
+    metric LowCardinality(String),
+    tag_set UInt64,
+
+    avg_value AggregateFunction(avg, Float64),
+    min_value AggregateFunction(min, Float64),
+    max_value AggregateFunction(max, Float64),
+    sum_value AggregateFunction(sum, Float64),
+    cnt_value AggregateFunction(count),
+    q_value AggregateFunction(quantilesTDigest(0.5, 0.95, 0.99), Float64),
+
+    INDEX idx_vm vm TYPE bloom_filter(0.01) GRANULARITY 4,
+    PROJECTION p_metric_time (SELECT * ORDER BY metric, bucket),
+    PROJECTION p_cardinality (SELECT bucket, uniq(vm), uniq(host), uniq(metric) GROUP BY bucket)
+)
+ENGINE = AggregatingMergeTree
+PARTITION BY toYYYYMM(date)
+ORDER BY (metric, host, vm, bucket, tag_set)
+TTL bucket + INTERVAL 1825 DAY
+SETTINGS non_replicated_deduplication_window = 1000, storage_policy = 'tiered',
+    ttl_only_drop_parts = 1, materialize_ttl_recalculate_only = 1, deduplicate_merge_projection_mode = 'rebuild';
+
+CREATE TABLE infra.metrics_1d ON CLUSTER infra_cluster
+AS infra.metrics_1d_local
+ENGINE = Distributed(
+    infra_cluster,
+    infra,
+    metrics_1d_local,
+    cityHash64(vm)
+);
+
+CREATE MATERIALIZED VIEW infra.mv_metrics_1d_local
+    ON CLUSTER infra_cluster
+TO infra.metrics_1d_local
+AS
+SELECT
+    date,
+    toStartOfDay(bucket) AS bucket,
+    host,
+    vm,
+    metric,
+    tag_set,
+
+    avgMergeState(avg_value)   AS avg_value,
+    minMergeState(min_value)   AS min_value,
+    maxMergeState(max_value)   AS max_value,
+    sumMergeState(sum_value)   AS sum_value,
+    countMergeState(cnt_value) AS cnt_value,
+    quantilesTDigestMergeState(0.5, 0.95, 0.99)(q_value) AS q_value
+FROM infra.metrics_1h_local
+GROUP BY
+    date,
+    bucket,
+    host,
+    vm,
+    metric,
+    tag_set;
+
+-- Collector side pre-aggregated samples: min/max/sum/count over a window inside one minute.
+-- Every row is expanded back to cnt values with the same min, max, sum and count
+-- (min, max and cnt - 2 copies of the mean of the rest), so rollup states merge
+-- exactly as if the samples were inserted to metrics_raw one by one. 5m and 1h are cascaded from 1m.
+-- Quantiles are the exception: the window keeps no distribution, its digest is of the expanded values.
+CREATE TABLE infra.metrics_agg_raw_local ON CLUSTER infra_cluster
+(
+    date Date,
+    ts DateTime,
+    host String,
+    vm String,
+    metric LowCardinality(String),
+    min_value Float64,
+    max_value Float64,
+    sum_value Float64,
+    cnt UInt32,
+    tags Map(String, String),
+    tag_set UInt64 MATERIALIZED if(empty(tags), 0, cityHash64(toString(mapSort(tags))))
+)
+ENGINE = MergeTree
+PARTITION BY date
+ORDER BY (metric, host, vm, ts)
+TTL ts + INTERVAL 2 DAY
+SETTINGS non_replicated_deduplication_window = 1000;
+
+CREATE TABLE infra.metrics_agg_raw ON CLUSTER infra_cluster
+AS infra.metrics_agg_raw_local
+ENGINE = Distributed(
+    infra_cluster,
+    infra,
+    metrics_agg_raw_local,
+    cityHash64(vm)
+);
+
+CREATE MATERIALIZED VIEW infra.mv_metrics_agg_1m_local
+    ON CLUSTER infra_cluster
+TO infra.metrics_1m_local
+AS
+SELECT
+    date,
+    toStartOfMinute(ts) AS minute,
     host,
     vm,
     metric,
+    tag_set,
 
     avgState(value) AS avg_value,
     minState(value) AS min_value,
     maxState(value) AS max_value,
     sumState(value) AS sum_value,
-    countState()    AS cnt_value
-FROM infra.metrics_raw_local
+    countState()    AS cnt_value,
+    quantilesTDigestState(0.5, 0.95, 0.99)(value) AS q_value
+FROM
+(
+    SELECT
+        date,
+        ts,
+        host,
+        vm,
+        metric,
+        tag_set,
+        arrayJoin(
+            if(
+                cnt = 1,
+                [sum_value],
+                arrayConcat(
+                    [min_value, max_value],
+                    arrayWithConstant(
+                        greatest(toInt64(cnt) - 2, 0),
+                        (sum_value - min_value - max_value) / greatest(toInt64(cnt) - 2, 1)
+                    )
+                )
+            )
+        ) AS value
+    FROM infra.metrics_agg_raw_local
+)
 GROUP BY
     date,
-    bucket,
+    minute,
+    host,
+    vm,
+    metric,
+    tag_set;
+
+-- Tags of raw samples are kept in rollups as tag_set, hash of the sorted tags map (0 without tags).
+-- tag_index lists tag sets by key and value, so tag filters are IN lookups of its primary key, and
+-- dictionary tag_values gives value of a key for tag set to group rollups by tag. Both are shard local:
+-- every shard resolves tag sets of its own rows, which are sharded by vm the same way as rollups.
+-- Tag sets not seen for retention_tag_index_days expire, older rollup rows then group under empty tag.
+CREATE TABLE infra.tag_index_local ON CLUSTER infra_cluster
+(
+    key LowCardinality(String),
+    value String,
+    tag_set UInt64,
+    last_seen DateTime
+)
+ENGINE = ReplacingMergeTree
+ORDER BY (key, value, tag_set)
+TTL last_seen + INTERVAL 365 DAY;
+
+CREATE MATERIALIZED VIEW infra.mv_tag_index_local
+    ON CLUSTER infra_cluster
+TO infra.tag_index_local
+AS
+SELECT
+    key,
+    value,
+    tag_set,
+    max(ts) AS last_seen
+FROM infra.metrics_raw_local
+ARRAY JOIN
+    mapKeys(tags) AS key,
+    mapValues(tags) AS value
+WHERE tag_set != 0
+GROUP BY
+    key,
+    value,
+    tag_set;
+
+CREATE MATERIALIZED VIEW infra.mv_tag_index_agg_local
+    ON CLUSTER infra_cluster
+TO infra.tag_index_local
+AS
+SELECT
+    key,
+    value,
+    tag_set,
+    max(ts) AS last_seen
+FROM infra.metrics_agg_raw_local
+ARRAY JOIN
+    mapKeys(tags) AS key,
+    mapValues(tags) AS value
+WHERE tag_set != 0
+GROUP BY
+    key,
+    value,
+    tag_set;
+
+CREATE DICTIONARY infra.tag_values ON CLUSTER infra_cluster
+(
+    tag_set UInt64,
+    key String,
+    value String
+)
+PRIMARY KEY tag_set, key
+SOURCE(CLICKHOUSE(QUERY 'SELECT DISTINCT tag_set, key, value FROM infra.tag_index_local'))
+LAYOUT(COMPLEX_KEY_HASHED())
+LIFETIME(MIN 30 MAX 60);
+
+-- Fleet inventory: first and last sample time of every (host, vm, metric), maintained on ingest.
+-- Dictionary inventory_dict keeps it in memory of every node, API reads it for cardinality and discovery
+-- instead of uniq() scans of rollups. Entities silent for retention_inventory_days expire.
+CREATE TABLE infra.inventory_local ON CLUSTER infra_cluster
+(
+    host String,
+    vm String,
+    metric LowCardinality(String),
+    first_seen SimpleAggregateFunction(min, DateTime),
+    last_seen SimpleAggregateFunction(max, DateTime)
+)
+ENGINE = AggregatingMergeTree
+ORDER BY (host, vm, metric)
+TTL last_seen + INTERVAL 30 DAY;
+
+CREATE TABLE infra.inventory ON CLUSTER infra_cluster
+AS infra.inventory_local
+ENGINE = Distributed(
+    infra_cluster,
+    infra,
+    inventory_local,
+    cityHash64(vm)
+);
+
+CREATE MATERIALIZED VIEW infra.mv_inventory_local
+    ON CLUSTER infra_cluster
+TO infra.inventory_local
+AS
+SELECT
+    host,
+    vm,
+    metric,
+    min(ts) AS first_seen,
+    max(ts) AS last_seen
+FROM infra.metrics_raw_local
+GROUP BY
+    host,
+    vm,
+    metric;
+
+CREATE MATERIALIZED VIEW infra.mv_inventory_agg_local
+    ON CLUSTER infra_cluster
+TO infra.inventory_local
+AS
+SELECT
+    host,
+    vm,
+    metric,
+    min(ts) AS first_seen,
+    max(ts) AS last_seen
+FROM infra.metrics_agg_raw_local
+GROUP BY
     host,
     vm,
     metric;
+
+CREATE DICTIONARY infra.inventory_dict ON CLUSTER infra_cluster
+(
+    host String,
+    vm String,
+    metric String,
+    first_seen DateTime,
+    last_seen DateTime
+)
+PRIMARY KEY host, vm, metric
+SOURCE(CLICKHOUSE(QUERY '
+    SELECT host, vm, metric, min(first_seen) AS first_seen, max(last_seen) AS last_seen
+    FROM infra.inventory
+    GROUP BY host, vm, metric
+'))
+LAYOUT(COMPLEX_KEY_HASHED())
+LIFETIME(MIN 10 MAX 30);
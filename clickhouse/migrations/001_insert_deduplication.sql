@@ -0,0 +1,15 @@
+-- Keep hashes of recent insert blocks, so inserts retried with the same
+-- insert_deduplication_token are skipped by raw table and by rollups
+-- (API sends deduplicate_blocks_in_dependent_materialized_views = 1).
+
+ALTER TABLE infra.metrics_raw_local ON CLUSTER infra_cluster
+    MODIFY SETTING non_replicated_deduplication_window = 1000;
+
+ALTER TABLE infra.metrics_1m_local ON CLUSTER infra_cluster
+    MODIFY SETTING non_replicated_deduplication_window = 1000;
+
+ALTER TABLE infra.metrics_5m_local ON CLUSTER infra_cluster
+    MODIFY SETTING non_replicated_deduplication_window = 1000;
+
+ALTER TABLE infra.metrics_1h_local ON CLUSTER infra_cluster
+    MODIFY SETTING non_replicated_deduplication_window = 1000;
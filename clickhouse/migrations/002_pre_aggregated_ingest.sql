@@ -0,0 +1,169 @@
+-- Collector side pre-aggregated samples: min/max/sum/count over a window inside one minute.
+-- Every row is expanded back to cnt values with the same min, max, sum and count
+-- (min, max and cnt - 2 copies of the mean of the rest), so rollup states merge
+-- exactly as if the samples were inserted to metrics_raw one by one.
+CREATE TABLE IF NOT EXISTS infra.metrics_agg_raw_local ON CLUSTER infra_cluster
+(
+    date Date,
+    ts DateTime,
+    host String,
+    vm String,
+    metric LowCardinality(String),
+    min_value Float64,
+    max_value Float64,
+    sum_value Float64,
+    cnt UInt32,
+    tags Map(String, String)
+)
+ENGINE = MergeTree
+PARTITION BY date
+ORDER BY (metric, host, vm, ts)
+TTL ts + INTERVAL 2 DAY
+SETTINGS non_replicated_deduplication_window = 1000;
+
+CREATE TABLE IF NOT EXISTS infra.metrics_agg_raw ON CLUSTER infra_cluster
+AS infra.metrics_agg_raw_local
+ENGINE = Distributed(
+    infra_cluster,
+    infra,
+    metrics_agg_raw_local,
+    cityHash64(vm)
+);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS infra.mv_metrics_agg_1m_local
+    ON CLUSTER infra_cluster
+TO infra.metrics_1m_local
+AS
+SELECT
+    date,
+    toStartOfMinute(ts) AS minute,
+    host,
+    vm,
+    metric,
+
+    avgState(value) AS avg_value,
+    minState(value) AS min_value,
+    maxState(value) AS max_value,
+    sumState(value) AS sum_value,
+    countState()    AS cnt_value
+FROM
+(
+    SELECT
+        date,
+        ts,
+        host,
+        vm,
+        metric,
+        arrayJoin(
+            if(
+                cnt = 1,
+                [sum_value],
+                arrayConcat(
+                    [min_value, max_value],
+                    arrayWithConstant(
+                        greatest(toInt64(cnt) - 2, 0),
+                        (sum_value - min_value - max_value) / greatest(toInt64(cnt) - 2, 1)
+                    )
+                )
+            )
+        ) AS value
+    FROM infra.metrics_agg_raw_local
+)
+GROUP BY
+    date,
+    minute,
+    host,
+    vm,
+    metric;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS infra.mv_metrics_agg_5m_local
+    ON CLUSTER infra_cluster
+TO infra.metrics_5m_local
+AS
+SELECT
+    date,
+    toStartOfFiveMinute(ts) AS bucket,
+    host,
+    vm,
+    metric,
+
+    avgState(value) AS avg_value,
+    minState(value) AS min_value,
+    maxState(value) AS max_value,
+    sumState(value) AS sum_value,
+    countState()    AS cnt_value
+FROM
+(
+    SELECT
+        date,
+        ts,
+        host,
+        vm,
+        metric,
+        arrayJoin(
+            if(
+                cnt = 1,
+                [sum_value],
+                arrayConcat(
+                    [min_value, max_value],
+                    arrayWithConstant(
+                        greatest(toInt64(cnt) - 2, 0),
+                        (sum_value - min_value - max_value) / greatest(toInt64(cnt) - 2, 1)
+                    )
+                )
+            )
+        ) AS value
+    FROM infra.metrics_agg_raw_local
+)
+GROUP BY
+    date,
+    bucket,
+    host,
+    vm,
+    metric;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS infra.mv_metrics_agg_1h_local
+    ON CLUSTER infra_cluster
+TO infra.metrics_1h_local
+AS
+SELECT
+    date,
+    toStartOfHour(ts) AS bucket,
+    host,
+    vm,
+    metric,
+
+    avgState(value) AS avg_value,
+    minState(value) AS min_value,
+    maxState(value) AS max_value,
+    sumState(value) AS sum_value,
+    countState()    AS cnt_value
+FROM
+(
+    SELECT
+        date,
+        ts,
+        host,
+        vm,
+        metric,
+        arrayJoin(
+            if(
+                cnt = 1,
+                [sum_value],
+                arrayConcat(
+                    [min_value, max_value],
+                    arrayWithConstant(
+                        greatest(toInt64(cnt) - 2, 0),
+                        (sum_value - min_value - max_value) / greatest(toInt64(cnt) - 2, 1)
+                    )
+                )
+            )
+        ) AS value
+    FROM infra.metrics_agg_raw_local
+)
+GROUP BY
+    date,
+    bucket,
+    host,
+    vm,
+    metric;
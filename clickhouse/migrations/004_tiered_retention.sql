@@ -0,0 +1,95 @@
+-- Tiered retention: daily rollup cascaded from 1h, rollups on 'tiered' storage policy
+-- (deploy config.d/storage.xml and restart ClickHouse first) and TTLs which drop whole parts.
+-- TTLs here are defaults, the API replaces them from retention_* settings on startup.
+-- Pause ingest or let the API spool it while this runs: 1d is backfilled from all of 1h,
+-- hours written between CREATE VIEW and the backfill would be counted twice.
+
+ALTER TABLE infra.metrics_1m_local ON CLUSTER infra_cluster
+    MODIFY SETTING storage_policy = 'tiered', ttl_only_drop_parts = 1, materialize_ttl_recalculate_only = 1;
+
+ALTER TABLE infra.metrics_5m_local ON CLUSTER infra_cluster
+    MODIFY SETTING storage_policy = 'tiered', ttl_only_drop_parts = 1, materialize_ttl_recalculate_only = 1;
+
+ALTER TABLE infra.metrics_1h_local ON CLUSTER infra_cluster
+    MODIFY SETTING storage_policy = 'tiered', ttl_only_drop_parts = 1, materialize_ttl_recalculate_only = 1;
+
+ALTER TABLE infra.metrics_5m_local ON CLUSTER infra_cluster
+    MODIFY TTL bucket + INTERVAL 60 DAY;
+
+ALTER TABLE infra.metrics_1h_local ON CLUSTER infra_cluster
+    MODIFY TTL bucket + INTERVAL 365 DAY;
+
+CREATE TABLE IF NOT EXISTS infra.metrics_1d_local ON CLUSTER infra_cluster (
+    date Date,
+    bucket DateTime,
+    host String,
+    vm String,
+    metric LowCardinality(String),
+
+    avg_value AggregateFunction(avg, Float64),
+    min_value AggregateFunction(min, Float64),
+    max_value AggregateFunction(max, Float64),
+    sum_value AggregateFunction(sum, Float64),
+    cnt_value AggregateFunction(count)
+)
+ENGINE = AggregatingMergeTree
+PARTITION BY toYYYYMM(date)
+ORDER BY (metric, host, vm, bucket)
+TTL bucket + INTERVAL 1825 DAY
+SETTINGS non_replicated_deduplication_window = 1000, storage_policy = 'tiered',
+    ttl_only_drop_parts = 1, materialize_ttl_recalculate_only = 1;
+
+CREATE TABLE IF NOT EXISTS infra.metrics_1d ON CLUSTER infra_cluster
+AS infra.metrics_1d_local
+ENGINE = Distributed(
+    infra_cluster,
+    infra,
+    metrics_1d_local,
+    cityHash64(vm)
+);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS infra.mv_metrics_1d_local
+    ON CLUSTER infra_cluster
+TO infra.metrics_1d_local
+AS
+SELECT
+    date,
+    toStartOfDay(bucket) AS bucket,
+    host,
+    vm,
+    metric,
+
+    avgMergeState(avg_value)   AS avg_value,
+    minMergeState(min_value)   AS min_value,
+    maxMergeState(max_value)   AS max_value,
+    sumMergeState(sum_value)   AS sum_value,
+    countMergeState(cnt_value) AS cnt_value
+FROM infra.metrics_1h_local
+GROUP BY
+    date,
+    bucket,
+    host,
+    vm,
+    metric;
+
+-- Backfill: run on every shard, 1h and 1d rows are sharded by vm the same way
+INSERT INTO infra.metrics_1d_local
+SELECT
+    date,
+    toStartOfDay(bucket) AS bucket,
+    host,
+    vm,
+    metric,
+
+    avgMergeState(avg_value)   AS avg_value,
+    minMergeState(min_value)   AS min_value,
+    maxMergeState(max_value)   AS max_value,
+    sumMergeState(sum_value)   AS sum_value,
+    countMergeState(cnt_value) AS cnt_value
+FROM infra.metrics_1h_local
+GROUP BY
+    date,
+    bucket,
+    host,
+    vm,
+    metric;
@@ -0,0 +1,176 @@
+-- t-digest states of p50/p95/p99 in every rollup, merged across rollup levels.
+-- Existing rows get empty digests, quantiles of buckets written before this migration are NULL
+-- in API responses. Pause ingest or let the API spool it while this runs:
+-- blocks inserted between DROP and CREATE of a view would miss that rollup.
+
+ALTER TABLE infra.metrics_1m_local ON CLUSTER infra_cluster
+    ADD COLUMN IF NOT EXISTS q_value AggregateFunction(quantilesTDigest(0.5, 0.95, 0.99), Float64);
+ALTER TABLE infra.metrics_1m ON CLUSTER infra_cluster
+    ADD COLUMN IF NOT EXISTS q_value AggregateFunction(quantilesTDigest(0.5, 0.95, 0.99), Float64);
+
+ALTER TABLE infra.metrics_5m_local ON CLUSTER infra_cluster
+    ADD COLUMN IF NOT EXISTS q_value AggregateFunction(quantilesTDigest(0.5, 0.95, 0.99), Float64);
+ALTER TABLE infra.metrics_5m ON CLUSTER infra_cluster
+    ADD COLUMN IF NOT EXISTS q_value AggregateFunction(quantilesTDigest(0.5, 0.95, 0.99), Float64);
+
+ALTER TABLE infra.metrics_1h_local ON CLUSTER infra_cluster
+    ADD COLUMN IF NOT EXISTS q_value AggregateFunction(quantilesTDigest(0.5, 0.95, 0.99), Float64);
+ALTER TABLE infra.metrics_1h ON CLUSTER infra_cluster
+    ADD COLUMN IF NOT EXISTS q_value AggregateFunction(quantilesTDigest(0.5, 0.95, 0.99), Float64);
+
+ALTER TABLE infra.metrics_1d_local ON CLUSTER infra_cluster
+    ADD COLUMN IF NOT EXISTS q_value AggregateFunction(quantilesTDigest(0.5, 0.95, 0.99), Float64);
+ALTER TABLE infra.metrics_1d ON CLUSTER infra_cluster
+    ADD COLUMN IF NOT EXISTS q_value AggregateFunction(quantilesTDigest(0.5, 0.95, 0.99), Float64);
+
+DROP VIEW IF EXISTS infra.mv_metrics_1m_local ON CLUSTER infra_cluster;
+CREATE MATERIALIZED VIEW infra.mv_metrics_1m_local
+    ON CLUSTER infra_cluster
+TO infra.metrics_1m_local
+AS
+SELECT
+    date,
+    toStartOfMinute(ts) AS minute,
+    host,
+    vm,
+    metric,
+
+    avgState(value) AS avg_value,
+    minState(value) AS min_value,
+    maxState(value) AS max_value,
+    sumState(value) AS sum_value,
+    countState()    AS cnt_value,
+    quantilesTDigestState(0.5, 0.95, 0.99)(value) AS q_value
+FROM infra.metrics_raw_local
+GROUP BY
+    date,
+    minute,
+    host,
+    vm,
+    metric;
+
+DROP VIEW IF EXISTS infra.mv_metrics_5m_local ON CLUSTER infra_cluster;
+CREATE MATERIALIZED VIEW infra.mv_metrics_5m_local
+    ON CLUSTER infra_cluster
+TO infra.metrics_5m_local
+AS
+SELECT
+    date,
+    toStartOfFiveMinute(minute) AS bucket,
+    host,
+    vm,
+    metric,
+
+    avgMergeState(avg_value)   AS avg_value,
+    minMergeState(min_value)   AS min_value,
+    maxMergeState(max_value)   AS max_value,
+    sumMergeState(sum_value)   AS sum_value,
+    countMergeState(cnt_value) AS cnt_value,
+    quantilesTDigestMergeState(0.5, 0.95, 0.99)(q_value) AS q_value
+FROM infra.metrics_1m_local
+GROUP BY
+    date,
+    bucket,
+    host,
+    vm,
+    metric;
+
+DROP VIEW IF EXISTS infra.mv_metrics_1h_local ON CLUSTER infra_cluster;
+CREATE MATERIALIZED VIEW infra.mv_metrics_1h_local
+    ON CLUSTER infra_cluster
+TO infra.metrics_1h_local
+AS
+SELECT
+    date,
+    toStartOfHour(bucket) AS bucket,
+    host,
+    vm,
+    metric,
+
+    avgMergeState(avg_value)   AS avg_value,
+    minMergeState(min_value)   AS min_value,
+    maxMergeState(max_value)   AS max_value,
+    sumMergeState(sum_value)   AS sum_value,
+    countMergeState(cnt_value) AS cnt_value,
+    quantilesTDigestMergeState(0.5, 0.95, 0.99)(q_value) AS q_value
+FROM infra.metrics_5m_local
+GROUP BY
+    date,
+    bucket,
+    host,
+    vm,
+    metric;
+
+DROP VIEW IF EXISTS infra.mv_metrics_1d_local ON CLUSTER infra_cluster;
+CREATE MATERIALIZED VIEW infra.mv_metrics_1d_local
+    ON CLUSTER infra_cluster
+TO infra.metrics_1d_local
+AS
+SELECT
+    date,
+    toStartOfDay(bucket) AS bucket,
+    host,
+    vm,
+    metric,
+
+    avgMergeState(avg_value)   AS avg_value,
+    minMergeState(min_value)   AS min_value,
+    maxMergeState(max_value)   AS max_value,
+    sumMergeState(sum_value)   AS sum_value,
+    countMergeState(cnt_value) AS cnt_value,
+    quantilesTDigestMergeState(0.5, 0.95, 0.99)(q_value) AS q_value
+FROM infra.metrics_1h_local
+GROUP BY
+    date,
+    bucket,
+    host,
+    vm,
+    metric;
+
+DROP VIEW IF EXISTS infra.mv_metrics_agg_1m_local ON CLUSTER infra_cluster;
+CREATE MATERIALIZED VIEW infra.mv_metrics_agg_1m_local
+    ON CLUSTER infra_cluster
+TO infra.metrics_1m_local
+AS
+SELECT
+    date,
+    toStartOfMinute(ts) AS minute,
+    host,
+    vm,
+    metric,
+
+    avgState(value) AS avg_value,
+    minState(value) AS min_value,
+    maxState(value) AS max_value,
+    sumState(value) AS sum_value,
+    countState()    AS cnt_value,
+    quantilesTDigestState(0.5, 0.95, 0.99)(value) AS q_value
+FROM
+(
+    SELECT
+        date,
+        ts,
+        host,
+        vm,
+        metric,
+        arrayJoin(
+            if(
+                cnt = 1,
+                [sum_value],
+                arrayConcat(
+                    [min_value, max_value],
+                    arrayWithConstant(
+                        greatest(toInt64(cnt) - 2, 0),
+                        (sum_value - min_value - max_value) / greatest(toInt64(cnt) - 2, 1)
+                    )
+                )
+            )
+        ) AS value
+    FROM infra.metrics_agg_raw_local
+)
+GROUP BY
+    date,
+    minute,
+    host,
+    vm,
+    metric;
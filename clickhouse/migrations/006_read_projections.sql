@@ -0,0 +1,53 @@
+-- Projections and skip index for reads without host filter, see MetricsReadRepository:
+-- p_metric_time (ORDER BY metric, time) serves global scope series, trend, compare and extremes,
+-- p_cardinality (uniq per time bucket) serves /metrics/cardinality, idx_vm serves vm lookups without host.
+-- MATERIALIZE rewrites existing parts in background mutations, new parts get them on insert.
+-- p_metric_time keeps a second copy of the rollup, check free disk space first.
+
+ALTER TABLE infra.metrics_1m_local ON CLUSTER infra_cluster
+    MODIFY SETTING deduplicate_merge_projection_mode = 'rebuild';
+ALTER TABLE infra.metrics_1m_local ON CLUSTER infra_cluster
+    ADD INDEX IF NOT EXISTS idx_vm vm TYPE bloom_filter(0.01) GRANULARITY 4;
+ALTER TABLE infra.metrics_1m_local ON CLUSTER infra_cluster
+    ADD PROJECTION IF NOT EXISTS p_metric_time (SELECT * ORDER BY metric, minute);
+ALTER TABLE infra.metrics_1m_local ON CLUSTER infra_cluster
+    ADD PROJECTION IF NOT EXISTS p_cardinality (SELECT minute, uniq(vm), uniq(host), uniq(metric) GROUP BY minute);
+ALTER TABLE infra.metrics_1m_local ON CLUSTER infra_cluster MATERIALIZE INDEX idx_vm;
+ALTER TABLE infra.metrics_1m_local ON CLUSTER infra_cluster MATERIALIZE PROJECTION p_metric_time;
+ALTER TABLE infra.metrics_1m_local ON CLUSTER infra_cluster MATERIALIZE PROJECTION p_cardinality;
+
+ALTER TABLE infra.metrics_5m_local ON CLUSTER infra_cluster
+    MODIFY SETTING deduplicate_merge_projection_mode = 'rebuild';
+ALTER TABLE infra.metrics_5m_local ON CLUSTER infra_cluster
+    ADD INDEX IF NOT EXISTS idx_vm vm TYPE bloom_filter(0.01) GRANULARITY 4;
+ALTER TABLE infra.metrics_5m_local ON CLUSTER infra_cluster
+    ADD PROJECTION IF NOT EXISTS p_metric_time (SELECT * ORDER BY metric, bucket);
+ALTER TABLE infra.metrics_5m_local ON CLUSTER infra_cluster
+    ADD PROJECTION IF NOT EXISTS p_cardinality (SELECT bucket, uniq(vm), uniq(host), uniq(metric) GROUP BY bucket);
+ALTER TABLE infra.metrics_5m_local ON CLUSTER infra_cluster MATERIALIZE INDEX idx_vm;
+ALTER TABLE infra.metrics_5m_local ON CLUSTER infra_cluster MATERIALIZE PROJECTION p_metric_time;
+ALTER TABLE infra.metrics_5m_local ON CLUSTER infra_cluster MATERIALIZE PROJECTION p_cardinality;
+
+ALTER TABLE infra.metrics_1h_local ON CLUSTER infra_cluster
+    MODIFY SETTING deduplicate_merge_projection_mode = 'rebuild';
+ALTER TABLE infra.metrics_1h_local ON CLUSTER infra_cluster
+    ADD INDEX IF NOT EXISTS idx_vm vm TYPE bloom_filter(0.01) GRANULARITY 4;
+ALTER TABLE infra.metrics_1h_local ON CLUSTER infra_cluster
+    ADD PROJECTION IF NOT EXISTS p_metric_time (SELECT * ORDER BY metric, bucket);
+ALTER TABLE infra.metrics_1h_local ON CLUSTER infra_cluster
+    ADD PROJECTION IF NOT EXISTS p_cardinality (SELECT bucket, uniq(vm), uniq(host), uniq(metric) GROUP BY bucket);
+ALTER TABLE infra.metrics_1h_local ON CLUSTER infra_cluster MATERIALIZE INDEX idx_vm;
+ALTER TABLE infra.metrics_1h_local ON CLUSTER infra_cluster MATERIALIZE PROJECTION p_metric_time;
+ALTER TABLE infra.metrics_1h_local ON CLUSTER infra_cluster MATERIALIZE PROJECTION p_cardinality;
+
+ALTER TABLE infra.metrics_1d_local ON CLUSTER infra_cluster
+    MODIFY SETTING deduplicate_merge_projection_mode = 'rebuild';
+ALTER TABLE infra.metrics_1d_local ON CLUSTER infra_cluster
+    ADD INDEX IF NOT EXISTS idx_vm vm TYPE bloom_filter(0.01) GRANULARITY 4;
+ALTER TABLE infra.metrics_1d_local ON CLUSTER infra_cluster
+    ADD PROJECTION IF NOT EXISTS p_metric_time (SELECT * ORDER BY metric, bucket);
+ALTER TABLE infra.metrics_1d_local ON CLUSTER infra_cluster
+    ADD PROJECTION IF NOT EXISTS p_cardinality (SELECT bucket, uniq(vm), uniq(host), uniq(metric) GROUP BY bucket);
+ALTER TABLE infra.metrics_1d_local ON CLUSTER infra_cluster MATERIALIZE INDEX idx_vm;
+ALTER TABLE infra.metrics_1d_local ON CLUSTER infra_cluster MATERIALIZE PROJECTION p_metric_time;
+ALTER TABLE infra.metrics_1d_local ON CLUSTER infra_cluster MATERIALIZE PROJECTION p_cardinality;
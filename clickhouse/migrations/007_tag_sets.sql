@@ -0,0 +1,278 @@
+-- Tag sets in rollups: raw tables get tag_set (hash of sorted tags), rollups group by it,
+-- tag_index and dictionary tag_values resolve tag filters and group by tag.
+-- Rollup rows written before this migration have tag_set 0 and match no tag filter.
+-- p_metric_time is recreated, SELECT * projection has to include the new column.
+-- Pause ingest or let the API spool it while this runs:
+-- blocks inserted between DROP and CREATE of a view would miss that rollup.
+
+ALTER TABLE infra.metrics_raw_local ON CLUSTER infra_cluster
+    ADD COLUMN IF NOT EXISTS tag_set UInt64 MATERIALIZED if(empty(tags), 0, cityHash64(toString(mapSort(tags))));
+ALTER TABLE infra.metrics_raw ON CLUSTER infra_cluster
+    ADD COLUMN IF NOT EXISTS tag_set UInt64 MATERIALIZED if(empty(tags), 0, cityHash64(toString(mapSort(tags))));
+ALTER TABLE infra.metrics_agg_raw_local ON CLUSTER infra_cluster
+    ADD COLUMN IF NOT EXISTS tag_set UInt64 MATERIALIZED if(empty(tags), 0, cityHash64(toString(mapSort(tags))));
+ALTER TABLE infra.metrics_agg_raw ON CLUSTER infra_cluster
+    ADD COLUMN IF NOT EXISTS tag_set UInt64 MATERIALIZED if(empty(tags), 0, cityHash64(toString(mapSort(tags))));
+
+ALTER TABLE infra.metrics_1m_local ON CLUSTER infra_cluster DROP PROJECTION IF EXISTS p_metric_time;
+ALTER TABLE infra.metrics_1m_local ON CLUSTER infra_cluster
+    ADD COLUMN IF NOT EXISTS tag_set UInt64 AFTER metric,
+    MODIFY ORDER BY (metric, host, vm, minute, tag_set);
+ALTER TABLE infra.metrics_1m_local ON CLUSTER infra_cluster
+    ADD PROJECTION IF NOT EXISTS p_metric_time (SELECT * ORDER BY metric, minute);
+ALTER TABLE infra.metrics_1m_local ON CLUSTER infra_cluster MATERIALIZE PROJECTION p_metric_time;
+ALTER TABLE infra.metrics_1m ON CLUSTER infra_cluster
+    ADD COLUMN IF NOT EXISTS tag_set UInt64 AFTER metric;
+
+ALTER TABLE infra.metrics_5m_local ON CLUSTER infra_cluster DROP PROJECTION IF EXISTS p_metric_time;
+ALTER TABLE infra.metrics_5m_local ON CLUSTER infra_cluster
+    ADD COLUMN IF NOT EXISTS tag_set UInt64 AFTER metric,
+    MODIFY ORDER BY (metric, host, vm, bucket, tag_set);
+ALTER TABLE infra.metrics_5m_local ON CLUSTER infra_cluster
+    ADD PROJECTION IF NOT EXISTS p_metric_time (SELECT * ORDER BY metric, bucket);
+ALTER TABLE infra.metrics_5m_local ON CLUSTER infra_cluster MATERIALIZE PROJECTION p_metric_time;
+ALTER TABLE infra.metrics_5m ON CLUSTER infra_cluster
+    ADD COLUMN IF NOT EXISTS tag_set UInt64 AFTER metric;
+
+ALTER TABLE infra.metrics_1h_local ON CLUSTER infra_cluster DROP PROJECTION IF EXISTS p_metric_time;
+ALTER TABLE infra.metrics_1h_local ON CLUSTER infra_cluster
+    ADD COLUMN IF NOT EXISTS tag_set UInt64 AFTER metric,
+    MODIFY ORDER BY (metric, host, vm, bucket, tag_set);
+ALTER TABLE infra.metrics_1h_local ON CLUSTER infra_cluster
+    ADD PROJECTION IF NOT EXISTS p_metric_time (SELECT * ORDER BY metric, bucket);
+ALTER TABLE infra.metrics_1h_local ON CLUSTER infra_cluster MATERIALIZE PROJECTION p_metric_time;
+ALTER TABLE infra.metrics_1h ON CLUSTER infra_cluster
+    ADD COLUMN IF NOT EXISTS tag_set UInt64 AFTER metric;
+
+ALTER TABLE infra.metrics_1d_local ON CLUSTER infra_cluster DROP PROJECTION IF EXISTS p_metric_time;
+ALTER TABLE infra.metrics_1d_local ON CLUSTER infra_cluster
+    ADD COLUMN IF NOT EXISTS tag_set UInt64 AFTER metric,
+    MODIFY ORDER BY (metric, host, vm, bucket, tag_set);
+ALTER TABLE infra.metrics_1d_local ON CLUSTER infra_cluster
+    ADD PROJECTION IF NOT EXISTS p_metric_time (SELECT * ORDER BY metric, bucket);
+ALTER TABLE infra.metrics_1d_local ON CLUSTER infra_cluster MATERIALIZE PROJECTION p_metric_time;
+ALTER TABLE infra.metrics_1d ON CLUSTER infra_cluster
+    ADD COLUMN IF NOT EXISTS tag_set UInt64 AFTER metric;
+
+DROP VIEW IF EXISTS infra.mv_metrics_1m_local ON CLUSTER infra_cluster;
+CREATE MATERIALIZED VIEW infra.mv_metrics_1m_local
+    ON CLUSTER infra_cluster
+TO infra.metrics_1m_local
+AS
+SELECT
+    date,
+    toStartOfMinute(ts) AS minute,
+    host,
+    vm,
+    metric,
+    tag_set,
+
+    avgState(value) AS avg_value,
+    minState(value) AS min_value,
+    maxState(value) AS max_value,
+    sumState(value) AS sum_value,
+    countState()    AS cnt_value,
+    quantilesTDigestState(0.5, 0.95, 0.99)(value) AS q_value
+FROM infra.metrics_raw_local
+GROUP BY
+    date,
+    minute,
+    host,
+    vm,
+    metric,
+    tag_set;
+
+DROP VIEW IF EXISTS infra.mv_metrics_5m_local ON CLUSTER infra_cluster;
+CREATE MATERIALIZED VIEW infra.mv_metrics_5m_local
+    ON CLUSTER infra_cluster
+TO infra.metrics_5m_local
+AS
+SELECT
+    date,
+    toStartOfFiveMinute(minute) AS bucket,
+    host,
+    vm,
+    metric,
+    tag_set,
+
+    avgMergeState(avg_value)   AS avg_value,
+    minMergeState(min_value)   AS min_value,
+    maxMergeState(max_value)   AS max_value,
+    sumMergeState(sum_value)   AS sum_value,
+    countMergeState(cnt_value) AS cnt_value,
+    quantilesTDigestMergeState(0.5, 0.95, 0.99)(q_value) AS q_value
+FROM infra.metrics_1m_local
+GROUP BY
+    date,
+    bucket,
+    host,
+    vm,
+    metric,
+    tag_set;
+
+DROP VIEW IF EXISTS infra.mv_metrics_1h_local ON CLUSTER infra_cluster;
+CREATE MATERIALIZED VIEW infra.mv_metrics_1h_local
+    ON CLUSTER infra_cluster
+TO infra.metrics_1h_local
+AS
+SELECT
+    date,
+    toStartOfHour(bucket) AS bucket,
+    host,
+    vm,
+    metric,
+    tag_set,
+
+    avgMergeState(avg_value)   AS avg_value,
+    minMergeState(min_value)   AS min_value,
+    maxMergeState(max_value)   AS max_value,
+    sumMergeState(sum_value)   AS sum_value,
+    countMergeState(cnt_value) AS cnt_value,
+    quantilesTDigestMergeState(0.5, 0.95, 0.99)(q_value) AS q_value
+FROM infra.metrics_5m_local
+GROUP BY
+    date,
+    bucket,
+    host,
+    vm,
+    metric,
+    tag_set;
+
+DROP VIEW IF EXISTS infra.mv_metrics_1d_local ON CLUSTER infra_cluster;
+CREATE MATERIALIZED VIEW infra.mv_metrics_1d_local
+    ON CLUSTER infra_cluster
+TO infra.metrics_1d_local
+AS
+SELECT
+    date,
+    toStartOfDay(bucket) AS bucket,
+    host,
+    vm,
+    metric,
+    tag_set,
+
+    avgMergeState(avg_value)   AS avg_value,
+    minMergeState(min_value)   AS min_value,
+    maxMergeState(max_value)   AS max_value,
+    sumMergeState(sum_value)   AS sum_value,
+    countMergeState(cnt_value) AS cnt_value,
+    quantilesTDigestMergeState(0.5, 0.95, 0.99)(q_value) AS q_value
+FROM infra.metrics_1h_local
+GROUP BY
+    date,
+    bucket,
+    host,
+    vm,
+    metric,
+    tag_set;
+
+DROP VIEW IF EXISTS infra.mv_metrics_agg_1m_local ON CLUSTER infra_cluster;
+CREATE MATERIALIZED VIEW infra.mv_metrics_agg_1m_local
+    ON CLUSTER infra_cluster
+TO infra.metrics_1m_local
+AS
+SELECT
+    date,
+    toStartOfMinute(ts) AS minute,
+    host,
+    vm,
+    metric,
+    tag_set,
+
+    avgState(value) AS avg_value,
+    minState(value) AS min_value,
+    maxState(value) AS max_value,
+    sumState(value) AS sum_value,
+    countState()    AS cnt_value,
+    quantilesTDigestState(0.5, 0.95, 0.99)(value) AS q_value
+FROM
+(
+    SELECT
+        date,
+        ts,
+        host,
+        vm,
+        metric,
+        tag_set,
+        arrayJoin(
+            if(
+                cnt = 1,
+                [sum_value],
+                arrayConcat(
+                    [min_value, max_value],
+                    arrayWithConstant(
+                        greatest(toInt64(cnt) - 2, 0),
+                        (sum_value - min_value - max_value) / greatest(toInt64(cnt) - 2, 1)
+                    )
+                )
+            )
+        ) AS value
+    FROM infra.metrics_agg_raw_local
+)
+GROUP BY
+    date,
+    minute,
+    host,
+    vm,
+    metric,
+    tag_set;
+
+CREATE TABLE IF NOT EXISTS infra.tag_index_local ON CLUSTER infra_cluster
+(
+    key LowCardinality(String),
+    value String,
+    tag_set UInt64
+)
+ENGINE = ReplacingMergeTree
+ORDER BY (key, value, tag_set);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS infra.mv_tag_index_local
+    ON CLUSTER infra_cluster
+TO infra.tag_index_local
+AS
+SELECT DISTINCT
+    key,
+    value,
+    tag_set
+FROM infra.metrics_raw_local
+ARRAY JOIN
+    mapKeys(tags) AS key,
+    mapValues(tags) AS value
+WHERE tag_set != 0;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS infra.mv_tag_index_agg_local
+    ON CLUSTER infra_cluster
+TO infra.tag_index_local
+AS
+SELECT DISTINCT
+    key,
+    value,
+    tag_set
+FROM infra.metrics_agg_raw_local
+ARRAY JOIN
+    mapKeys(tags) AS key,
+    mapValues(tags) AS value
+WHERE tag_set != 0;
+
+CREATE DICTIONARY IF NOT EXISTS infra.tag_values ON CLUSTER infra_cluster
+(
+    tag_set UInt64,
+    key String,
+    value String
+)
+PRIMARY KEY tag_set, key
+SOURCE(CLICKHOUSE(QUERY 'SELECT DISTINCT tag_set, key, value FROM infra.tag_index_local'))
+LAYOUT(COMPLEX_KEY_HASHED())
+LIFETIME(MIN 30 MAX 60);
+
+-- Backfill tag index from raw data which is still kept: run on every shard
+INSERT INTO infra.tag_index_local
+SELECT DISTINCT
+    key,
+    value,
+    tag_set
+FROM infra.metrics_raw_local
+ARRAY JOIN
+    mapKeys(tags) AS key,
+    mapValues(tags) AS value
+WHERE tag_set != 0;
@@ -0,0 +1,101 @@
+-- Fleet inventory: first and last sample time of every (host, vm, metric), maintained on ingest
+-- and kept in memory by dictionary inventory_dict for /metrics/cardinality and /inventory endpoints.
+
+CREATE TABLE IF NOT EXISTS infra.inventory_local ON CLUSTER infra_cluster
+(
+    host String,
+    vm String,
+    metric LowCardinality(String),
+    first_seen SimpleAggregateFunction(min, DateTime),
+    last_seen SimpleAggregateFunction(max, DateTime)
+)
+ENGINE = AggregatingMergeTree
+ORDER BY (host, vm, metric);
+
+CREATE TABLE IF NOT EXISTS infra.inventory ON CLUSTER infra_cluster
+AS infra.inventory_local
+ENGINE = Distributed(
+    infra_cluster,
+    infra,
+    inventory_local,
+    cityHash64(vm)
+);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS infra.mv_inventory_local
+    ON CLUSTER infra_cluster
+TO infra.inventory_local
+AS
+SELECT
+    host,
+    vm,
+    metric,
+    min(ts) AS first_seen,
+    max(ts) AS last_seen
+FROM infra.metrics_raw_local
+GROUP BY
+    host,
+    vm,
+    metric;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS infra.mv_inventory_agg_local
+    ON CLUSTER infra_cluster
+TO infra.inventory_local
+AS
+SELECT
+    host,
+    vm,
+    metric,
+    min(ts) AS first_seen,
+    max(ts) AS last_seen
+FROM infra.metrics_agg_raw_local
+GROUP BY
+    host,
+    vm,
+    metric;
+
+CREATE DICTIONARY IF NOT EXISTS infra.inventory_dict ON CLUSTER infra_cluster
+(
+    host String,
+    vm String,
+    metric String,
+    first_seen DateTime,
+    last_seen DateTime
+)
+PRIMARY KEY host, vm, metric
+SOURCE(CLICKHOUSE(QUERY '
+    SELECT host, vm, metric, min(first_seen) AS first_seen, max(last_seen) AS last_seen
+    FROM infra.inventory
+    GROUP BY host, vm, metric
+'))
+LAYOUT(COMPLEX_KEY_HASHED())
+LIFETIME(MIN 10 MAX 30);
+
+-- Backfill: run on every shard. first_seen comes from the daily rollup, which is kept longest,
+-- last_seen from the 1m rollup, inventory merges both with min and max.
+INSERT INTO infra.inventory_local
+SELECT
+    host,
+    vm,
+    metric,
+    min(bucket) AS first_seen,
+    max(bucket) AS last_seen
+FROM infra.metrics_1d_local
+GROUP BY
+    host,
+    vm,
+    metric;
+
+INSERT INTO infra.inventory_local
+SELECT
+    host,
+    vm,
+    metric,
+    min(minute) AS first_seen,
+    max(minute) AS last_seen
+FROM infra.metrics_1m_local
+GROUP BY
+    host,
+    vm,
+    metric;
+
+SYSTEM RELOAD DICTIONARY infra.inventory_dict ON CLUSTER infra_cluster;
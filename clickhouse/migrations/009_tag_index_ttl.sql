@@ -0,0 +1,54 @@
+-- Expiry of tag_index: tag sets get last sample time and are dropped when not seen for
+-- retention_tag_index_days (apply_retention.py replaces the default TTL below).
+-- Existing rows get the migration time as last_seen, so they expire one retention period from now.
+-- Pause ingest or let the API spool it while this runs:
+-- blocks inserted between DROP and CREATE of a view would miss the tag index.
+
+ALTER TABLE infra.tag_index_local ON CLUSTER infra_cluster
+    ADD COLUMN IF NOT EXISTS last_seen DateTime DEFAULT now();
+
+ALTER TABLE infra.tag_index_local ON CLUSTER infra_cluster
+    MATERIALIZE COLUMN last_seen;
+
+DROP VIEW IF EXISTS infra.mv_tag_index_local ON CLUSTER infra_cluster;
+CREATE MATERIALIZED VIEW infra.mv_tag_index_local
+    ON CLUSTER infra_cluster
+TO infra.tag_index_local
+AS
+SELECT
+    key,
+    value,
+    tag_set,
+    max(ts) AS last_seen
+FROM infra.metrics_raw_local
+ARRAY JOIN
+    mapKeys(tags) AS key,
+    mapValues(tags) AS value
+WHERE tag_set != 0
+GROUP BY
+    key,
+    value,
+    tag_set;
+
+DROP VIEW IF EXISTS infra.mv_tag_index_agg_local ON CLUSTER infra_cluster;
+CREATE MATERIALIZED VIEW infra.mv_tag_index_agg_local
+    ON CLUSTER infra_cluster
+TO infra.tag_index_local
+AS
+SELECT
+    key,
+    value,
+    tag_set,
+    max(ts) AS last_seen
+FROM infra.metrics_agg_raw_local
+ARRAY JOIN
+    mapKeys(tags) AS key,
+    mapValues(tags) AS value
+WHERE tag_set != 0
+GROUP BY
+    key,
+    value,
+    tag_set;
+
+ALTER TABLE infra.tag_index_local ON CLUSTER infra_cluster
+    MODIFY TTL last_seen + INTERVAL 365 DAY;
@@ -0,0 +1,6 @@
+-- Expiry of fleet inventory: hosts, vms and metrics without samples for retention_inventory_days
+-- are dropped from inventory_local and, on the next reload, from inventory_dict.
+-- TTL here is the default, apply_retention.py replaces it from retention_inventory_days.
+
+ALTER TABLE infra.inventory_local ON CLUSTER infra_cluster
+    MODIFY TTL last_seen + INTERVAL 30 DAY;
@@ -0,0 +1,208 @@
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import fcntl
+import json
+import logging
+import os
+import random
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# payload kinds: row per metric list for POST /metrics, columnar and aggregated batches
+ROWS = "rows"
+COLUMNAR = "columnar"
+AGGREGATED = "aggregated"
+
+
+def payload_size(kind: str, payload: Any) -> int:
+    """ Number of samples in payload
+    :param kind:
+    :param payload:
+    :return:
+    """
+    return len(payload) if kind == ROWS else len(payload["metrics"])
+
+
+class Backlog:
+    """ Bounded local file with batches which could not be sent. When the file is larger than max_bytes
+    the oldest batches are dropped. Backlog is uploaded oldest first in chunks of up to chunk_samples,
+    not more often than upload_interval and for up to upload_budget seconds, so a long catch-up is spread
+    over several calls from the sampling loop. Every batch is sent under its own batch id: a send which timed out
+    may have been stored, so the api must be able to skip it on replay.
+    Depth counters are kept in memory and re-read from the file only when another process changed it
+    """
+
+    def __init__(
+            self,
+            path: str | Path,
+            max_bytes: int,
+            chunk_samples: int,
+            upload_interval: float,
+            upload_budget: float = 1.0
+    ):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.chunk_samples = chunk_samples
+        self.upload_interval = upload_interval
+        self.upload_budget = upload_budget
+        self.next_upload: float = 0.0
+        # (mtime_ns, size) of the file the counters are valid for, batches, sample time of the oldest batch
+        self._depth: Optional[Tuple[Tuple[int, int], int, float]] = None
+
+    def append(self, kind: str, url: str, payload: Any, batch_id: str, ts: float) -> None:
+        """ Add unsent batch to backlog
+        :param kind:
+        :param url:
+        :param payload:
+        :param batch_id:
+        :param ts: sample time of batch
+        :return:
+        """
+        line: str = json.dumps({"kind": kind, "url": url, "batch_id": batch_id, "ts": ts, "payload": payload})
+        with self._locked():
+            depth: Optional[Tuple[int, float]] = self._known_depth()
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+            if depth is not None:
+                self._remember(depth[0] + 1, depth[1] if depth[0] else ts)
+
+            if self.path.stat().st_size > self.max_bytes:
+                entries: List[Dict[str, Any]] = self._read()
+                dropped: int = 0
+                size: int = sum(len(json.dumps(e)) + 1 for e in entries)
+                # free some room, so the file is not rewritten on every append
+                while entries and size > self.max_bytes * 0.9:
+                    size -= len(json.dumps(entries.pop(0))) + 1
+                    dropped += 1
+                self._write(entries)
+                self._remember(len(entries), entries[0]["ts"] if entries else 0.0)
+                logger.warning(f"Backlog is full, dropped {dropped} oldest batches")
+
+    def stats(self) -> Tuple[int, int, float]:
+        """ Backlog depth
+        :return: batches, bytes, age of the oldest batch in seconds
+        """
+        if not self.path.exists():
+            return 0, 0, 0.0
+
+        depth: Optional[Tuple[int, float]] = self._known_depth()
+        if depth is None:
+            # first call or the file was changed by another collector process
+            with self._locked():
+                entries: List[Dict[str, Any]] = self._read()
+                self._remember(len(entries), entries[0]["ts"] if entries else 0.0)
+            depth = (len(entries), entries[0]["ts"] if entries else 0.0)
+
+        batches, oldest_ts = depth
+        oldest_age: float = time.time() - oldest_ts if batches else 0.0
+        return batches, self.path.stat().st_size, max(0.0, oldest_age)
+
+    def upload(
+            self,
+            post: Callable[[str, str, Any, str], None],
+            is_retryable: Callable[[Exception], bool] = lambda e: True
+    ) -> bool:
+        """ Upload one chunk of the oldest batches if upload interval has passed, batch by batch
+        :param post: function(kind, url, payload, batch_id) which raises on failure
+        :param is_retryable: batch is dropped from backlog if upload error is not retryable
+        :return: False if upload failed
+        """
+        if time.monotonic() < self.next_upload or not self.path.exists():
+            return True
+        # jitter, so the fleet does not upload backlogs at the same moment after api recovery
+        self.next_upload = time.monotonic() + self.upload_interval * random.uniform(0.5, 1.5)
+
+        with self._locked():
+            entries: List[Dict[str, Any]] = self._read()
+            if not entries:
+                return True
+
+            deadline: float = time.monotonic() + self.upload_budget
+            done: int = 0
+            samples: int = 0
+            uploaded: bool = True
+            for entry in entries:
+                size: int = payload_size(entry["kind"], entry["payload"])
+                if done and (samples + size > self.chunk_samples or time.monotonic() >= deadline):
+                    break
+                try:
+                    post(entry["kind"], entry["url"], entry["payload"], entry["batch_id"])
+                except Exception as e:
+                    if is_retryable(e):
+                        logger.error(f"Upload backlog failed: {e}")
+                        uploaded = False
+                        break
+                    logger.error(f"Backlog batch {entry['batch_id']} rejected by api, drop it: {e}")
+                done += 1
+                samples += size
+
+            if done:
+                rest: List[Dict[str, Any]] = entries[done:]
+                self._write(rest)
+                self._remember(len(rest), rest[0]["ts"] if rest else 0.0)
+
+        if done:
+            logger.info(f"Uploaded {done} backlog batches, {samples} samples")
+        return uploaded
+
+    def _known_depth(self) -> Optional[Tuple[int, float]]:
+        """ counters if the file was not changed since they were taken
+        :return: batches, sample time of the oldest batch
+        """
+        if self._depth is None:
+            return None
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            return 0, 0.0
+        state, batches, oldest_ts = self._depth
+        return (batches, oldest_ts) if state == (st.st_mtime_ns, st.st_size) else None
+
+    def _remember(self, batches: int, oldest_ts: float) -> None:
+        st = self.path.stat()
+        self._depth = ((st.st_mtime_ns, st.st_size), batches, oldest_ts)
+
+    def _read(self) -> List[Dict[str, Any]]:
+        entries: List[Dict[str, Any]] = []
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # torn last line after crash
+                        logger.warning("Skip broken backlog line")
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _write(self, entries: List[Dict[str, Any]]) -> None:
+        tmp: Path = self.path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp, self.path)
+
+    def _locked(self) -> "_FileLock":
+        return _FileLock(self.path.with_suffix(".lock"))
+
+
+class _FileLock:
+    """ flock, cron runs of the collector may overlap with each other """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.fd: Optional[int] = None
+
+    def __enter__(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *args) -> None:
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
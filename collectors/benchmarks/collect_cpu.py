@@ -0,0 +1,47 @@
+""" Collector process cpu time per collect, per metric group. Optional groups which do not fit
+the cpu budget are skipped and reported.
+
+    python -m benchmarks.collect_cpu --cycles 100 --budget 0.05
+"""
+from typing import Dict, List
+
+from system_metrics import SystemMetrics
+
+import argparse
+import time
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cycles", type=int, default=100)
+    parser.add_argument("--interval", type=float, default=0.1, help="seconds between collects")
+    parser.add_argument("--budget", type=float, default=0.05, help="cpu seconds per collect")
+    args = parser.parse_args()
+
+    system = SystemMetrics(cpu_budget=args.budget)
+    system.prime()
+
+    costs: List[float] = []
+    group_costs: Dict[str, float] = {name: 0.0 for name in system.costs}
+    samples: int = 0
+    skipped: int = 0
+    for _ in range(args.cycles):
+        time.sleep(args.interval)
+        samples += len(system.collect())
+        costs.append(system.last_cost)
+        skipped += bool(system.skipped)
+        for name in group_costs:
+            if name not in system.skipped:
+                group_costs[name] += system.costs[name]
+
+    costs.sort()
+    print(f"samples/cycle    {samples / args.cycles:>10.1f}")
+    print(f"cpu ms/cycle avg {sum(costs) / len(costs) * 1000:>10.3f}")
+    print(f"cpu ms/cycle p99 {costs[int(len(costs) * 0.99) - 1] * 1000:>10.3f}")
+    print(f"over budget      {skipped:>10} cycles")
+    for name, cost in group_costs.items():
+        print(f"  {name:<14} {cost / args.cycles * 1000:>10.3f} ms/cycle")
+
+
+if __name__ == "__main__":
+    main()
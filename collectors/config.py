@@ -1,5 +1,6 @@
 from pathlib import Path
 from pydantic_settings import BaseSettings, SettingsConfigDict
+from typing import Optional
 
 import logging
 import sys
@@ -15,8 +16,29 @@ class Settings(BaseSettings):
     log_path: str = "app.log"
 
     api_url: str
+    columnar_api_url: Optional[str] = None
     host: str
 
+    # daemon mode: sample every interval seconds, first sample is delayed by random jitter up to interval
+    daemon: bool = False
+    interval: float = 60.0
+
+    # process cpu seconds per collect, optional metric groups (disk io, mounts) are skipped above it
+    cpu_budget: float = 0.05
+
+    # daemon mode: keep min/max/sum/count per metric and send them once per aggregate_window seconds
+    # to aggregated_api_url, window must divide a minute
+    aggregate_window: Optional[int] = None
+    aggregated_api_url: Optional[str] = None
+
+    # unsent batches are kept in backlog file and uploaded in chunks after api recovery,
+    # one upload posts for up to backlog_upload_budget seconds, so catch-up does not delay sampling
+    backlog_path: Path = BASE_DIR / "backlog.jsonl"
+    backlog_max_bytes: int = 16 * 1024 * 1024
+    backlog_chunk_samples: int = 5000
+    backlog_upload_interval: float = 5.0
+    backlog_upload_budget: float = 1.0
+
     model_config = SettingsConfigDict(
         env_file=BASE_DIR / ".env",
         env_file_encoding="utf-8",
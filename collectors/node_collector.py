@@ -1,82 +1,373 @@
-from typing import List, Dict, Any
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Optional, Tuple
+from backlog import AGGREGATED, COLUMNAR, ROWS, Backlog
 from config import settings, setup_logging
+from system_metrics import Sample, SystemMetrics
 
-import psutil
+import argparse
+import gzip
+import itertools
+import json
 import logging
+import random
 import requests
+import signal
 import socket
 import sys
+import threading
+import time
+import uuid
 
 
 setup_logging(log_level=settings.log_level, log_file=settings.log_path)
 logger = logging.getLogger(__name__)
 
 VM = socket.gethostname()
+RUN_ID = uuid.uuid4().hex[:8]
+# batch ids of this process, two samples of one second must not share an id
+SEND_SEQ = itertools.count()
 
+# keep-alive connection to api between sends in daemon mode
+session = requests.Session()
+stop_event = threading.Event()
 
-def collect_metrics() -> List[Dict[str, Any]]:
-    """ Collect system metrics
-    :return:
+backlog = Backlog(
+    path=settings.backlog_path,
+    max_bytes=settings.backlog_max_bytes,
+    chunk_samples=settings.backlog_chunk_samples,
+    upload_interval=settings.backlog_upload_interval,
+    upload_budget=settings.backlog_upload_budget
+)
+
+system = SystemMetrics(cpu_budget=settings.cpu_budget)
+
+
+def collect_metrics() -> List[Sample]:
+    """ Collect system metrics. Rates are measured since the previous call, see prime_cpu
+    :return: list of (metric, value, tags)
     """
     logger.debug("Collect metrics")
-    metrics: List[Dict[str, Any]] = [{
-        "host": settings.host,
-        "vm": VM,
-        "metric": "cpu_usage",
-        "value": psutil.cpu_percent(interval=None) / 100,
-        "tags": {}
-    }]
+    metrics: List[Sample] = system.collect()
+    metrics.append(("collector_cpu_seconds", system.last_cost, {}))
 
-    load1, load5, load15 = psutil.getloadavg()
+    batches, size, oldest_age = backlog.stats()
     metrics.extend([
-        {"host": settings.host, "vm": VM, "metric": "load_1", "value": load1, "tags": {}},
-        {"host": settings.host, "vm": VM, "metric": "load_5", "value": load5, "tags": {}},
-        {"host": settings.host, "vm": VM, "metric": "load_15", "value": load15, "tags": {}},
+        ("collector_backlog_batches", batches, {}),
+        ("collector_backlog_bytes", size, {}),
+        ("collector_backlog_oldest_age", oldest_age, {}),
     ])
 
-    mem = psutil.virtual_memory()
-    metrics.append({
-        "host": settings.host,
-        "vm": VM,
-        "metric": "ram_used_pct",
-        "value": mem.percent / 100,
-        "tags": {}
-    })
+    return metrics
+
+
+def prime_cpu() -> None:
+    """ First read of cpu times and io counters only caches them for rates of the next call
+    :return:
+    """
+    system.prime()
+
+
+def make_batch(metrics: List[Sample], ts: float) -> List[Dict[str, Any]]:
+    """ Make row per metric payload for POST /metrics
+    :param metrics:
+    :param ts: sample unix timestamp
+    :return:
+    """
+    sample_ts: str = datetime.fromtimestamp(ts, tz=timezone.utc).isoformat()
+    return [
+        {"host": settings.host, "vm": VM, "metric": metric, "value": value, "tags": tags, "ts": sample_ts}
+        for metric, value, tags in metrics
+    ]
+
+
+def encode_tags(tags_list: List[Dict[str, str]]) -> Tuple[List[Dict[str, str]], List[int]]:
+    """ Dictionary encode tags column: distinct tag sets and index of tag set for every sample
+    :param tags_list:
+    :return:
+    """
+    tag_sets: List[Dict[str, str]] = []
+    tag_ids: List[int] = []
+    for tags in tags_list:
+        if tags not in tag_sets:
+            tag_sets.append(tags)
+        tag_ids.append(tag_sets.index(tags))
+    return tag_sets, tag_ids
 
-    disk = psutil.disk_usage("/")
-    metrics.append({
+
+def make_columnar_batch(metrics: List[Sample], ts: float) -> Dict[str, Any]:
+    """ Make compact payload for POST /metrics/columnar, distinct tag sets are sent once
+    :param metrics:
+    :param ts: sample unix timestamp
+    :return:
+    """
+    tag_sets, tag_ids = encode_tags([tags for _, _, tags in metrics])
+
+    return {
         "host": settings.host,
         "vm": VM,
-        "metric": "disk_used_pct",
-        "value": disk.percent / 100,
-        "tags": {"mount": "/"}
-    })
+        "metrics": [metric for metric, _, _ in metrics],
+        "values": [value for _, value, _ in metrics],
+        "timestamps": [int(ts)] * len(metrics),
+        "tag_sets": tag_sets,
+        "tag_ids": tag_ids,
+    }
 
-    return metrics
 
+def post(url: str, payload: Any, batch_id: str) -> None:
+    """ Post gzipped json payload to api, raise on failure
+    :param url:
+    :param payload:
+    :param batch_id: same batch id for every retry, api skips batches it has already stored
+    :return:
+    """
+    headers: Dict[str, str] = {
+        "Content-Type": "application/json",
+        "Content-Encoding": "gzip",
+        "X-Batch-Id": batch_id,
+    }
+    data: bytes = gzip.compress(json.dumps(payload).encode())
 
-def send(metrics: List[Dict[str, Any]]):
-    """ Send metrics to analytics api
-    :param metrics:
+    response = session.post(url, data=data, headers=headers, timeout=3)
+    response.raise_for_status()
+
+
+def is_retryable(error: Exception) -> bool:
+    """ Batch rejected by api as invalid is not worth keeping in backlog
+    :param error:
+    :return:
+    """
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status: int = error.response.status_code
+        return status >= 500 or status in (408, 429)
+    return True
+
+
+def deliver(kind: str, url: str, payload: Any, batch_id: str, ts: float) -> None:
+    """ Send batch, keep it in backlog if api is unreachable. After successful send upload part of backlog
+    :param kind: backlog payload kind
+    :param url:
+    :param payload:
+    :param batch_id:
+    :param ts: sample time
     :return:
     """
-    logger.info("Send metrics")
     try:
-        requests.post(settings.api_url, json=metrics, timeout=3)
+        post(url, payload, batch_id)
     except Exception as e:
-        logger.error(f"Send metrics failed: {e}")
+        if not is_retryable(e):
+            logger.error(f"Batch {batch_id} rejected by api: {e}")
+            return
+        logger.error(f"Send batch {batch_id} failed, keep it in backlog: {e}")
+        backlog.append(kind, url, payload, batch_id, ts)
+        return
+
+    backlog.upload(lambda k, u, p, b: post(u, p, b), is_retryable)
+
+
+def send(metrics: List[Sample], ts: float):
+    """ Send metrics to analytics api, columnar payload if columnar api url is set
+    :param metrics:
+    :param ts: sample unix timestamp
+    :return:
+    """
+    logger.info("Send metrics")
+    batch_id: str = f"{settings.host}/{VM}/{RUN_ID}/{next(SEND_SEQ)}/{int(ts)}"
+    if settings.columnar_api_url:
+        deliver(COLUMNAR, settings.columnar_api_url, make_columnar_batch(metrics, ts), batch_id, ts)
+    else:
+        deliver(ROWS, settings.api_url, make_batch(metrics, ts), batch_id, ts)
+
+
+class Aggregator:
+    """ min/max/sum/count accumulators per metric and tags for windows aligned to wall clock.
+    Closed window is held until random part of the window after its end, so the fleet does not send
+    at window boundary. Held windows are released by due(), which the daemon calls on its own timer
+    """
+
+    def __init__(self, window: int):
+        if window <= 0 or 60 % window:
+            raise ValueError("aggregate_window must divide a minute")
+        self.window = window
+        self.send_delay: float = random.uniform(0, window / 2)
+        self.window_start: Optional[int] = None
+        self.acc: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], List[float]] = {}
+        # (unix time to send at, payload) of closed windows
+        self.closed: List[Tuple[float, Dict[str, Any]]] = []
+
+    def add(self, metrics: List[Sample], ts: float) -> List[Dict[str, Any]]:
+        """ Add samples, window is closed when sample of the next window comes
+        :param metrics:
+        :param ts: sample unix timestamp
+        :return: payloads of closed windows which are due to send
+        """
+        window_start: int = int(ts) - int(ts) % self.window
+        if self.window_start is not None and window_start != self.window_start:
+            closed: Optional[Dict[str, Any]] = self.flush()
+            if closed is not None:
+                self.closed.append((self.window_start + self.window + self.send_delay, closed))
+        self.window_start = window_start
+
+        for metric, value, tags in metrics:
+            key = (metric, tuple(sorted(tags.items())))
+            acc: Optional[List[float]] = self.acc.get(key)
+            if acc is None:
+                self.acc[key] = [value, value, value, 1]
+            else:
+                acc[0] = min(acc[0], value)
+                acc[1] = max(acc[1], value)
+                acc[2] += value
+                acc[3] += 1
+
+        return self.due(ts)
+
+    def due(self, now: float) -> List[Dict[str, Any]]:
+        """ Release closed windows whose send time has come
+        :param now: unix time
+        :return: payloads to send
+        """
+        due: List[Dict[str, Any]] = [payload for send_at, payload in self.closed if send_at <= now]
+        self.closed = [(send_at, payload) for send_at, payload in self.closed if send_at > now]
+        return due
+
+    def next_due(self) -> Optional[float]:
+        """ Unix time of the next closed window to send
+        :return: None if nothing is held
+        """
+        return min(send_at for send_at, _ in self.closed) if self.closed else None
+
+    def flush(self) -> Optional[Dict[str, Any]]:
+        """ Close current window
+        :return: payload for POST /metrics/aggregated
+        """
+        if not self.acc:
+            return None
+
+        keys = list(self.acc)
+        tag_sets, tag_ids = encode_tags([dict(tags) for _, tags in keys])
+        payload: Dict[str, Any] = {
+            "host": settings.host,
+            "vm": VM,
+            "metrics": [metric for metric, _ in keys],
+            "timestamps": [self.window_start] * len(keys),
+            "mins": [self.acc[k][0] for k in keys],
+            "maxs": [self.acc[k][1] for k in keys],
+            "sums": [self.acc[k][2] for k in keys],
+            "counts": [int(self.acc[k][3]) for k in keys],
+            "tag_sets": tag_sets,
+            "tag_ids": tag_ids,
+        }
+        self.acc = {}
+        return payload
+
+
+def send_aggregated(payload: Dict[str, Any]) -> None:
+    """ Send pre-aggregated window to analytics api
+    :param payload:
+    :return:
+    """
+    window_start: int = payload["timestamps"][0]
+    logger.info(f"Send {len(payload['metrics'])} aggregated metrics of window {window_start}")
+    # window may be sent in parts by restarted collector, so batch id is unique per process
+    batch_id: str = f"{settings.host}/{VM}/agg/{RUN_ID}/{window_start}"
+    deliver(AGGREGATED, settings.aggregated_api_url, payload, batch_id, window_start)
+
+
+def run_once(aggregator: Optional[Aggregator] = None) -> None:
+    """ Collect metrics once and send them, or add them to aggregator
+    :param aggregator:
+    :return:
+    """
+    ts = time.time()
+    metrics = collect_metrics()
+    if not metrics:
+        logger.warning("No metrics collected")
+        return
+
+    if aggregator is not None:
+        for payload in aggregator.add(metrics, ts):
+            send_aggregated(payload)
+        return
+
+    logger.info(f"Send {len(metrics)} metrics")
+    send(metrics=metrics, ts=ts)
+
+
+def _wait_time(next_run: float, aggregator: Optional[Aggregator]) -> float:
+    """ Seconds until the next sample or the next held aggregated window to send
+    :param next_run: monotonic time of the next sample
+    :param aggregator:
+    :return:
+    """
+    wait: float = next_run - time.monotonic()
+    next_due: Optional[float] = aggregator.next_due() if aggregator is not None else None
+    if next_due is not None:
+        wait = min(wait, next_due - time.time())
+    return max(0.0, wait)
+
+
+def run_daemon() -> None:
+    """ Collect and send metrics every settings.interval seconds until SIGTERM/SIGINT.
+    Random start offset spreads sends of the whole fleet over the interval
+    :return:
+    """
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+    signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+
+    aggregator: Optional[Aggregator] = None
+    if settings.aggregate_window:
+        if not settings.aggregated_api_url:
+            raise ValueError("aggregated_api_url is required with aggregate_window")
+        aggregator = Aggregator(settings.aggregate_window)
+
+    prime_cpu()
+    next_run: float = time.monotonic() + random.uniform(0, settings.interval)
+    logger.info(f"Collector daemon started, interval {settings.interval}s, aggregate window {settings.aggregate_window}")
+
+    while not stop_event.wait(_wait_time(next_run, aggregator)):
+        if time.monotonic() >= next_run:
+            try:
+                run_once(aggregator)
+            except Exception as e:
+                logger.exception(f"Collect metrics failed - {e}")
+
+            next_run += settings.interval
+            if next_run < time.monotonic():
+                # collection took longer than interval, skip missed runs
+                logger.warning("Collector is late, skip missed runs")
+                next_run = time.monotonic() + settings.interval
+
+        if aggregator is not None:
+            # held windows are sent on their own time, not only at sample ticks
+            try:
+                for payload in aggregator.due(time.time()):
+                    send_aggregated(payload)
+            except Exception as e:
+                logger.exception(f"Send aggregated metrics failed - {e}")
+
+    if aggregator is not None:
+        # partial window is merged with the rest of it by rollups
+        closed: Optional[Dict[str, Any]] = aggregator.flush()
+        for payload in [payload for _, payload in aggregator.closed] + ([closed] if closed is not None else []):
+            send_aggregated(payload)
+
+    session.close()
+    logger.info("Collector daemon stopped")
 
 
 def main():
-    try:
-        metrics = collect_metrics()
-        if not metrics:
-            logger.warning("No metrics collected")
-            return
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--daemon", action="store_true", default=settings.daemon, help="run as long running daemon")
+    args = parser.parse_args()
 
-        logger.info(f"Send {len(metrics)} metrics")
-        send(metrics=metrics)
+    if args.daemon:
+        run_daemon()
+        return
 
+    try:
+        prime_cpu()
+        # measure cpu and io rates over one second, first sample of a fresh process is meaningless
+        time.sleep(1)
+        run_once()
         logger.info("Collector finished successfully")
     except Exception as e:
         logger.exception(f"Collector failed - {e}")
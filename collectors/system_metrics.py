@@ -0,0 +1,211 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import logging
+import psutil
+import time
+
+
+logger = logging.getLogger(__name__)
+
+Sample = Tuple[str, float, Dict[str, str]]
+
+# virtual interfaces, block devices and filesystems which only add cardinality
+SKIP_INTERFACES: Tuple[str, ...] = ("lo",)
+SKIP_DEVICES: Tuple[str, ...] = ("loop", "ram", "zram")
+SKIP_FSTYPES: Tuple[str, ...] = ("squashfs", "overlay", "tmpfs", "devtmpfs")
+
+NET_COUNTERS: Tuple[Tuple[str, str], ...] = (
+    ("bytes_recv", "net_rx_bytes"),
+    ("bytes_sent", "net_tx_bytes"),
+    ("packets_recv", "net_rx_packets"),
+    ("packets_sent", "net_tx_packets"),
+)
+DISK_COUNTERS: Tuple[Tuple[str, str], ...] = (
+    ("read_count", "disk_read_iops"),
+    ("write_count", "disk_write_iops"),
+    ("read_bytes", "disk_read_bytes"),
+    ("write_bytes", "disk_write_bytes"),
+)
+
+
+def cpu_busy(prev: Any, cur: Any) -> Optional[float]:
+    """ Busy part of cpu time between two psutil cpu_times readings
+    :param prev:
+    :param cur:
+    :return: None if counters did not move
+    """
+    total: float = sum(cur) - sum(prev)
+    if total <= 0:
+        return None
+    idle: float = (cur.idle - prev.idle) + (getattr(cur, "iowait", 0.0) - getattr(prev, "iowait", 0.0))
+    return min(1.0, max(0.0, 1 - idle / total))
+
+
+class SystemMetrics:
+    """ Collect host metrics with one bulk psutil read per group. Counters (cpu times, network and disk io)
+    are turned into per second rates from readings cached since the previous collect, so the first collect
+    only primes them.
+
+    Metric groups run in priority order. Cost of every group is measured with process cpu time, optional
+    groups are skipped when they would not fit cpu_budget seconds per collect. Cost estimate of a skipped
+    group decays, so it is tried again later.
+    """
+
+    def __init__(self, cpu_budget: float = 0.05, cost_decay: float = 0.9):
+        self.cpu_budget = cpu_budget
+        self.cost_decay = cost_decay
+
+        self.read_at: Dict[str, float] = {}
+        self.prev_cpu: Optional[List[Any]] = None
+        self.prev_net: Dict[str, Any] = {}
+        self.prev_disk: Dict[str, Any] = {}
+
+        # name, collect function, optional
+        self.groups: List[Tuple[str, Callable[[Optional[float]], List[Sample]], bool]] = [
+            ("cpu", self.collect_cpu, False),
+            ("memory", self.collect_memory, False),
+            ("net", self.collect_net, False),
+            ("disk", self.collect_disk, False),
+            ("disk_io", self.collect_disk_io, True),
+            ("mounts", self.collect_mounts, True),
+        ]
+        self.costs: Dict[str, float] = {name: 0.0 for name, _, _ in self.groups}
+        self.last_cost: float = 0.0
+        self.skipped: List[str] = []
+
+    def prime(self) -> None:
+        """ Cache counters, rates are reported from the next collect
+        :return:
+        """
+        self.collect()
+
+    def collect(self) -> List[Sample]:
+        """ Collect all metric groups which fit cpu budget
+        :return: list of (metric, value, tags)
+        """
+        started: float = time.process_time()
+        metrics: List[Sample] = []
+        self.skipped = []
+        for name, collect, optional in self.groups:
+            spent: float = time.process_time() - started
+            if optional and spent + self.costs[name] > self.cpu_budget:
+                self.costs[name] *= self.cost_decay
+                self.skipped.append(name)
+                continue
+
+            # skipped groups keep older readings, so time since previous reading is per group
+            now: float = time.monotonic()
+            elapsed: Optional[float] = now - self.read_at[name] if name in self.read_at else None
+            self.read_at[name] = now
+
+            group_started: float = time.process_time()
+            try:
+                metrics.extend(collect(elapsed))
+            except Exception as e:
+                logger.error(f"Collect {name} metrics failed: {e}")
+            self.costs[name] = time.process_time() - group_started
+
+        self.last_cost = time.process_time() - started
+        if self.skipped:
+            logger.warning(f"Collector cpu budget {self.cpu_budget}s exceeded, skipped {', '.join(self.skipped)}")
+        return metrics
+
+    def collect_cpu(self, elapsed: Optional[float]) -> List[Sample]:
+        cpu = psutil.cpu_times(percpu=True)
+        prev, self.prev_cpu = self.prev_cpu, cpu
+
+        metrics: List[Sample] = []
+        if prev is not None and len(prev) == len(cpu):
+            busy_sum: float = 0.0
+            cores: int = 0
+            for core, (p, c) in enumerate(zip(prev, cpu)):
+                busy: Optional[float] = cpu_busy(p, c)
+                if busy is None:
+                    continue
+                busy_sum += busy
+                cores += 1
+                metrics.append(("cpu_core_usage", busy, {"core": str(core)}))
+            if cores:
+                metrics.insert(0, ("cpu_usage", busy_sum / cores, {}))
+
+        load1, load5, load15 = psutil.getloadavg()
+        metrics.extend([
+            ("load_1", load1, {}),
+            ("load_5", load5, {}),
+            ("load_15", load15, {}),
+        ])
+        return metrics
+
+    def collect_memory(self, elapsed: Optional[float]) -> List[Sample]:
+        mem = psutil.virtual_memory()
+        return [("ram_used_pct", mem.percent / 100, {})]
+
+    def collect_net(self, elapsed: Optional[float]) -> List[Sample]:
+        counters: Dict[str, Any] = {
+            nic: c for nic, c in psutil.net_io_counters(pernic=True).items() if not nic.startswith(SKIP_INTERFACES)
+        }
+        prev, self.prev_net = self.prev_net, counters
+
+        metrics: List[Sample] = []
+        total: float = 0.0
+        for nic, c in counters.items():
+            rates: Dict[str, float] = self.rates(prev.get(nic), c, NET_COUNTERS, elapsed)
+            for metric, rate in rates.items():
+                metrics.append((metric, rate, {"iface": nic}))
+            total += rates.get("net_rx_bytes", 0.0) + rates.get("net_tx_bytes", 0.0)
+
+        if elapsed and prev:
+            # all interfaces bytes per second, ranked by /metrics/extremes
+            metrics.append(("net_io", total, {}))
+        return metrics
+
+    def collect_disk_io(self, elapsed: Optional[float]) -> List[Sample]:
+        counters: Dict[str, Any] = {
+            disk: c for disk, c in (psutil.disk_io_counters(perdisk=True) or {}).items()
+            if not disk.startswith(SKIP_DEVICES)
+        }
+        prev, self.prev_disk = self.prev_disk, counters
+
+        metrics: List[Sample] = []
+        for disk, c in counters.items():
+            for metric, rate in self.rates(prev.get(disk), c, DISK_COUNTERS, elapsed).items():
+                metrics.append((metric, rate, {"device": disk}))
+        return metrics
+
+    def collect_disk(self, elapsed: Optional[float]) -> List[Sample]:
+        # root filesystem only, disk_used_pct is read and ranked as root disk usage
+        return [("disk_used_pct", psutil.disk_usage("/").percent / 100, {"mount": "/"})]
+
+    def collect_mounts(self, elapsed: Optional[float]) -> List[Sample]:
+        metrics: List[Sample] = []
+        for partition in psutil.disk_partitions(all=False):
+            if partition.fstype in SKIP_FSTYPES or partition.mountpoint == "/":
+                continue
+            try:
+                usage = psutil.disk_usage(partition.mountpoint)
+            except OSError:
+                # unmounted or not readable since partitions were listed
+                continue
+            # own metric name, so other mounts are not averaged into root disk_used_pct
+            metrics.append(("disk_mount_used_pct", usage.percent / 100, {"mount": partition.mountpoint}))
+        return metrics
+
+    @staticmethod
+    def rates(
+            prev: Optional[Any], cur: Any, counters: Tuple[Tuple[str, str], ...], elapsed: Optional[float]
+    ) -> Dict[str, float]:
+        """ Per second rates of counters since previous reading, counters which were reset are skipped
+        :param prev:
+        :param cur:
+        :param counters: (psutil field, metric name)
+        :param elapsed: seconds since previous reading
+        :return:
+        """
+        if prev is None or not elapsed:
+            return {}
+        out: Dict[str, float] = {}
+        for field, metric in counters:
+            delta: int = getattr(cur, field) - getattr(prev, field)
+            if delta >= 0:
+                out[metric] = delta / elapsed
+        return out